@@ -0,0 +1,90 @@
+import json
+import os
+import time
+from django.core.management.base import BaseCommand
+from ...src.client_session import ClientSession, SendQueue
+from ...src.group_key import GroupKeyring
+from ...src.session_cipher import SessionCipher, new_salt
+from ...src.utils import FRAMING_BINARY
+
+class Command(BaseCommand):
+    help = 'Benchmarks per-broadcast CPU cost for per-client keys versus the group key mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--members',
+            type=int,
+            nargs='+',
+            default=[10, 100, 1000],
+            help='計測する参加人数'
+        )
+        parser.add_argument(
+            '--broadcasts',
+            type=int,
+            default=200,
+            help='人数ごとのブロードキャスト回数'
+        )
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=200,
+            help='本文の文字数'
+        )
+
+    def make_sessions(self, members, group_mode):
+        sessions = []
+        for i in range(members):
+            shared_key = os.urandom(32)
+            sessions.append(ClientSession(
+                f"127.0.0.1:{10000 + i}", f"user{i}", shared_key,
+                SendQueue(1 << 30), FRAMING_BINARY, group_mode,
+                cipher=SessionCipher(shared_key, new_salt(), new_salt(), True)
+            ))
+        return sessions
+
+    def per_client(self, sessions, message):
+        for session in sessions:
+            session.send_queue.put(session.encrypt_frame(message))
+
+    def group(self, sessions, message, group_key):
+        frame = group_key.encrypt_frame(message)
+        for session in sessions:
+            session.send_queue.put(frame)
+
+    def measure(self, sessions, broadcast, message, broadcasts):
+        start = time.process_time()
+        for _ in range(broadcasts):
+            broadcast(sessions, message)
+        elapsed = time.process_time() - start
+        for session in sessions:
+            session.send_queue.frames.clear()
+        return elapsed / broadcasts * 1000
+
+    def handle(self, *args, **options):
+        message = json.dumps({
+            "type": "message",
+            "username": "bench",
+            "ip": "127.0.0.1",
+            "port": "12345",
+            "content": "x" * options['size']
+        })
+        broadcasts = options['broadcasts']
+
+        self.stdout.write(f"{'members':>8} {'per-client ms':>14} {'group ms':>10} {'rotate ms':>10} {'speedup':>8}")
+        for members in options['members']:
+            per_client_ms = self.measure(self.make_sessions(members, False), self.per_client, message, broadcasts)
+
+            keyring = GroupKeyring()
+            sessions = self.make_sessions(members, True)
+            # 参加・離脱1回ごとにかかる鍵の再配布コスト
+            start = time.process_time()
+            group_key = keyring.next_key()
+            for session in sessions:
+                session.send_queue.put(group_key.wrap_frame(session.cipher))
+            rotate_ms = (time.process_time() - start) * 1000
+
+            group_ms = self.measure(
+                sessions, lambda s, m: self.group(s, m, group_key), message, broadcasts
+            )
+            speedup = per_client_ms / group_ms if group_ms else float('inf')
+            self.stdout.write(f"{members:>8} {per_client_ms:>14.3f} {group_ms:>10.3f} {rotate_ms:>10.3f} {speedup:>7.1f}x")
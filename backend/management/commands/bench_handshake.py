@@ -0,0 +1,85 @@
+import hashlib
+import random
+import time
+from django.core.management.base import BaseCommand
+from py_ecc.secp256k1 import secp256k1
+from ...src import utils
+
+class Command(BaseCommand):
+    help = 'Benchmarks ECDH handshakes per second for each available backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='バックエンドごとのハンドシェイク回数'
+        )
+        parser.add_argument(
+            '--backend',
+            choices=['all', 'legacy'] + list(utils.ECDH_BACKENDS),
+            default='all',
+            help='計測するバックエンド (legacy: 変更前のpy_ecc.multiplyをそのまま呼ぶ経路)'
+        )
+
+    def legacy_handshake(self, server_sk, client_sk):
+        client_pk = secp256k1.multiply(utils.G, client_sk)
+        server_pk = secp256k1.multiply(utils.G, server_sk)
+        server_secret = secp256k1.multiply(client_pk, server_sk)
+        client_secret = secp256k1.multiply(server_pk, client_sk)
+        return (
+            hashlib.sha256(str(server_secret[0]).encode()).digest(),
+            hashlib.sha256(str(client_secret[0]).encode()).digest()
+        )
+
+    def backend_handshake(self, backend, server_sk, server_pk, client_sk):
+        # クライアントの鍵生成 + 双方の共有鍵導出（キャッシュは通さない）
+        client_pk = backend.public_key(client_sk)
+        server_secret = backend.shared_x(server_sk, client_pk)
+        client_secret = backend.shared_x(client_sk, server_pk)
+        return (
+            hashlib.sha256(str(server_secret).encode()).digest(),
+            hashlib.sha256(str(client_secret).encode()).digest()
+        )
+
+    def report(self, name, elapsed, iterations):
+        rate = iterations / elapsed if elapsed else float('inf')
+        self.stdout.write(f"{name:<24} {rate:>10.1f} handshakes/s  {elapsed / iterations * 1000:>8.3f} ms/handshake")
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        selected = options['backend']
+        client_sks = [random.randint(1, utils.N - 1) for _ in range(iterations)]
+        server_sk = random.randint(1, utils.N - 1)
+
+        if selected in ('all', 'legacy'):
+            start = time.perf_counter()
+            for client_sk in client_sks:
+                self.legacy_handshake(server_sk, client_sk)
+            self.report('legacy (py_ecc.multiply)', time.perf_counter() - start, iterations)
+
+        for name, backend_class in utils.ECDH_BACKENDS.items():
+            if selected not in ('all', name):
+                continue
+            backend = backend_class()
+            # サーバー起動時と同じく、長期鍵の準備とGのテーブル構築は計測の外で行う
+            backend.prepare_private_key(server_sk)
+            server_pk = backend.public_key(server_sk)
+
+            start = time.perf_counter()
+            for client_sk in client_sks:
+                server_key, client_key = self.backend_handshake(backend, server_sk, server_pk, client_sk)
+            elapsed = time.perf_counter() - start
+            if server_key != client_key:
+                self.stderr.write(self.style.ERROR(f"{name}: 共有鍵が一致しません"))
+            self.report(name, elapsed, iterations)
+
+            # 同じ公開鍵からの再接続（共有鍵キャッシュのヒット）
+            utils.set_ecdh_backend(name)
+            client_pks = [utils.multiply(client_sk) for client_sk in client_sks]
+            for client_pk in client_pks:
+                utils.generate_shared_key(server_sk, client_pk)
+            start = time.perf_counter()
+            for client_pk in client_pks:
+                utils.generate_shared_key(server_sk, client_pk)
+            self.report(f"{name} (cached)", time.perf_counter() - start, iterations)
@@ -0,0 +1,329 @@
+import json
+import os
+import platform
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...src import utils
+from ...src.chat_manager import ChatManager
+from ...src.compression import PayloadCompressor
+from ...src.connection_manager import ConnectionManager
+from ...src.session_cipher import AESGCM, SessionCipher, new_salt
+
+# 1回の計測がこの秒数に届くまで反復回数を増やす
+CALIBRATE_SECONDS = 0.05
+
+
+def discard(sock, total):
+    # 受け取った分を捨てるだけの相手側
+    buffer = bytearray(1 << 20)
+    while total > 0:
+        received = sock.recv_into(buffer, min(len(buffer), total))
+        if not received:
+            return
+        total -= received
+
+
+def feed(sock, data, count):
+    for _ in range(count):
+        sock.sendall(data)
+
+
+def socket_run(target, args, body):
+    # socketpairの片側をスレッドで動かしながら、もう片側でbodyをn回呼ぶのにかかった秒数
+    def run(n):
+        left, right = socket.socketpair()
+        try:
+            peer = threading.Thread(target=target, args=(right,) + args(n), daemon=True)
+            peer.start()
+            started = time.perf_counter()
+            for _ in range(n):
+                body(left)
+            peer.join()
+            return time.perf_counter() - started
+        finally:
+            left.close()
+            right.close()
+    return run
+
+
+class Command(BaseCommand):
+    help = 'Times the crypto, compression, framing and message history hot paths and fails on regressions against a stored baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[64, 1024, 16384, 262144],
+            help='暗号化とフレーム送受信で計測する本文のバイト数'
+        )
+        parser.add_argument(
+            '--history-sizes',
+            type=int,
+            nargs='+',
+            default=[1000, 100000, 1000000],
+            help='add_message / get_messages で計測する保持件数'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='計測ごとの繰り返し回数 (最良値を採る)'
+        )
+        parser.add_argument(
+            '--filter',
+            default=None,
+            help='名前がこの正規表現に一致する計測だけを行う'
+        )
+        parser.add_argument(
+            '--baseline',
+            default=None,
+            help='基準値のJSONファイル (既定: benchmarks/hotpaths.json)'
+        )
+        parser.add_argument(
+            '--save-baseline',
+            action='store_true',
+            help='今回の結果を基準値として保存する'
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.2,
+            help='基準値からこの割合を超えて遅くなった計測があれば失敗にする (0.2: 20%%)'
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='結果をJSONで出力する'
+        )
+
+    def crypto_benchmarks(self, sizes):
+        key = os.urandom(32)
+        for size in sizes:
+            message = "x" * size
+            ciphertext = utils.aes_encrypt(message, key)
+            yield f"aes_encrypt[{size}]", self.loop(lambda message=message: utils.aes_encrypt(message, key))
+            yield f"aes_decrypt[{size}]", self.loop(lambda ciphertext=ciphertext: utils.aes_decrypt(ciphertext, key))
+            sender = SessionCipher(key, new_salt(), new_salt(), True)
+            yield f"session_encrypt[{size}]", self.loop(lambda message=message, sender=sender: sender.encrypt(message))
+            yield f"session_decrypt[{size}]", self.session_decrypt(key, message)
+
+        # サーバーと同じく長期鍵の準備は計測の外で行い、相手の公開鍵は毎回変える
+        server_sk = random.randint(1, utils.N - 1)
+        utils.prepare_private_key(server_sk)
+        public_keys = [utils.multiply(random.randint(1, utils.N - 1)) for _ in range(64)]
+        yield "derive_shared_key", self.loop_over(
+            public_keys, lambda public_key: utils.derive_shared_key(server_sk, public_key)
+        )
+        utils.generate_shared_key(server_sk, public_keys[0])
+        yield "generate_shared_key[cached]", self.loop(lambda: utils.generate_shared_key(server_sk, public_keys[0]))
+
+    def session_decrypt(self, key, message):
+        # 同じフレームは2度復号できないので、反復回数分を暗号化しておいてから計測する
+        def run(n):
+            server_salt, client_salt = new_salt(), new_salt()
+            sender = SessionCipher(key, server_salt, client_salt, True)
+            receiver = SessionCipher(key, server_salt, client_salt, False)
+            payloads = [sender.encrypt(message) for _ in range(n)]
+            started = time.perf_counter()
+            for payload in payloads:
+                receiver.decrypt(payload)
+            return time.perf_counter() - started
+        return run
+
+    def compression_benchmarks(self, sizes):
+        # 本文の大きさごとの、封筒込みのメッセージの圧縮と展開
+        compressor = PayloadCompressor()
+        words = random.Random(0).choices(["hello", "meeting", "today", "ok", "thanks", "see", "you", "at", "the", "room"], k=max(sizes))
+        for size in sizes:
+            message = self.chat_message(1, " ".join(words)[:size])
+            payload = compressor.compress(message)
+            yield f"compress[{size}]", self.loop(lambda message=message: compressor.compress(message))
+            yield f"decompress[{size}]", self.loop(lambda payload=payload: compressor.decompress(payload, utils.DEFAULT_MAX_FRAME))
+
+    def framing_benchmarks(self, sizes):
+        for size in sizes:
+            payload = os.urandom(size)
+            frame = utils.pack_data(payload)
+            yield f"send_data[{size}]", socket_run(
+                discard, lambda n, frame=frame: (len(frame) * n,),
+                lambda sock, payload=payload: utils.send_data(sock, payload)
+            )
+            yield f"receive_data[{size}]", socket_run(
+                feed, lambda n, frame=frame: (frame, n), utils.receive_data
+            )
+            yield f"recvall[{size}]", socket_run(
+                feed, lambda n, payload=payload: (payload, n),
+                lambda sock, size=size: utils.recvall(sock, size)
+            )
+
+    def history_benchmarks(self, history_sizes):
+        for history_size in history_sizes:
+            yield from self.history_group(history_size)
+
+    def history_group(self, history_size):
+        chat_manager = None
+
+        def prepared():
+            # 保持件数いっぱいまで埋めるのは重いので、この保持件数の計測を始めるときに1回だけ行う
+            nonlocal chat_manager
+            if chat_manager is None:
+                chat_manager = ChatManager(ConnectionManager(), max_messages=history_size)
+                for seq in range(history_size):
+                    chat_manager.messages.add(self.chat_message(seq), {"seq": seq})
+            return chat_manager
+
+        def add_message(n):
+            # 満杯の状態から追加するので、最も古いメッセージの破棄も含む
+            manager = prepared()
+            first = manager.messages.next_seq + history_size
+            messages = [(self.chat_message(seq), {"seq": seq}) for seq in range(first, first + n)]
+            started = time.perf_counter()
+            for message, decoded in messages:
+                manager.add_message(message, decoded)
+            return time.perf_counter() - started
+
+        def get_messages(**kwargs):
+            def run(n):
+                manager = prepared()
+                if kwargs.get("since_timestamp") == "middle":
+                    kwargs["since_timestamp"] = manager.messages.record_at(manager.messages.size // 2).timestamp
+                return self.loop(lambda: manager.get_messages(**kwargs))(n)
+            return run
+
+        yield f"add_message[history={history_size}]", add_message
+        yield f"get_messages[history={history_size},limit=100]", get_messages(limit=100)
+        yield f"get_messages[history={history_size},since]", get_messages(limit=100, since_timestamp="middle")
+        yield f"get_messages[history={history_size},all]", get_messages()
+
+    def chat_message(self, seq, content="hello"):
+        return json.dumps({
+            "type": "message",
+            "username": f"user{seq % 100}",
+            "ip": "127.0.0.1",
+            "port": "12345",
+            "content": content,
+            "room": "lobby",
+            "seq": seq
+        })
+
+    def loop(self, body):
+        def run(n):
+            started = time.perf_counter()
+            for _ in range(n):
+                body()
+            return time.perf_counter() - started
+        return run
+
+    def loop_over(self, items, body):
+        def run(n):
+            started = time.perf_counter()
+            for i in range(n):
+                body(items[i % len(items)])
+            return time.perf_counter() - started
+        return run
+
+    def measure(self, run, repeat):
+        # 1回がCALIBRATE_SECONDSに届く反復回数を決めてから、repeat回計測して最良値を採る
+        iterations = 1
+        while True:
+            elapsed = run(iterations)
+            if elapsed >= CALIBRATE_SECONDS:
+                break
+            iterations = min(iterations * 10, max(iterations * 2, int(iterations * CALIBRATE_SECONDS / max(elapsed, 1e-9) * 1.2)))
+        best = min([elapsed] + [run(iterations) for _ in range(repeat - 1)])
+        return best / iterations * 1e9, iterations
+
+    def baseline_path(self, options):
+        return Path(options['baseline']) if options['baseline'] else Path(settings.BASE_DIR) / 'benchmarks' / 'hotpaths.json'
+
+    def environment(self):
+        # 基準値と比べる意味があるかを判断するための計測環境
+        return {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "ecdh_backend": utils.ecdh_backend.name,
+            "aead_backend": "cryptography" if AESGCM else "pycryptodome"
+        }
+
+    def load_baseline(self, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        current = self.environment()
+        differences = [
+            f"{key}: {data[key]} → {value}" for key, value in current.items()
+            if key in data and key != "platform" and data[key] != value
+        ]
+        if differences:
+            self.stderr.write(self.style.WARNING(
+                f"基準値は別の環境で計測されています ({', '.join(differences)})。比較には同じ環境で --save-baseline した値を使ってください"
+            ))
+        return data["benchmarks"]
+
+    def save_baseline(self, path, results):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                "created": datetime.now().isoformat(timespec='seconds'),
+                **self.environment(),
+                "benchmarks": {name: result["ns_per_op"] for name, result in results.items()}
+            }, f, indent=2)
+            f.write("\n")
+
+    def handle(self, *args, **options):
+        pattern = re.compile(options['filter']) if options['filter'] else None
+        repeat = max(1, options['repeat'])
+        if min(options['history_sizes']) < 1:
+            raise CommandError("--history-sizes には1以上を指定してください")
+        path = self.baseline_path(options)
+        baseline = self.load_baseline(path) or {}
+        benchmarks = [
+            self.crypto_benchmarks(options['sizes']),
+            self.compression_benchmarks(options['sizes']),
+            self.framing_benchmarks(options['sizes']),
+            self.history_benchmarks(options['history_sizes'])
+        ]
+
+        results = {}
+        regressions = []
+        if not options['json']:
+            self.stdout.write(f"{'benchmark':<44} {'iterations':>10} {'us/op':>12} {'baseline':>12} {'ratio':>7}")
+        for group in benchmarks:
+            for name, run in group:
+                if pattern and not pattern.search(name):
+                    continue
+                ns_per_op, iterations = self.measure(run, repeat)
+                ratio = ns_per_op / baseline[name] if baseline.get(name) else None
+                results[name] = {"ns_per_op": ns_per_op, "iterations": iterations, "ratio": ratio}
+                if ratio is not None and ratio > 1 + options['threshold']:
+                    regressions.append(name)
+                if not options['json']:
+                    reference = f"{baseline[name] / 1000:>12.3f} {ratio:>6.2f}x" if ratio is not None else f"{'-':>12} {'-':>7}"
+                    line = f"{name:<44} {iterations:>10} {ns_per_op / 1000:>12.3f} {reference}"
+                    self.stdout.write(self.style.ERROR(line) if name in regressions else line)
+
+        if options['json']:
+            self.stdout.write(json.dumps({"baseline": str(path) if baseline else None, "results": results}, indent=2))
+        if options['save_baseline']:
+            # 一部だけ計測したときは、それ以外の基準値を残したまま上書きする
+            merged = {name: {"ns_per_op": value} for name, value in baseline.items()}
+            merged.update(results)
+            self.save_baseline(path, merged)
+            self.stderr.write(f"基準値を {path} に保存しました")
+        elif regressions:
+            raise CommandError(
+                f"{len(regressions)} 件の計測が基準値より {options['threshold']:.0%} を超えて遅くなりました: "
+                + ", ".join(regressions)
+            )
@@ -0,0 +1,82 @@
+import random
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ...src import utils
+from ...src.connection_manager import ConnectionManager
+
+class Command(BaseCommand):
+    help = 'Measures reconnect latency against a running socket server with and without session resumption'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default=None,
+            help='接続先IP (既定: CHAT_SERVER_HOST)'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=None,
+            help='接続先Port (既定: CHAT_SERVER_PORT)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=50,
+            help='方式ごとの再接続回数'
+        )
+
+    def new_client(self, nickname):
+        # 鍵ファイルは作らず、メモリ上の鍵で接続する
+        connection_manager = ConnectionManager()
+        connection_manager.nickname = nickname
+        connection_manager.client_sk = random.randint(1, utils.N - 1)
+        connection_manager.client_pk = utils.multiply(connection_manager.client_sk)
+        return connection_manager
+
+    def reconnect(self, connection_manager, host, port, resume):
+        if not resume:
+            connection_manager.resumption = None
+        start = time.perf_counter()
+        connection_manager.connect_to_server(host, port)
+        elapsed = time.perf_counter() - start
+        resumed = connection_manager.resumed
+        connection_manager.close_connection()
+        return elapsed, resumed
+
+    def report(self, name, samples):
+        samples_ms = sorted(sample * 1000 for sample in samples)
+        p99 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.99))]
+        self.stdout.write(
+            f"{name:<28} 平均 {statistics.mean(samples_ms):>8.3f}ms  "
+            f"中央値 {statistics.median(samples_ms):>8.3f}ms  p99 {p99:>8.3f}ms"
+        )
+
+    def handle(self, *args, **options):
+        host = options['host'] or getattr(settings, 'CHAT_SERVER_HOST', '127.0.0.1')
+        port = options['port'] or getattr(settings, 'CHAT_SERVER_PORT', 12345)
+        iterations = options['iterations']
+
+        # 毎回新しい鍵（サーバー側の共有鍵キャッシュにも当たらない初回接続相当）
+        cold = [self.reconnect(self.new_client(f"bench-cold-{i}"), host, port, False)[0] for i in range(iterations)]
+
+        # 同じ鍵で再接続（共有鍵キャッシュは効くがECDHの手順は毎回行う）
+        connection_manager = self.new_client("bench-reconnect")
+        self.reconnect(connection_manager, host, port, False)
+        full = [self.reconnect(connection_manager, host, port, False)[0] for _ in range(iterations)]
+
+        # チケットによる再開
+        self.reconnect(connection_manager, host, port, False)
+        resumed_samples = [self.reconnect(connection_manager, host, port, True) for _ in range(iterations)]
+        resumed = [elapsed for elapsed, ok in resumed_samples if ok]
+
+        self.report('full handshake (new key)', cold)
+        self.report('full handshake (same key)', full)
+        if resumed:
+            self.report('resumed', resumed)
+        if len(resumed) < iterations:
+            self.stderr.write(self.style.WARNING(
+                f"{iterations - len(resumed)} 回は再開できずに通常のハンドシェイクになりました (サーバーの --ticket-ttl を確認してください)"
+            ))
@@ -0,0 +1,476 @@
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from ...src import utils
+from ...src.connection_manager import ConnectionManager
+from ...src.rooms import DEFAULT_ROOM
+
+
+def percentile(samples, q):
+    # samplesは昇順に並べ替え済み
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def summarize(samples):
+    samples = sorted(sample * 1000 for sample in samples)
+    if not samples:
+        return {"count": 0, "mean": None, "p50": None, "p99": None, "p999": None, "max": None}
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples),
+        "p50": percentile(samples, 0.5),
+        "p99": percentile(samples, 0.99),
+        "p999": percentile(samples, 0.999),
+        "max": samples[-1]
+    }
+
+
+def process_tree(pid):
+    # プリフォーク構成ではワーカーも合わせて数える
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/task/{child}/children") as f:
+                pids.extend(int(found) for found in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def process_usage(pid):
+    # /proc から読んだCPU秒（ユーザー + システム）と常駐メモリ。Linux以外やpid不明ならNone
+    if pid is None:
+        return None
+    cpu = 0.0
+    rss = 0
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    try:
+        for target in process_tree(pid):
+            with open(f"/proc/{target}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f"/proc/{target}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+    except (OSError, IndexError, ValueError):
+        return None
+    return cpu, rss
+
+
+class LoadClient:
+    # ConnectionManagerに、送った本文の識別子と届いた時刻の集計だけを足したもの
+    def __init__(self, command, index, room):
+        self.command = command
+        self.index = index
+        self.room = room
+        self.connection_manager = ConnectionManager()
+        self.connection_manager.nickname = f"load-{index}"
+        self.connection_manager.client_sk = random.randint(1, utils.N - 1)
+        self.connection_manager.client_pk = utils.multiply(self.connection_manager.client_sk)
+        # 切断は計測の一部なので再接続させず、参加時の履歴も受け取らない
+        self.connection_manager.auto_reconnect = False
+        self.connection_manager.join_history = 0
+        self.connection_manager.rooms = {room}
+
+    def connect(self, host, port):
+        started = time.perf_counter()
+        self.connection_manager.connect_to_server(host, port)
+        elapsed = time.perf_counter() - started
+        self.connection_manager.set_message_callback(self.on_message)
+        return elapsed
+
+    def on_message(self, message):
+        if self.command.token not in message:
+            return
+        content = json.loads(message).get("content", "")
+        _, sent_ns, _ = content.split(":", 2)
+        self.command.record_delivery(int(sent_ns))
+
+    def send(self, content):
+        connection_manager = self.connection_manager
+        if connection_manager.rooms_enabled:
+            connection_manager.send_message(json.dumps({"type": "message", "room": self.room, "content": content}))
+        else:
+            connection_manager.send_message(content)
+
+    def close(self):
+        self.connection_manager.close_connection()
+
+
+class Command(BaseCommand):
+    help = 'Drives simulated chat clients against a socket server and reports throughput, latency and resource usage as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default=None,
+            help='接続先IP (既定: CHAT_SERVER_HOST, 0.0.0.0なら127.0.0.1)'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=None,
+            help='接続先Port (既定: CHAT_SERVER_PORT)'
+        )
+        parser.add_argument(
+            '--clients',
+            type=int,
+            default=50,
+            help='同時に接続するクライアント数'
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=1.0,
+            help='クライアント1つあたりの毎秒の送信数'
+        )
+        parser.add_argument(
+            '--fanout',
+            type=int,
+            default=0,
+            help='1件が届くクライアント数 (この人数ずつ別のルームに入れる。0: 全員が既定ルーム)'
+        )
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=100,
+            help='本文の文字数'
+        )
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=10.0,
+            help='計測する秒数'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=float,
+            default=1.0,
+            help='計測前に送信だけ行う秒数'
+        )
+        parser.add_argument(
+            '--drain',
+            type=float,
+            default=2.0,
+            help='送信を止めてから配信中のメッセージを待つ秒数'
+        )
+        parser.add_argument(
+            '--churn',
+            type=float,
+            default=0.0,
+            help='毎秒切断して新しい鍵で接続し直すクライアント数'
+        )
+        parser.add_argument(
+            '--connect-concurrency',
+            type=int,
+            default=16,
+            help='最初の接続で同時に行うハンドシェイク数'
+        )
+        parser.add_argument(
+            '--sender-threads',
+            type=int,
+            default=4,
+            help='送信を行うスレッド数 (クライアントを分担する)'
+        )
+        parser.add_argument(
+            '--server-pid',
+            type=int,
+            default=None,
+            help='CPUとメモリを計測するサーバーのpid (ワーカーも合わせて数える)'
+        )
+        parser.add_argument(
+            '--spawn-server',
+            action='store_true',
+            help='run_socket_serverをこのコマンドから起動して計測後に停止する'
+        )
+        parser.add_argument(
+            '--server-args',
+            default='',
+            help='--spawn-server で渡す引数 (例: "--engine asyncio --workers 2")'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'text'],
+            default='json',
+            help='結果の出力形式'
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help='結果を書き出すファイル (既定: 標準出力)'
+        )
+
+    def record_delivery(self, sent_ns):
+        if sent_ns < self.measure_from:
+            return
+        received = time.perf_counter_ns()
+        # 全クライアントの受信スレッドから呼ばれるので、件数と遅延はロックの中でまとめて更新する
+        with self.stats_lock:
+            self.latencies.append((received - sent_ns) / 1e9)
+            self.delivered += 1
+
+    def spawn_server(self, host, port, server_args):
+        env = dict(os.environ, CHAT_SERVER_HOST=host, CHAT_SERVER_PORT=str(port))
+        process = subprocess.Popen(
+            [sys.executable, 'manage.py', 'run_socket_server'] + shlex.split(server_args),
+            cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"サーバーが起動直後に終了しました (終了コード {process.returncode})")
+            # 待ち受けを始めたかどうかだけを確かめる。ハンドシェイクはしない
+            with contextlib.suppress(OSError), socket.create_connection((host, port), timeout=1):
+                return process
+            time.sleep(0.2)
+        process.kill()
+        raise RuntimeError("サーバーが待ち受けを始めませんでした")
+
+    def stop_server(self, process):
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def room_for(self, index, fanout):
+        return f"load-{index // fanout}" if fanout else DEFAULT_ROOM
+
+    def connect_all(self, clients, host, port, concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            started = time.perf_counter()
+            results = list(executor.map(lambda client: self.try_connect(client, host, port), clients))
+            elapsed = time.perf_counter() - started
+        return [result for result in results if result is not None], elapsed
+
+    def try_connect(self, client, host, port):
+        try:
+            return client.connect(host, port)
+        except Exception as e:
+            with self.stats_lock:
+                self.connect_errors += 1
+                self.last_error = str(e)
+            return None
+
+    def sender_loop(self, slots, indices, rate, size):
+        # 開ループで送る。遅れても送信間隔は詰めず、予定時刻どおりに送れなかった分はそのまま遅延に現れる
+        if not indices or rate <= 0:
+            return
+        interval = 1 / (rate * len(indices))
+        padding = "x" * size
+        next_time = time.perf_counter()
+        position = 0
+        while not self.stop_sending.is_set():
+            next_time += interval
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client = slots[indices[position % len(indices)]]
+            position += 1
+            if not client.connection_manager.is_connected:
+                continue
+            sent_ns = time.perf_counter_ns()
+            try:
+                client.send(f"{self.token}:{sent_ns}:{padding}")
+            except Exception:
+                with self.stats_lock:
+                    self.send_errors += 1
+                continue
+            if sent_ns >= self.measure_from:
+                with self.stats_lock:
+                    self.sent += 1
+                    self.expected += self.room_sizes.get(client.room, 0)
+
+    def churn_loop(self, slots, rate, host, port, fanout):
+        # 無作為に選んだクライアントを切断し、新しい鍵で同じ枠に接続し直す
+        while not self.stop_sending.wait(random.expovariate(rate)):
+            index = random.randrange(len(slots))
+            old = slots[index]
+            if not old.connection_manager.is_connected:
+                continue
+            with self.stats_lock:
+                self.room_sizes[old.room] -= 1
+            old.close()
+            client = LoadClient(self, index, self.room_for(index, fanout))
+            elapsed = self.try_connect(client, host, port)
+            slots[index] = client
+            if elapsed is None:
+                continue
+            with self.stats_lock:
+                self.room_sizes[client.room] += 1
+                self.churn_handshakes.append(elapsed)
+
+    def handle(self, *args, **options):
+        host = options['host'] or getattr(settings, 'CHAT_SERVER_HOST', '127.0.0.1')
+        if host == '0.0.0.0':
+            host = '127.0.0.1'
+        port = options['port'] or getattr(settings, 'CHAT_SERVER_PORT', 12345)
+        clients = options['clients']
+        fanout = min(options['fanout'], clients) if options['fanout'] > 0 else 0
+
+        # 他の実行や旧サーバーの履歴と混ざらないよう、この実行で送った本文にだけ付ける識別子
+        self.token = f"lt{os.getpid()}{random.randrange(1 << 32):08x}"
+        self.measure_from = float('inf')
+        self.stats_lock = threading.Lock()
+        self.stop_sending = threading.Event()
+        self.latencies = []
+        self.churn_handshakes = []
+        self.delivered = self.sent = self.expected = 0
+        self.send_errors = self.connect_errors = 0
+        self.last_error = None
+        self.room_sizes = {}
+
+        process = None
+        server_pid = options['server_pid']
+        if options['spawn_server']:
+            process = self.spawn_server(host, port, options['server_args'])
+            server_pid = process.pid
+
+        # ConnectionManagerの受信スレッドは標準出力に書くので、結果のJSONと混ざらないよう標準エラーに回す
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                report = self.run(host, port, clients, fanout, server_pid, options)
+        finally:
+            if process:
+                self.stop_server(process)
+
+        if options['format'] == 'json':
+            output = json.dumps(report, indent=2, ensure_ascii=False)
+        else:
+            output = self.format_text(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def run(self, host, port, clients, fanout, server_pid, options):
+        slots = [LoadClient(self, index, self.room_for(index, fanout)) for index in range(clients)]
+        handshakes, connect_seconds = self.connect_all(slots, host, port, max(1, options['connect_concurrency']))
+        for client in slots:
+            if client.connection_manager.is_connected:
+                self.room_sizes[client.room] = self.room_sizes.get(client.room, 0) + 1
+        if not handshakes:
+            raise RuntimeError(f"どのクライアントも接続できませんでした: {self.last_error}")
+
+        threads = [
+            threading.Thread(
+                target=self.sender_loop,
+                args=(slots, list(range(start, clients, options['sender_threads'])), options['rate'], options['size']),
+                daemon=True
+            )
+            for start in range(max(1, options['sender_threads']))
+        ]
+        if options['churn'] > 0:
+            threads.append(threading.Thread(
+                target=self.churn_loop, args=(slots, options['churn'], host, port, fanout), daemon=True
+            ))
+        for thread in threads:
+            thread.start()
+
+        time.sleep(options['warmup'])
+        server_before = process_usage(server_pid)
+        client_before = resource.getrusage(resource.RUSAGE_SELF)
+        started = time.perf_counter()
+        self.measure_from = time.perf_counter_ns()
+        time.sleep(options['duration'])
+        self.stop_sending.set()
+        measured = time.perf_counter() - started
+        for thread in threads:
+            thread.join()
+        time.sleep(options['drain'])
+        server_after = process_usage(server_pid)
+        client_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        with self.stats_lock:
+            latencies = list(self.latencies)
+            delivered, sent, expected = self.delivered, self.sent, self.expected
+        for client in slots:
+            client.close()
+
+        server = None
+        if server_before and server_after:
+            cpu = server_after[0] - server_before[0]
+            server = {
+                "pid": server_pid,
+                "cpu_seconds": cpu,
+                "cpu_percent": cpu / measured * 100,
+                "rss_bytes": server_after[1]
+            }
+        client_cpu = (client_after.ru_utime + client_after.ru_stime) - (client_before.ru_utime + client_before.ru_stime)
+        return {
+            "config": {
+                "host": host,
+                "port": port,
+                "clients": clients,
+                "rate_per_client": options['rate'],
+                "fanout": fanout or clients,
+                "size": options['size'],
+                "duration": options['duration'],
+                "churn_per_second": options['churn'],
+                "server_args": options['server_args'] if options['spawn_server'] else None,
+                "python": platform.python_version()
+            },
+            "handshakes": {
+                "connected": len(handshakes),
+                "errors": self.connect_errors,
+                "per_second": len(handshakes) / connect_seconds if connect_seconds else None,
+                "latency_ms": summarize(handshakes),
+                "churn_latency_ms": summarize(self.churn_handshakes)
+            },
+            "messages": {
+                "sent": sent,
+                "send_errors": self.send_errors,
+                "sent_per_second": sent / measured,
+                "delivered": delivered,
+                "expected": expected,
+                "delivery_ratio": delivered / expected if expected else None,
+                "delivered_per_second": delivered / measured
+            },
+            "latency_ms": summarize(latencies),
+            "server": server,
+            "client": {
+                "cpu_seconds": client_cpu,
+                "cpu_percent": client_cpu / measured * 100,
+                # Linuxのru_maxrssはキロバイト単位
+                "max_rss_bytes": client_after.ru_maxrss * 1024
+            }
+        }
+
+    def format_text(self, report):
+        handshakes = report["handshakes"]
+        messages = report["messages"]
+        latency = report["latency_ms"]
+        lines = [
+            f"接続: {handshakes['connected']} (失敗 {handshakes['errors']}), "
+            f"{handshakes['per_second']:.1f} handshakes/s, p50 {handshakes['latency_ms']['p50']:.2f}ms "
+            f"p99 {handshakes['latency_ms']['p99']:.2f}ms",
+            f"送信: {messages['sent']} 件 ({messages['sent_per_second']:.1f}/s), 失敗 {messages['send_errors']}",
+            f"配信: {messages['delivered']} / {messages['expected']} 件 ({messages['delivered_per_second']:.1f}/s)",
+        ]
+        if latency["count"]:
+            lines.append(
+                f"遅延: p50 {latency['p50']:.2f}ms  p99 {latency['p99']:.2f}ms  "
+                f"p999 {latency['p999']:.2f}ms  最大 {latency['max']:.2f}ms"
+            )
+        if report["server"]:
+            server = report["server"]
+            lines.append(f"サーバー: CPU {server['cpu_percent']:.1f}%, RSS {server['rss_bytes'] / 1048576:.1f}MiB")
+        client = report["client"]
+        lines.append(f"負荷生成側: CPU {client['cpu_percent']:.1f}%, 最大RSS {client['max_rss_bytes'] / 1048576:.1f}MiB")
+        return "\n".join(lines)
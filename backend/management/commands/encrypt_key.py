@@ -0,0 +1,26 @@
+import getpass
+from django.core.management.base import BaseCommand, CommandError
+from ...src.key_store import key_store
+
+class Command(BaseCommand):
+    help = 'Encrypts a key pair that was stored without a passphrase'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'nickname',
+            help='暗号化する鍵のニックネーム'
+        )
+
+    def handle(self, *args, **options):
+        nickname = options['nickname']
+        # 鍵の所有者がこのホストで入力する。接続画面からは平文の鍵にパスフレーズを設定できない
+        passphrase = getpass.getpass('パスフレーズ: ')
+        if not passphrase:
+            raise CommandError("パスフレーズを入力してください")
+        if getpass.getpass('パスフレーズ（確認）: ') != passphrase:
+            raise CommandError("パスフレーズが一致しません")
+        try:
+            key_store.encrypt(nickname, passphrase)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"{nickname} の鍵を暗号化しました"))
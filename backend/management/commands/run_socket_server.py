@@ -1,14 +1,52 @@
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+import asyncio
+import os
+import signal
 import socket
 import threading
-import hashlib
+import time
 import json
 import logging
-from ...src.utils import send_data, receive_data, generate_keys, aes_encrypt, aes_decrypt, get_local_ip
-from py_ecc.secp256k1.secp256k1 import multiply
+import queue
+import random
+from ...src.utils import send_data, receive_data, async_send_data, async_receive_data, async_next_frame, pack_data, send_buffers, frame_size, negotiate_framing, encode_frame, enable_keepalive, FrameReader, FRAMING_BINARY, SUPPORTED_FRAMINGS, FRAME_DATA, FRAME_PING, FRAME_PONG, FRAME_CHUNK, prepare_private_key, get_local_ip
+from ...src.client_session import ClientSession, SendQueue, AsyncSendQueue, SlowConsumerError, SLOW_CONSUMER_POLICIES
+from ...src.worker_bus import BusHub, WorkerBus
+from ...src.handshake_pool import HandshakePool, HandshakeTimeout
+from ...src.key_store import generate_keys
+from ...src.group_key import GroupKeyring
+from ...src.resumption import TicketCache, new_nonce, resumed_key
+from ...src.session_cipher import SALT_SIZE, SessionCipher, new_salt
+from ...src.message_store import MessageStore
+from ...src.message_log import MessageLog, FSYNC_POLICIES, take
+from ...src.rooms import DEFAULT_ROOM, RoomIndex, parse_request, visible_to
+from ...src.presence import ONLINE, Roster, presence_key
+from ...src.metrics import MetricsRegistry, serve_metrics
+from ...src.compression import COMPRESSION_ID, COMPRESSION_THRESHOLD, PayloadCompressor
+from ...src.transfers import BUS_CHUNK_BACKLOG, CHUNK_ABORT, CHUNK_LAST, MAX_TRANSFERS_PER_CLIENT, TRANSFER_QUEUE_FRAMES, TransferTable, decode_chunk, encode_chunk, parse_transfer_id
+
+# asyncioエンジンでログから一度に読み出す件数
+REPLAY_CHUNK = 256
+
+PONG_FRAME = encode_frame(b'', FRAMING_BINARY, FRAME_PONG)
+# 圧縮・展開はメッセージ1件で数マイクロ秒〜数ミリ秒なので、既定より細かいバケットで測る
+COMPRESSION_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+# 0や負の値では動作しない数値の引数
+POSITIVE_OPTIONS = (
+    'workers', 'send_queue_size', 'max_frame_size', 'idle_timeout', 'handshake_timeout', 'max_pending_handshakes',
+    'max_tickets', 'log_segment_bytes', 'log_fsync_interval', 'batch_max_bytes'
+)
+
+
+def option(options, name, default):
+    # 明示した0を既定値に置き換えないよう、未指定（None）のときだけ既定値を使う
+    value = options.get(name)
+    return default if value is None else value
+
 
 class Command(BaseCommand):
     help = 'Runs the socket server for chat'
@@ -16,10 +54,317 @@ class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.SERVER_SK, self.SERVER_PK = generate_keys("server")
+        prepare_private_key(self.SERVER_SK)
         self.clients = {}
         self.clients_lock = threading.Lock()
+        self.room_index = RoomIndex()
         self.running = True
         self.server_socket = None
+        self.async_server = None
+        self.send_queue_size = 1000
+        self.slow_consumer_policy = 'drop_oldest'
+        self.send_timeout = 1.0
+        self.worker_id = None
+        self.bus = None
+        self.bus_writer = None
+        # 他のワーカーから届いたチャンクを宛先に積む、送信元ワーカーごとのキュー
+        self.bus_chunk_backlogs = {}
+        self.bus_chunk_tasks = []
+        self.roster = Roster()
+        self.presence_interval = 0.05
+        self.presence_pending = threading.Event()
+        self.presence_event = None
+        self.presence_task = None
+        self.bus_task = None
+        self.handshake_pool = HandshakePool(self.SERVER_SK)
+        self.group_keyring = None
+        # 鍵の切り替えと参加者の追加を順番に行うためのロック（配信はこれを取らない）
+        self.group_key_lock = threading.Lock()
+        self.group_key_lock_async = None
+        self.tickets = None
+        self.history = None
+        self.message_log = None
+        self.log_writer = None
+        self.log_options = None
+        self.max_replay = 1000
+        self.heartbeat_interval = 30.0
+        self.idle_timeout = 90.0
+        self.seq_lock = threading.Lock()
+        self.last_seq = 0
+        self.batch_max_messages = 64
+        self.batch_max_bytes = 65536
+        self.batch_flush_delay = 0.0
+        self.message_echo_rate = 1.0
+        self.max_frame_size = 1024 * 1024
+        self.max_transfer_bytes = 100 * 1024 * 1024
+        self.transfer_timeout = 10.0
+        self.transfers = TransferTable()
+        self.compressor = PayloadCompressor()
+        self.stats_interval = 0
+        self.metrics_address = None
+        self.metrics_server = None
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine',
+            choices=['threaded', 'asyncio'],
+            default='threaded',
+            help='接続処理エンジン (threaded: 1接続1スレッド, asyncio: 単一イベントループ)'
+        )
+        parser.add_argument(
+            '--backlog',
+            type=int,
+            default=None,
+            help='listenのバックログ数 (既定: threaded=5, asyncio=1024)'
+        )
+        parser.add_argument(
+            '--send-queue-size',
+            type=int,
+            default=1000,
+            help='クライアントごとの送信キューの上限フレーム数'
+        )
+        parser.add_argument(
+            '--slow-consumer-policy',
+            choices=SLOW_CONSUMER_POLICIES,
+            default='drop_oldest',
+            help='送信キューが満杯のときの挙動 (drop_oldest: 古いものを破棄, disconnect: 切断, block: 空きを待つ)'
+        )
+        parser.add_argument(
+            '--send-timeout',
+            type=float,
+            default=1.0,
+            help='blockポリシーで空きを待つ最大秒数 (超過すると切断)'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='ワーカープロセス数 (2以上でlistenソケットを共有するプリフォーク構成)'
+        )
+        parser.add_argument(
+            '--handshake-pool-size',
+            type=int,
+            default=0,
+            help='共有鍵の導出に使うプロセス数 (0: 接続を処理するスレッドでそのまま導出)'
+        )
+        parser.add_argument(
+            '--max-pending-handshakes',
+            type=int,
+            default=256,
+            help='同時に処理中のハンドシェイクの上限 (超えた接続は空きが出るまで待たせる)'
+        )
+        parser.add_argument(
+            '--handshake-queue-timeout',
+            type=float,
+            default=5.0,
+            help='上限に達しているときに接続を待たせる最大秒数 (0で即座に切断)'
+        )
+        parser.add_argument(
+            '--handshake-timeout',
+            type=float,
+            default=10.0,
+            help='ハンドシェイク完了までの最大秒数'
+        )
+        parser.add_argument(
+            '--group-key',
+            action='store_true',
+            help='対応クライアントへのブロードキャストを共通のグループ鍵で1回だけ暗号化する (参加・離脱のたびに鍵を更新)'
+        )
+        parser.add_argument(
+            '--ticket-ttl',
+            type=float,
+            default=3600.0,
+            help='セッション再開チケットの有効秒数 (0: 再開を無効にする)'
+        )
+        parser.add_argument(
+            '--max-tickets',
+            type=int,
+            default=10000,
+            help='保持する再開チケットの上限 (超えた分は古いものから破棄)'
+        )
+        parser.add_argument(
+            '--heartbeat-interval',
+            type=float,
+            default=30.0,
+            help='対応クライアントに送らせるハートビートの間隔秒数 (0: ハートビートを使わない)'
+        )
+        parser.add_argument(
+            '--idle-timeout',
+            type=float,
+            default=90.0,
+            help='ハートビート対応クライアントから何も届かなければ切断するまでの秒数 (旧クライアントはTCPキープアライブで検出)'
+        )
+        parser.add_argument(
+            '--history-size',
+            type=int,
+            default=1000,
+            help='再接続したクライアントに送り直すために保持する直近のメッセージ数 (0: 送り直さない)'
+        )
+        parser.add_argument(
+            '--message-log',
+            default=None,
+            help='メッセージを追記保存するディレクトリ。指定するとサーバー再起動後も履歴を送り直せる (複数ワーカーではワーカーごとのサブディレクトリ)'
+        )
+        parser.add_argument(
+            '--log-segment-bytes',
+            type=int,
+            default=16 * 1024 * 1024,
+            help='メッセージログの1セグメントの最大バイト数'
+        )
+        parser.add_argument(
+            '--log-max-segments',
+            type=int,
+            default=0,
+            help='保持するセグメント数の上限。超えた分は古いものから削除 (0: 削除しない)'
+        )
+        parser.add_argument(
+            '--log-fsync',
+            choices=FSYNC_POLICIES,
+            default='interval',
+            help='always: 1件ごとにfsync, interval: --log-fsync-interval秒ごと, never: OSに任せる'
+        )
+        parser.add_argument(
+            '--log-fsync-interval',
+            type=float,
+            default=1.0,
+            help='--log-fsync interval のときのfsync間隔秒数'
+        )
+        parser.add_argument(
+            '--presence-interval',
+            type=float,
+            default=0.05,
+            help='在席の変更をまとめて配る間隔の秒数 (0: 変更のたびにすぐ配る)'
+        )
+        parser.add_argument(
+            '--max-replay',
+            type=int,
+            default=1000,
+            help='新しく参加したクライアントに送る直近のメッセージ数の上限'
+        )
+        parser.add_argument(
+            '--batch-max-messages',
+            type=int,
+            default=64,
+            help='1回の書き込みにまとめる最大フレーム数 (1でまとめない)'
+        )
+        parser.add_argument(
+            '--batch-max-bytes',
+            type=int,
+            default=65536,
+            help='1回の書き込みにまとめる最大バイト数'
+        )
+        parser.add_argument(
+            '--batch-flush-delay-us',
+            type=int,
+            default=0,
+            help='後続フレームを待つ最大マイクロ秒 (0: 既に溜まっている分だけまとめる)'
+        )
+        parser.add_argument(
+            '--compression',
+            choices=['zlib', 'none'],
+            default='zlib',
+            help='zlib: 対応クライアントとのメッセージを封筒用の辞書付きzlibで圧縮してから暗号化する, none: 圧縮しない'
+        )
+        parser.add_argument(
+            '--compression-threshold',
+            type=int,
+            default=COMPRESSION_THRESHOLD,
+            help='これより短いメッセージは圧縮しない (バイト数)'
+        )
+        parser.add_argument(
+            '--max-frame-size',
+            type=int,
+            default=1024 * 1024,
+            help='クライアントから受け付ける1フレームの最大バイト数。超えたクライアントは切断する'
+        )
+        parser.add_argument(
+            '--max-transfer-bytes',
+            type=int,
+            default=100 * 1024 * 1024,
+            help='分割転送で送れる1件あたりの最大バイト数'
+        )
+        parser.add_argument(
+            '--transfer-timeout',
+            type=float,
+            default=10.0,
+            help='分割転送のチャンクを宛先の送信キューに積めるまで待つ最大秒数。超えた宛先にはその転送を中断する'
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            default=0,
+            help='Prometheus形式のメトリクスを /metrics で返すポート (0: 無効, ワーカーごとに番号を足したポート)'
+        )
+        parser.add_argument(
+            '--metrics-host',
+            default='127.0.0.1',
+            help='メトリクスを返すアドレス'
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            default=0,
+            help='スループットや遅延の統計を1行出力する間隔の秒数 (0: 出力しない)'
+        )
+        parser.add_argument(
+            '--message-echo-rate',
+            type=float,
+            default=1.0,
+            help='ルームへの発言の本文を標準出力に表示する割合 (1: 全件, 0: 表示しない, 0.01: 100件に1件程度。個別メッセージは表示しない)'
+        )
+
+    def setup_metrics(self):
+        metrics = self.metrics
+        self.handshake_seconds = metrics.histogram('chat_handshake_seconds', '受け入れからハンドシェイク完了までの秒数')
+        self.decrypt_seconds = metrics.histogram('chat_decrypt_seconds', '受信メッセージ1件の復号にかかった秒数')
+        self.encrypt_seconds = metrics.histogram('chat_encrypt_seconds', '配信フレーム1つの暗号化にかかった秒数')
+        self.fan_out_seconds = metrics.histogram('chat_fan_out_seconds', '1件の配信を全宛先の送信キューに積むまでの秒数')
+        self.messages_received = metrics.counter('chat_messages_received_total', '受信したメッセージ数')
+        self.bytes_received = metrics.counter('chat_received_bytes_total', '受信したメッセージ本文（暗号文）のバイト数')
+        self.frames_sent = metrics.counter('chat_sent_frames_total', '送信したフレーム数')
+        self.bytes_sent = metrics.counter('chat_sent_bytes_total', '送信したバイト数')
+        self.send_calls = metrics.counter('chat_send_calls_total', '送信の書き込み回数')
+        self.chunks_relayed = metrics.counter('chat_transfer_chunks_total', '中継した分割転送のチャンク数')
+        self.compress_input = metrics.counter('chat_compress_input_bytes_total', '圧縮に応じた接続へ送るメッセージの圧縮前のバイト数')
+        self.compress_output = metrics.counter('chat_compress_output_bytes_total', '圧縮に応じた接続へ送るメッセージの圧縮後のバイト数')
+        self.compressor.set_metrics(
+            metrics.histogram('chat_compress_seconds', 'メッセージ1件の圧縮にかかった秒数', COMPRESSION_BUCKETS),
+            metrics.histogram('chat_decompress_seconds', '受信メッセージ1件の展開にかかった秒数', COMPRESSION_BUCKETS),
+            self.compress_input,
+            self.compress_output,
+            metrics.counter('chat_compress_skipped_total', '短いか縮まなかったため圧縮せずに送ったメッセージ数')
+        )
+        metrics.gauge(
+            'chat_compression_ratio', '圧縮後のバイト数 / 圧縮前のバイト数（起動からの累計）',
+            lambda: self.compress_output.value / self.compress_input.value if self.compress_input.value else 1.0
+        )
+        metrics.gauge('chat_connections', '接続中のクライアント数', lambda: len(self.clients))
+        metrics.gauge('chat_send_queue_frames', '全クライアントの送信キューに溜まっているフレーム数', lambda: self.queue_depths()[0])
+        metrics.gauge('chat_send_queue_frames_max', '最も溜まっている送信キューのフレーム数', lambda: self.queue_depths()[1])
+        metrics.gauge('chat_rooms', '参加者のいるルーム数', lambda: len(self.room_index.rooms))
+        metrics.gauge('chat_roster_users', '在席ユーザー数（他ワーカーの接続を含む）', lambda: len(self.roster.users))
+        metrics.gauge('chat_transfers', '中継中の分割転送の数（他ワーカーから届いたものを含む）', lambda: len(self.transfers))
+        metrics.gauge('chat_handshakes_pending', '処理中のハンドシェイク数', lambda: self.handshake_pool.stats()['pending'])
+        metrics.gauge('chat_handshakes_waiting', 'ハンドシェイクの順番を待っている接続数', lambda: self.handshake_pool.stats()['waiting'])
+        metrics.gauge(
+            'chat_handshakes_queued_total', '上限に達していたため順番を待った接続数',
+            lambda: self.handshake_pool.stats()['queued'], kind='counter'
+        )
+        metrics.gauge(
+            'chat_handshakes_rejected_total', '順番を待ちきれずに拒否した接続数',
+            lambda: self.handshake_pool.stats()['rejected'], kind='counter'
+        )
+        metrics.gauge(
+            'chat_handshakes_timed_out_total', 'タイムアウトしたハンドシェイク数',
+            lambda: self.handshake_pool.stats()['timed_out'], kind='counter'
+        )
+
+    def queue_depths(self):
+        # メトリクスのスレッドから読むので、接続一覧はコピーしてから数える
+        depths = [len(session.send_queue) for session in list(self.clients.values())]
+        return sum(depths), max(depths, default=0)
 
     def setup_logging(self):
         logging.basicConfig(
@@ -28,23 +373,102 @@ class Command(BaseCommand):
             datefmt='%Y-%m-%d %H:%M:%S'
         )
 
+    def server_hello(self):
+        hello = {"pk": self.SERVER_PK, "framing": list(SUPPORTED_FRAMINGS), "aead": new_salt()}
+        if self.group_keyring:
+            hello["group_key"] = True
+        if self.batch_max_messages > 1:
+            hello["batch"] = True
+        if self.heartbeat_interval:
+            hello["heartbeat"] = self.heartbeat_interval
+        if self.message_log is not None or self.history is not None:
+            hello["history"] = True
+        hello["rooms"] = True
+        hello["roster"] = True
+        hello["transfer"] = True
+        hello["max_frame"] = self.max_frame_size
+        if self.compressor:
+            hello["compression"] = [COMPRESSION_ID]
+        if self.tickets:
+            hello["resume"] = True
+            hello["nonce"] = new_nonce()
+        return hello
+
+    def negotiate(self, client_data):
+        # クライアントが応答で選んだ機能だけを有効にする。旧クライアントは何も選ばない
+        framing = negotiate_framing(client_data.get('framing'))
+        since = client_data.get('since')
+        last = client_data.get('history')
+        rooms = client_data.get('rooms')
+        aead = self.client_salt(client_data) is not None
+        return {
+            "framing": framing,
+            # グループ宛てのフレームはAES-GCMで暗号化するので、それに対応したクライアントだけをグループ鍵モードにする
+            "group_mode": bool(self.group_keyring and framing == FRAMING_BINARY and client_data.get('group_key') and aead),
+            "batch_mode": bool(self.batch_max_messages > 1 and framing == FRAMING_BINARY and client_data.get('batch')),
+            "heartbeat": bool(self.heartbeat_interval and framing == FRAMING_BINARY and client_data.get('heartbeat')),
+            "replay_since": since if isinstance(since, int) else None,
+            "replay_last": min(last, self.max_replay) if isinstance(last, int) and last > 0 else None,
+            "rooms": rooms if isinstance(rooms, list) else None,
+            "roster_mode": bool(client_data.get('roster')),
+            # チャンクは専用のフレーム種別で送り、宛先ごとにバイト列のまま暗号化し直すので、両方に対応した接続だけ
+            "transfer_mode": bool(framing == FRAMING_BINARY and client_data.get('transfer') and aead),
+            # 同じ辞書を選んだクライアントとだけ圧縮する。旧クライアントは何も選ばない
+            "compressor": self.compressor if self.compressor and client_data.get('compression') == COMPRESSION_ID else None
+        }
+
+    def client_salt(self, client_data):
+        salt = client_data.get('aead')
+        return salt if isinstance(salt, bytes) and len(salt) == SALT_SIZE else None
+
+    def session_cipher(self, hello, client_data, shared_key):
+        # 双方が塩を出し合った接続は、接続ごとの鍵とカウンタによるAES-GCMで暗号化する。それ以外は従来の暗号
+        client_salt = self.client_salt(client_data)
+        if client_salt is None:
+            return None
+        return SessionCipher(shared_key, hello['aead'], client_salt, True)
+
+    def resume_session(self, hello, client_data):
+        # 有効なチケットが提示されればECDHを省き、双方のノンスを混ぜた新しい鍵で再開する
+        if not self.tickets or client_data.get('ticket') is None:
+            return None
+        secret = self.tickets.redeem(client_data['ticket'], client_data['pk'])
+        client_nonce = client_data.get('nonce')
+        if secret is None or not isinstance(client_nonce, bytes):
+            return None
+        return resumed_key(secret, hello['nonce'], client_nonce)
+
+    def handshake_result(self, client_data, shared_key, resumed):
+        # 再開に対応したクライアントにだけ、結果と次回用のチケットを返す
+        if self.tickets and client_data.get('resume'):
+            return {"resumed": resumed, "ticket": self.tickets.issue(shared_key, client_data['pk'])}
+        return None
+
     def perform_key_exchange(self, client_socket):
         try:
-            send_data(client_socket, {"pk": self.SERVER_PK})
-            client_data = receive_data(client_socket)
-            
+            hello = self.server_hello()
+            send_data(client_socket, hello)
+            client_data = receive_data(client_socket, self.max_frame_size)
+
             if not client_data or not all(k in client_data for k in ['pk', 'address', 'nickname']):
                 raise ValueError("無効なクライアントデータを受信しました")
-            
+
             client_pk = client_data['pk']
             client_address = client_data['address']
             client_nickname = client_data['nickname']
-            
-            shared_secret = multiply(client_pk, self.SERVER_SK)
-            shared_key = hashlib.sha256(str(shared_secret[0]).encode()).digest()
-            
-            return client_address, client_nickname, shared_key
-            
+            features = self.negotiate(client_data)
+
+            shared_key = self.resume_session(hello, client_data)
+            resumed = shared_key is not None
+            if not resumed:
+                shared_key = self.handshake_pool.derive(client_pk)
+            result = self.handshake_result(client_data, shared_key, resumed)
+            if result:
+                send_data(client_socket, result)
+            features["cipher"] = self.session_cipher(hello, client_data, shared_key)
+
+            return client_address, client_nickname, shared_key, features
+
         except (ConnectionResetError, BrokenPipeError) as e:
             self.stderr.write(self.style.ERROR(f"キー交換中に接続が切断されました: {e}"))
             raise
@@ -52,101 +476,494 @@ class Command(BaseCommand):
             self.stderr.write(self.style.ERROR(f"キー交換中にエラーが発生: {e}"))
             raise
 
-    def send_client_update(self, client_socket, client_info, shared_key):
+    def complete_handshake(self, client_socket):
+        # 受け入れ時にadmitした枠は、成否にかかわらずここで返す
+        started = time.monotonic()
+        outcome = 'failed'
+        try:
+            client_socket.settimeout(self.handshake_pool.timeout)
+            result = self.perform_key_exchange(client_socket)
+            client_socket.settimeout(None)
+            outcome = 'completed'
+            return result
+        except (socket.timeout, HandshakeTimeout):
+            outcome = 'timeout'
+            raise
+        finally:
+            self.handshake_pool.release(started, outcome)
+            if outcome == 'completed':
+                self.handshake_seconds.observe(time.monotonic() - started)
+
+    def user_update(self, session, status):
+        return {
+            "type": "user_update",
+            "username": session.nickname,
+            "ip": session.ip,
+            "port": session.port,
+            "status": status
+        }
+
+    def room_update(self, session, room, status):
+        return json.dumps({
+            "type": "room_update",
+            "room": room,
+            "username": session.nickname,
+            "ip": session.ip,
+            "port": session.port,
+            "status": status
+        })
+
+    def user_online(self, nickname):
+        # 在席一覧にはバス経由で知った他ワーカーの接続も含まれる
+        return self.room_index.has_nickname(nickname) or self.roster.has_username(nickname)
+
+    def roster_frames(self, session, snapshot):
+        # 対応クライアントには在席一覧を1フレームで、旧クライアントには従来どおりユーザーごとに送る
+        if session.roster_mode:
+            return [session.encrypt_frame(json.dumps(snapshot))]
+        return [session.encrypt_frame(json.dumps(update)) for update in snapshot["users"]]
+
+    def presence_frames(self, delta, targets):
+        modern = [(key, session) for key, session in targets if session.roster_mode]
+        # 在席の変更は全員に配るものなので、グループ鍵で暗号化してよい
+        yield from self.broadcast_frames(json.dumps(delta), modern, True)
+        for key, session in targets:
+            if session.roster_mode:
+                continue
+            own_key = (session.ip, session.port, session.nickname)
+            for update in delta["updates"]:
+                # 旧クライアントには自分自身の参加通知を送らない（以前の挙動に合わせる）
+                if presence_key(update) != own_key:
+                    yield key, session, session.encrypt_frame(json.dumps(update))
+
+    def next_seq(self):
+        # seq_lockを持って呼ぶ。マイクロ秒の時刻を単調増加にそろえた値を連番にする。ワーカーが複数あるときはハブが振る
+        self.last_seq = max(self.last_seq + 1, time.time_ns() // 1000)
+        return self.last_seq
+
+    def store_history(self, message, seq):
+        # seq_lockを持って呼ぶ。ログがあればディスクに、無ければ直近の分だけメモリに残す
+        if self.log_writer is not None:
+            # 非同期エンジンではイベントループで書き込みやfsyncを待たないよう、1本のスレッドに順番どおり任せる
+            self.log_writer.submit(self.append_log, seq, message)
+        elif self.message_log is not None:
+            self.message_log.append(seq, message)
+        elif self.history is not None:
+            self.history.add(message, timestamp=seq)
+
+    def append_log(self, seq, message):
+        try:
+            self.message_log.append(seq, message)
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"メッセージログへの書き込み中にエラーが発生: {e}"))
+
+    def record_history(self, message, seq):
+        with self.seq_lock:
+            self.store_history(message, seq)
+
+    def sequenced_message(self, body, seq):
+        # ハブが振った連番を付けて記録する。バスからは連番の順に届くので、ログ上の順序も連番の順になる
+        body["seq"] = seq
+        message = json.dumps(body)
+        self.record_history(message, seq)
+        return message
+
+    def replay_messages(self, session):
+        # 再接続したクライアントには最後に受け取った連番より後を、新しく参加したクライアントには直近の分を返す。
+        # ログからは少しずつ読み出すイテレータを返すので、履歴全体をメモリに載せない
+        if self.message_log is not None:
+            if session.replay_since is not None:
+                messages = self.message_log.read_after(session.replay_since)
+            elif session.replay_last:
+                messages = self.message_log.read_last(session.replay_last)
+            else:
+                messages = iter(())
+        elif self.history is None:
+            return iter(())
+        else:
+            with self.seq_lock:
+                if session.replay_since is not None:
+                    records = self.history.since(session.replay_since)
+                elif session.replay_last:
+                    records = self.history.tail(0, session.replay_last)
+                else:
+                    records = []
+                messages = [record.raw for record in records]
+        # 参加していないルームのメッセージや他人同士の個別メッセージは送らない
+        return (message for message in messages if visible_to(session, message))
+
+    def chat_message(self, session, content, room=DEFAULT_ROOM, to=None):
+        # 連番の採番と記録を同じロックの中で行い、ログ上の順序を連番の順にそろえる
+        body = {
+            "type": "message",
+            "username": session.nickname,
+            "ip": session.ip,
+            "port": session.port,
+            "content": content
+        }
+        if to is None:
+            body["room"] = room
+        else:
+            body["to"] = to
+        if self.bus is not None or self.bus_writer is not None:
+            # ワーカー間ではバスのハブが全体で一意な連番を振って送信元にも送り返すので、記録と配信はそれを受け取ってから行う
+            return None, {"body": body}
+        with self.seq_lock:
+            body["seq"] = seq = self.next_seq()
+            message = json.dumps(body)
+            self.store_history(message, seq)
+        return message, {"seq": seq}
+
+    def route_request(self, key, session, text):
+        # 受信した要求を処理し、配信するメッセージと宛先を順に返す。呼び出し側は1件配信し終えてから次へ進む。
+        # 宛先がNoneのものは送信者本人への応答
+        request = parse_request(text, session.rooms_mode)
+        kind = request["type"]
+        if kind == "direct":
+            if not self.user_online(request["to"]):
+                raise ValueError(f"{request['to']} はオンラインではありません")
+            message, sequencing = self.chat_message(session, request["content"], to=request["to"])
+            # 送信者の他の接続にも同じものを届ける
+            yield message, dict(sequencing, to=(request["to"], session.nickname))
+        elif kind == "message":
+            if request["room"] not in session.rooms:
+                raise ValueError(f"ルーム {request['room']} に参加していません")
+            self.echo_message(session.nickname, request["content"], request["room"])
+            message, sequencing = self.chat_message(session, request["content"], room=request["room"])
+            yield message, dict(sequencing, room=request["room"])
+        elif kind == "roster":
+            yield json.dumps(self.roster.snapshot()), None
+        elif kind == "transfer":
+            # 転送の通知は履歴に残さない。チャンクはこの通知を受け取った宛先にだけ中継する
+            transfer = self.transfer_request(key, session, request)
+            message = self.transfer_message(session, request)
+            if request.get("to") is not None:
+                yield message, {"to": (request["to"],), "transfer": transfer}
+            else:
+                yield message, {"room": request["room"], "transfer": transfer}
+        elif kind == "join":
+            if self.room_index.join(key, session, request["room"]):
+                yield self.room_update(session, request["room"], "join"), {"room": request["room"]}
+        elif request["room"] in session.rooms:
+            # 退出する本人にも届くよう、索引から外すのは配信の後
+            yield self.room_update(session, request["room"], "leave"), {"room": request["room"]}
+            self.room_index.leave(key, session, request["room"])
+
+    def transfer_request(self, key, session, request):
+        if not session.transfer_mode:
+            raise ValueError("この接続は分割転送に対応していません")
+        if request["size"] > self.max_transfer_bytes:
+            raise ValueError(f"転送できるのは {self.max_transfer_bytes} バイトまでです")
+        if request.get("to") is not None:
+            if not self.user_online(request["to"]):
+                raise ValueError(f"{request['to']} はオンラインではありません")
+        elif request["room"] not in session.rooms:
+            raise ValueError(f"ルーム {request['room']} に参加していません")
+        transfer_id = parse_transfer_id(request["id"])
+        if self.transfers.get(key, transfer_id) is not None:
+            raise ValueError("同じIDの転送が既に進行中です")
+        if self.transfers.count(key) >= MAX_TRANSFERS_PER_CLIENT:
+            raise ValueError(f"同時に送れる転送は {MAX_TRANSFERS_PER_CLIENT} 件までです")
+        return key, transfer_id, request["size"]
+
+    def transfer_message(self, session, request):
+        body = {
+            "type": "transfer",
+            "id": request["id"],
+            "name": request["name"],
+            "size": request["size"],
+            "username": session.nickname,
+            "ip": session.ip,
+            "port": session.port
+        }
+        if request.get("to") is not None:
+            body["to"] = request["to"]
+        else:
+            body["room"] = request["room"]
+        return json.dumps(body)
+
+    def transfer_targets(self, targets, owner, transfer_id, size):
+        # 送信者本人と分割転送に対応していない接続には通知を送らず、通知した宛先を中継先として登録する
+        targets = [(key, session) for key, session in targets if key is not owner and session.transfer_mode]
+        self.transfers.start(owner, transfer_id, targets, size)
+        return targets
+
+    def bus_transfer(self, data):
+        # 他ワーカーで始まった転送は、そのワーカーを送信元として登録する
+        if not data.get("transfer"):
+            return None
+        transfer_id, size = data["transfer"]
+        return ("bus", data["origin"]), transfer_id, size
+
+    def accept_chunk(self, key, session, payload):
+        self.bytes_received.inc(len(payload))
+        return self.relay_chunk(key, session.cipher.decrypt_bytes(payload))
+
+    def relay_chunk(self, owner, plaintext):
+        # 中継先と宛先に送る平文、送信者に返すエラーを返す。組み立て直さずに1チャンクずつそのまま流す。
+        # 順序やサイズが不正なら転送を打ち切り、宛先には中断を送る。終わった転送や不明な転送のチャンクは捨てる
+        transfer_id, index, flags, data = decode_chunk(plaintext)
+        transfer = self.transfers.get(owner, transfer_id)
+        if transfer is None:
+            return None
+        error = None
+        if not flags & CHUNK_ABORT:
+            try:
+                transfer.accept(index, len(data))
+                if flags & CHUNK_LAST and not transfer.complete():
+                    raise ValueError("宣言したサイズに届かないまま転送が終わりました")
+            except ValueError as e:
+                error = e
+                flags = CHUNK_ABORT
+                plaintext = encode_chunk(transfer_id, index, CHUNK_ABORT)
+        if flags & (CHUNK_LAST | CHUNK_ABORT):
+            self.transfers.finish(owner, transfer_id)
+        self.chunks_relayed.inc()
+        return transfer.targets, plaintext, error
+
+    def drop_chunk_target(self, targets, key, session, plaintext, error):
+        # 送信キューが空くのを待ちきれなかった宛先はこの転送から外し、届いた分を捨てるよう中断を知らせる
+        if (key, session) in targets:
+            targets.remove((key, session))
+        self.stderr.write(self.style.WARNING(f"{session.nickname} への分割転送を中断します: {error}"))
+        transfer_id, index, _, _ = decode_chunk(plaintext)
+        return session.encrypt_chunk(encode_chunk(transfer_id, index, CHUNK_ABORT))
+
+    def error_message(self, error):
+        return {"type": "error", "content": str(error)}
+
+    def receive_timeout(self, session):
+        # ハートビートに応じたクライアントだけ、無通信が続いたら切断する
+        return self.idle_timeout if session.heartbeat else None
+
+    def send_client_update(self, session, client_info):
         try:
-            encrypted = aes_encrypt(json.dumps(client_info), shared_key)
-            send_data(client_socket, encrypted)
+            session.send_queue.put(session.encrypt_frame(json.dumps(client_info)))
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"クライアント更新の送信中にエラーが発生: {e}"))
             raise
 
+    def client_writer(self, client_socket, session):
+        # 送信キューを排出する専用スレッド。遅い受信者はこのスレッドだけを止める
+        try:
+            while True:
+                batch = session.send_queue.get_batch(
+                    self.batch_max_messages, self.batch_max_bytes, self.batch_flush_delay
+                )
+                if batch is None:
+                    break
+                buffers = session.batch_buffers(batch)
+                calls = send_buffers(client_socket, buffers)
+                self.record_send(len(batch), calls, frame_size(buffers))
+        except Exception as e:
+            if self.running:
+                self.stderr.write(self.style.ERROR(f"{session.nickname} への送信中にエラーが発生: {e}"))
+            self.evict_client(client_socket)
+
+    def record_send(self, frames, calls, nbytes):
+        self.frames_sent.inc(frames)
+        self.send_calls.inc(calls)
+        self.bytes_sent.inc(nbytes)
+
+    def decrypt_message(self, encrypted_message, session):
+        started = time.perf_counter()
+        if session.compressor:
+            # 展開後もフレームの上限を超えさせない
+            plaintext = session.compressor.decompress(session.cipher.decrypt_bytes(encrypted_message), self.max_frame_size)
+            message = plaintext.decode('utf-8')
+        else:
+            message = session.cipher.decrypt(encrypted_message)
+        self.decrypt_seconds.observe(time.perf_counter() - started)
+        self.messages_received.inc()
+        self.bytes_received.inc(len(encrypted_message))
+        return message
+
+    def echo_message(self, nickname, content, room=DEFAULT_ROOM):
+        # 1件ごとの標準出力は量が増えると配信より重くなるので、割合を指定して間引くか止める。
+        # 出すのはルームへの発言の本文だけで、要求のJSONや個別メッセージは出さない
+        rate = self.message_echo_rate
+        if rate >= 1 or (rate > 0 and random.random() < rate):
+            prefix = f'[{room}] ' if room != DEFAULT_ROOM else ''
+            self.stdout.write(self.style.SUCCESS(f'{prefix}{nickname}: {content}'))
+
     def handle_client(self, client_socket):
         client_address = None
         client_nickname = None
-        
+
+        if not self.handshake_pool.admit():
+            self.stderr.write(self.style.WARNING("ハンドシェイクの順番を待ちきれなかったため接続を拒否しました"))
+            client_socket.close()
+            return
+
         try:
             # キー交換
-            client_address, client_nickname, shared_key = self.perform_key_exchange(client_socket)
-            
-            with self.clients_lock:
-                self.clients[client_socket] = (client_address, client_nickname, shared_key)
-            
+            client_address, client_nickname, shared_key, features = self.complete_handshake(client_socket)
+            session = ClientSession(
+                client_address, client_nickname, shared_key,
+                SendQueue(self.send_queue_size, self.slow_consumer_policy, self.send_timeout),
+                **features
+            )
+            frame_reader = FrameReader(client_socket, session.framing, max_size=self.max_frame_size)
+            client_socket.settimeout(self.receive_timeout(session))
+            session.writer = threading.Thread(
+                target=self.client_writer,
+                args=(client_socket, session),
+                daemon=True
+            )
+            session.writer.start()
+
+            snapshot = self.roster.snapshot()
+            self.register_client(client_socket, session)
+            self.rotate_group_key()
+
             self.stdout.write(self.style.SUCCESS(f'新しいユーザーが接続しました: {client_nickname}'))
-            
-            # 接続通知の送信
-            ip, port = client_address.rsplit(':', 1)
-            update_message = {
-                "type": "user_update",
-                "username": client_nickname,
-                "ip": ip,
-                "port": port,
-                "status": "オンライン"
-            }
-            
+
             # 新規クライアントに既存ユーザーの情報を送信
-            with self.clients_lock:
-                for sock, (addr, nick, key) in self.clients.items():
-                    if sock != client_socket:
-                        existing_ip, existing_port = addr.rsplit(':', 1)
-                        try:
-                            self.send_client_update(client_socket, {
-                                "type": "user_update",
-                                "username": nick,
-                                "ip": existing_ip,
-                                "port": existing_port,
-                                "status": "オンライン"
-                            }, shared_key)
-                        except Exception:
-                            continue
-
-            # 他のクライアントに新規ユーザーの情報を通知
-            self.broadcast_message(json.dumps(update_message), client_socket)
-
-            # メッセージ受信ループ
+            for frame in self.roster_frames(session, snapshot):
+                session.send_queue.put(frame)
+
+            # 他のクライアントへの通知は、短い間隔の変更をまとめて差分として配る
+            self.publish_presence(self.user_update(session, ONLINE))
+
+            # 再接続したクライアントには切断中に流れたメッセージを、新しいクライアントには直近の履歴を送る。
+            # 送信キューの空きを待ちながら積むので、履歴が多くても取りこぼさずメモリも増えない
+            for message in self.replay_messages(session):
+                session.send_queue.put_wait(session.encrypt_frame(message))
+
+            # メッセージ受信ループ。届くまでブロックし、読み取りに失敗したらフレームの境目を失うので切断する
             while self.running:
                 try:
-                    encrypted_message = receive_data(client_socket)
-                    if not encrypted_message:
-                        break
-                    
-                    decrypted_message = aes_decrypt(encrypted_message, shared_key)
-                    self.stdout.write(self.style.SUCCESS(f'{client_nickname}: {decrypted_message}'))
-                    
-                    message_data = {
-                        "type": "message",
-                        "username": client_nickname,
-                        "ip": ip,
-                        "port": port,
-                        "content": decrypted_message
-                    }
-                    
-                    self.broadcast_message(json.dumps(message_data), None)
-                    
-                except (ConnectionResetError, BrokenPipeError):
+                    frame = frame_reader.next_frame()
+                except socket.timeout:
+                    self.stdout.write(self.style.WARNING(f"{client_nickname} から{self.idle_timeout:g}秒間応答が無いため切断します"))
+                    break
+                except OSError:
                     break
                 except Exception as e:
-                    self.stderr.write(self.style.ERROR(f"メッセージ処理中にエラーが発生: {e}"))
+                    self.stderr.write(self.style.ERROR(f"{client_nickname} から不正なデータを受信したため切断します: {e}"))
+                    break
+                if not frame:
+                    break
+
+                frame_type, encrypted_message = frame
+                if frame_type == FRAME_PING:
+                    session.send_queue.put(PONG_FRAME)
                     continue
+                if frame_type == FRAME_CHUNK:
+                    try:
+                        self.receive_chunk(client_socket, session, encrypted_message)
+                    except Exception as e:
+                        self.stderr.write(self.style.ERROR(f"チャンクの中継中にエラーが発生: {e}"))
+                    continue
+                if frame_type != FRAME_DATA:
+                    continue
+
+                try:
+                    decrypted_message = self.decrypt_message(encrypted_message, session)
+
+                    try:
+                        for message, route in self.route_request(client_socket, session, decrypted_message):
+                            if route is None:
+                                session.send_queue.put(session.encrypt_frame(message))
+                            else:
+                                self.broadcast_message(message, **route)
+                    except ValueError as e:
+                        self.send_client_update(session, self.error_message(e))
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"メッセージ処理中にエラーが発生: {e}"))
 
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"クライアント処理中にエラーが発生: {e}"))
         finally:
             self.cleanup_client(client_socket, client_address, client_nickname)
 
+    def receive_chunk(self, client_socket, session, payload):
+        relayed = self.accept_chunk(client_socket, session, payload)
+        if relayed is None:
+            return
+        targets, plaintext, error = relayed
+        self.enqueue_chunk(targets, plaintext)
+        self.publish_chunk(plaintext)
+        if error:
+            self.send_client_update(session, self.error_message(error))
+
+    def enqueue_chunk(self, targets, plaintext):
+        # チャンクは取りこぼすと組み立てられないので、ポリシーにかかわらず空きを待って積む
+        for key, session in list(targets):
+            if session.send_queue.closed:
+                continue
+            try:
+                session.send_queue.put_wait(session.encrypt_chunk(plaintext), self.transfer_timeout, TRANSFER_QUEUE_FRAMES)
+            except SlowConsumerError as e:
+                try:
+                    session.send_queue.put(self.drop_chunk_target(targets, key, session, plaintext, e))
+                except SlowConsumerError:
+                    pass
+
+    def backlog_chunk(self, origin, backlog, plaintext):
+        # 宛先に積みきれずに溜まりすぎた転送は中断する。以降のチャンクは終わった転送のものとして捨てられる
+        if backlog < BUS_CHUNK_BACKLOG:
+            return plaintext
+        transfer_id, index, flags, _ = decode_chunk(plaintext)
+        if flags & CHUNK_ABORT:
+            return plaintext
+        self.transfers.finish(("bus", origin), transfer_id)
+        self.stderr.write(self.style.WARNING(f"ワーカー {origin} からの分割転送が宛先に積みきれないため中断します"))
+        return encode_chunk(transfer_id, index, CHUNK_ABORT)
+
+    def queue_bus_chunk(self, origin, targets, plaintext):
+        # バスの受信スレッドは宛先の空きを待たず、送信元ワーカーごとのスレッドが順番に積む。
+        # 遅い宛先があっても、他のワーカーからのメッセージの受信は止まらない
+        backlog = self.bus_chunk_backlogs.get(origin)
+        if backlog is None:
+            backlog = self.bus_chunk_backlogs[origin] = queue.Queue()
+            threading.Thread(target=self.bus_chunk_loop, args=(backlog,), daemon=True).start()
+        backlog.put((targets, self.backlog_chunk(origin, backlog.qsize(), plaintext)))
+
+    def bus_chunk_loop(self, backlog):
+        while True:
+            targets, plaintext = backlog.get()
+            self.enqueue_chunk(targets, plaintext)
+
+    def publish_chunk(self, plaintext):
+        if self.bus:
+            try:
+                self.bus.publish_chunk(plaintext)
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"ワーカー間バスへの送信中にエラーが発生: {e}"))
+
+    def abort_transfers(self, client_socket):
+        # 送信元が切断したら、中継途中の転送の宛先に中断を知らせる
+        for transfer_id, transfer in self.transfers.drop(client_socket):
+            plaintext = encode_chunk(transfer_id, transfer.next_index, CHUNK_ABORT)
+            self.enqueue_all((key, session, session.encrypt_chunk(plaintext)) for key, session in transfer.targets)
+            self.publish_chunk(plaintext)
+
+    def evict_client(self, client_socket):
+        # ソケットを閉じるだけで、登録解除と切断通知は受信ループ側のcleanup_clientが行う
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def cleanup_client(self, client_socket, client_address, client_nickname):
         try:
             with self.clients_lock:
-                if client_socket in self.clients:
-                    del self.clients[client_socket]
-            
+                session = self.clients.pop(client_socket, None)
+            if session:
+                self.room_index.remove(client_socket, session)
+                session.send_queue.close()
+                self.abort_transfers(client_socket)
+                self.rotate_group_key()
+
             client_socket.close()
-            
+
             if client_nickname and client_address:
                 self.stdout.write(self.style.WARNING(f"{client_nickname} ({client_address}) が切断しました"))
-                
+
                 ip, port = client_address.rsplit(':', 1)
                 current_time = datetime.now(ZoneInfo("Asia/Tokyo")).strftime('%Y/%m/%d %H:%M')
-                
+
                 disconnect_message = {
                     "type": "user_update",
                     "username": client_nickname,
@@ -154,40 +971,726 @@ class Command(BaseCommand):
                     "port": port,
                     "status": f"最終ログイン: {current_time}"
                 }
-                
-                self.broadcast_message(json.dumps(disconnect_message), None)
-                
+
+                self.publish_presence(disconnect_message)
+
         except Exception as e:
             self.stderr.write(self.style.ERROR(f"クライアントのクリーンアップ中にエラーが発生: {e}"))
 
-    def broadcast_message(self, message, exclude_socket=None):
-        disconnected_clients = []
-        
+    def broadcast_message(self, message, exclude_socket=None, seq=None, room=None, to=None, transfer=None, body=None):
+        # 連番を振ってもらうメッセージは、ハブから戻ってきたときにこのワーカーの宛先にも配る
+        if body is None:
+            self.fan_out(message, exclude_socket, room, to, transfer)
+        self.publish_bus(message, seq=seq, room=room, to=to, transfer=transfer, body=body)
+
+    def publish_bus(self, message, presence=False, seq=None, room=None, to=None, transfer=None, body=None):
+        if self.bus:
+            try:
+                # 転送の送信元（接続）は他ワーカーでは意味がないので、IDとサイズだけを送る
+                self.bus.publish(message, presence, seq, room, to, transfer and transfer[1:], body)
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"ワーカー間バスへの送信中にエラーが発生: {e}"))
+
+    def publish_presence(self, update):
+        self.roster.update(update)
+        self.publish_bus(json.dumps(update), presence=True)
+        self.presence_changed()
+
+    def presence_changed(self):
+        if self.presence_interval:
+            self.presence_pending.set()
+        else:
+            self.flush_presence()
+
+    def presence_loop(self):
+        # 最初の変更から一定時間待ち、その間の変更をまとめて1回で配る
+        while self.running:
+            if not self.presence_pending.wait(1.0):
+                continue
+            time.sleep(self.presence_interval)
+            self.presence_pending.clear()
+            self.flush_presence()
+
+    def flush_presence(self):
+        delta = self.roster.drain()
+        if delta:
+            with self.clients_lock:
+                targets = list(self.clients.items())
+            self.enqueue_all(self.presence_frames(delta, targets))
+
+    def on_bus_message(self, data):
+        if data.get("chunk") is not None:
+            relayed = self.relay_chunk(("bus", data["origin"]), data["chunk"])
+            if relayed:
+                self.queue_bus_chunk(data["origin"], relayed[0], relayed[1])
+            return
+        if data["presence"]:
+            self.roster.update(json.loads(data["message"]))
+            self.presence_changed()
+            return
+        if data.get("body") is not None:
+            message = self.sequenced_message(data["body"], data["seq"])
+            self.fan_out(message, room=data.get("room"), to=data.get("to"))
+            return
+        if data.get("seq") is not None:
+            self.record_history(data["message"], data["seq"])
+        self.fan_out(data["message"], room=data.get("room"), to=data.get("to"), transfer=self.bus_transfer(data))
+
+    def route_targets(self, room=None, to=None):
+        # ルーム宛てはその参加者、個別宛ては宛先の接続だけを索引から引く。どちらでもなければNone（全員宛て）
+        if room is not None:
+            return self.room_index.members(room)
+        if to is not None:
+            return self.room_index.connections(to)
+        return None
+
+    def fan_out(self, message, exclude_socket=None, room=None, to=None, transfer=None):
+        targets = self.route_targets(room, to)
+        if targets is None:
+            # ロックは宛先一覧のスナップショットを取る間だけ保持する
+            with self.clients_lock:
+                targets = list(self.clients.items())
+        shared = to is None and transfer is None and self.reaches_group(targets)
+        targets = [(sock, session) for sock, session in targets if sock != exclude_socket]
+        if transfer is not None:
+            targets = self.transfer_targets(targets, *transfer)
+
+        started = time.perf_counter()
+        self.enqueue_all(self.broadcast_frames(message, targets, shared))
+        self.fan_out_seconds.observe(time.perf_counter() - started)
+
+    def reaches_group(self, targets):
+        # グループ鍵は接続中のグループ鍵モードの全員が持っている。その全員が宛先に含まれるときだけ使い、
+        # 個別宛てや参加者の限られたルームは宛先でない人にも読めてしまうので接続ごとの鍵で暗号化する
+        if not self.group_keyring:
+            return False
+        keys = {key for key, _ in targets}
         with self.clients_lock:
-            for sock, (_, _, key) in self.clients.items():
-                if sock != exclude_socket:
+            return all(key in keys for key, session in self.clients.items() if session.group_mode)
+
+    def broadcast_frames(self, message, targets, shared=False):
+        # グループ鍵モードの宛先には、1回だけ暗号化した同じバッファを渡す
+        group_key = self.group_keyring.current if self.group_keyring and shared else None
+        group_frame = None
+        compressed = None
+        for key, session in targets:
+            if group_key and session.group_mode:
+                if group_frame is None:
+                    started = time.perf_counter()
+                    group_frame = group_key.encrypt_frame(message)
+                    self.encrypt_seconds.observe(time.perf_counter() - started)
+                if session.send_queue.dropped != session.group_key_drops:
+                    # drop_oldestで鍵配布フレームが捨てられた可能性があるので配り直す
+                    session.group_key_drops = session.send_queue.dropped
+                    yield key, session, group_key.wrap_frame(session.cipher)
+                yield key, session, group_frame
+            else:
+                started = time.perf_counter()
+                if session.compressor:
+                    # 圧縮に応じた宛先には、1回だけ圧縮したものをそれぞれの鍵で暗号化する
+                    if compressed is None:
+                        compressed = session.compressor.compress(message)
+                    frame = session.encrypt_payload(compressed)
+                else:
+                    frame = session.encrypt_frame(message)
+                self.encrypt_seconds.observe(time.perf_counter() - started)
+                yield key, session, frame
+
+    def group_key_frames(self, group_key, targets):
+        for key, session in targets:
+            if session.group_mode:
+                session.group_key_drops = session.send_queue.dropped
+                yield key, session, group_key.wrap_frame(session.cipher)
+
+    def register_client(self, client_socket, session):
+        if not self.group_keyring:
+            with self.clients_lock:
+                self.clients[client_socket] = session
+            self.room_index.add(client_socket, session)
+            return
+        # 追加した直後の配信は切り替え前の鍵で届くことがあるので、先に現在の鍵を渡しておく
+        with self.group_key_lock:
+            if self.group_keyring.current:
+                self.enqueue_all(self.group_key_frames(self.group_keyring.current, [(client_socket, session)]))
+            with self.clients_lock:
+                self.clients[client_socket] = session
+            self.room_index.add(client_socket, session)
+
+    def rotate_group_key(self):
+        if not self.group_keyring:
+            return
+        # 新しい鍵は全員の送信キューに配布を積み終えてから切り替える。先に切り替えると、
+        # 他のスレッドの配信が鍵の配布より先に新しい鍵のデータを積んでしまう
+        with self.group_key_lock:
+            with self.clients_lock:
+                targets = list(self.clients.items())
+            group_key = self.group_keyring.next_key()
+            self.enqueue_all(self.group_key_frames(group_key, targets))
+            self.group_keyring.activate(group_key)
+
+    def enqueue_all(self, frames):
+        disconnected_clients = []
+
+        for sock, session, frame in frames:
+            if sock in disconnected_clients:
+                continue
+            try:
+                session.send_queue.put(frame)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"ブロードキャスト中にエラーが発生 ({session.nickname}): {e}"))
+                disconnected_clients.append(sock)
+
+        for sock in disconnected_clients:
+            self.evict_client(sock)
+
+    async def perform_key_exchange_async(self, reader, writer):
+        try:
+            hello = self.server_hello()
+            await async_send_data(writer, hello)
+            client_data = await async_receive_data(reader, self.max_frame_size)
+
+            if not client_data or not all(k in client_data for k in ['pk', 'address', 'nickname']):
+                raise ValueError("無効なクライアントデータを受信しました")
+
+            client_pk = client_data['pk']
+            client_address = client_data['address']
+            client_nickname = client_data['nickname']
+            features = self.negotiate(client_data)
+
+            shared_key = self.resume_session(hello, client_data)
+            resumed = shared_key is not None
+            if not resumed:
+                shared_key = await self.handshake_pool.derive_async(client_pk)
+            result = self.handshake_result(client_data, shared_key, resumed)
+            if result:
+                await async_send_data(writer, result)
+            features["cipher"] = self.session_cipher(hello, client_data, shared_key)
+
+            return client_address, client_nickname, shared_key, features
+
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+            self.stderr.write(self.style.ERROR(f"キー交換中に接続が切断されました: {e}"))
+            raise
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"キー交換中にエラーが発生: {e}"))
+            raise
+
+    async def complete_handshake_async(self, reader, writer):
+        started = time.monotonic()
+        outcome = 'failed'
+        try:
+            result = await asyncio.wait_for(
+                self.perform_key_exchange_async(reader, writer), self.handshake_pool.timeout
+            )
+            outcome = 'completed'
+            return result
+        except (asyncio.TimeoutError, HandshakeTimeout):
+            outcome = 'timeout'
+            raise
+        finally:
+            self.handshake_pool.release(started, outcome)
+            if outcome == 'completed':
+                self.handshake_seconds.observe(time.monotonic() - started)
+
+    async def client_writer_async(self, writer, session):
+        try:
+            while True:
+                batch = await session.send_queue.get_batch(
+                    self.batch_max_messages, self.batch_max_bytes, self.batch_flush_delay
+                )
+                if batch is None:
+                    break
+                buffers = session.batch_buffers(batch)
+                writer.writelines(buffers)
+                self.record_send(len(batch), 1, frame_size(buffers))
+                await writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if self.running:
+                self.stderr.write(self.style.ERROR(f"{session.nickname} への送信中にエラーが発生: {e}"))
+            writer.close()
+
+    async def handle_client_async(self, reader, writer):
+        client_address = None
+        client_nickname = None
+
+        # スレッドエンジンと同じく、pingを送らない旧クライアントの消えた接続はTCPキープアライブで検出する
+        enable_keepalive(writer.get_extra_info('socket'), self.idle_timeout)
+        if not await self.handshake_pool.admit_async():
+            self.stderr.write(self.style.WARNING("ハンドシェイクの順番を待ちきれなかったため接続を拒否しました"))
+            writer.close()
+            return
+
+        try:
+            # キー交換
+            client_address, client_nickname, shared_key, features = await self.complete_handshake_async(reader, writer)
+            session = ClientSession(
+                client_address, client_nickname, shared_key,
+                AsyncSendQueue(self.send_queue_size, self.slow_consumer_policy, self.send_timeout),
+                **features
+            )
+            session.writer = asyncio.create_task(self.client_writer_async(writer, session))
+            snapshot = self.roster.snapshot()
+            await self.register_client_async(writer, session)
+            await self.rotate_group_key_async()
+
+            self.stdout.write(self.style.SUCCESS(f'新しいユーザーが接続しました: {client_nickname}'))
+
+            # 新規クライアントに既存ユーザーの情報を送信
+            for frame in self.roster_frames(session, snapshot):
+                await session.send_queue.put(frame)
+
+            # 他のクライアントへの通知は、短い間隔の変更をまとめて差分として配る
+            await self.publish_presence_async(self.user_update(session, ONLINE))
+
+            # 再接続したクライアントには切断中に流れたメッセージを、新しいクライアントには直近の履歴を送る。
+            # ログの読み出しはイベントループを止めないよう別スレッドで少しずつ行う。
+            # 書き込みと同じスレッドで読むので、参加前に積まれた書き込みを読み落とさない
+            records = self.replay_messages(session)
+            loop = asyncio.get_running_loop()
+            while True:
+                messages = await loop.run_in_executor(self.log_writer, take, records, REPLAY_CHUNK)
+                for message in messages:
+                    await session.send_queue.put_wait(session.encrypt_frame(message))
+                if len(messages) < REPLAY_CHUNK:
+                    break
+
+            # メッセージ受信ループ。読み取りに失敗したらフレームの境目を失うので切断する
+            receive_timeout = self.receive_timeout(session)
+            while self.running:
+                try:
+                    frame = await asyncio.wait_for(async_next_frame(reader, session.framing, self.max_frame_size), receive_timeout)
+                except asyncio.TimeoutError:
+                    self.stdout.write(self.style.WARNING(f"{client_nickname} から{self.idle_timeout:g}秒間応答が無いため切断します"))
+                    break
+                except OSError:
+                    break
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"{client_nickname} から不正なデータを受信したため切断します: {e}"))
+                    break
+                if not frame:
+                    break
+
+                frame_type, encrypted_message = frame
+                if frame_type == FRAME_PING:
+                    await session.send_queue.put(PONG_FRAME)
+                    continue
+                if frame_type == FRAME_CHUNK:
                     try:
-                        encrypted = aes_encrypt(message, key)
-                        send_data(sock, encrypted)
+                        await self.receive_chunk_async(writer, session, encrypted_message)
                     except Exception as e:
-                        self.stderr.write(self.style.ERROR(f"ブロードキャスト中にエラーが発生: {e}"))
-                        disconnected_clients.append(sock)
+                        self.stderr.write(self.style.ERROR(f"チャンクの中継中にエラーが発生: {e}"))
+                    continue
+                if frame_type != FRAME_DATA:
+                    continue
+
+                try:
+                    decrypted_message = self.decrypt_message(encrypted_message, session)
+
+                    try:
+                        for message, route in self.route_request(writer, session, decrypted_message):
+                            if route is None:
+                                await session.send_queue.put(session.encrypt_frame(message))
+                            else:
+                                await self.broadcast_message_async(message, **route)
+                    except ValueError as e:
+                        await session.send_queue.put(session.encrypt_frame(json.dumps(self.error_message(e))))
+                    # 受信済みデータが溜まっていてもreadexactlyは制御を返さないので、送信タスクに順番を譲る
+                    await asyncio.sleep(0)
+                except Exception as e:
+                    self.stderr.write(self.style.ERROR(f"メッセージ処理中にエラーが発生: {e}"))
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"クライアント処理中にエラーが発生: {e}"))
+        finally:
+            await self.cleanup_client_async(writer, client_address, client_nickname)
+
+    async def receive_chunk_async(self, writer, session, payload):
+        relayed = self.accept_chunk(writer, session, payload)
+        if relayed is None:
+            return
+        targets, plaintext, error = relayed
+        await self.enqueue_chunk_async(targets, plaintext)
+        await self.publish_chunk_async(plaintext)
+        if error:
+            await session.send_queue.put(session.encrypt_frame(json.dumps(self.error_message(error))))
+
+    async def enqueue_chunk_async(self, targets, plaintext):
+        # 宛先ごとの空き待ちは並行して行い、遅い宛先が他の宛先への中継を止めないようにする
+        pending = [(key, session) for key, session in targets if not session.send_queue.closed]
+        results = await asyncio.gather(
+            *(session.send_queue.put_wait(session.encrypt_chunk(plaintext), self.transfer_timeout, TRANSFER_QUEUE_FRAMES)
+              for _, session in pending),
+            return_exceptions=True
+        )
+        for (key, session), result in zip(pending, results):
+            if isinstance(result, SlowConsumerError) and not session.send_queue.closed:
+                try:
+                    session.send_queue.put_nowait(self.drop_chunk_target(targets, key, session, plaintext, result))
+                except SlowConsumerError:
+                    pass
+
+    def queue_bus_chunk_async(self, origin, targets, plaintext):
+        backlog = self.bus_chunk_backlogs.get(origin)
+        if backlog is None:
+            backlog = self.bus_chunk_backlogs[origin] = asyncio.Queue()
+            self.bus_chunk_tasks.append(asyncio.create_task(self.bus_chunk_loop_async(backlog)))
+        backlog.put_nowait((targets, self.backlog_chunk(origin, backlog.qsize(), plaintext)))
+
+    async def bus_chunk_loop_async(self, backlog):
+        while True:
+            targets, plaintext = await backlog.get()
+            await self.enqueue_chunk_async(targets, plaintext)
+
+    async def publish_chunk_async(self, plaintext):
+        if self.bus_writer:
+            try:
+                self.bus_writer.write(pack_data({"origin": self.worker_id, "chunk": plaintext}))
+                await self.bus_writer.drain()
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"ワーカー間バスへの送信中にエラーが発生: {e}"))
+
+    async def abort_transfers_async(self, writer):
+        for transfer_id, transfer in self.transfers.drop(writer):
+            plaintext = encode_chunk(transfer_id, transfer.next_index, CHUNK_ABORT)
+            await self.enqueue_all_async((key, session, session.encrypt_chunk(plaintext)) for key, session in transfer.targets)
+            await self.publish_chunk_async(plaintext)
+
+    async def cleanup_client_async(self, writer, client_address, client_nickname):
+        try:
+            session = self.clients.pop(writer, None)
+            if session:
+                self.room_index.remove(writer, session)
+                session.send_queue.close()
+                session.writer.cancel()
+                await self.abort_transfers_async(writer)
+                await self.rotate_group_key_async()
+            writer.close()
+
+            if client_nickname and client_address:
+                self.stdout.write(self.style.WARNING(f"{client_nickname} ({client_address}) が切断しました"))
+
+                ip, port = client_address.rsplit(':', 1)
+                current_time = datetime.now(ZoneInfo("Asia/Tokyo")).strftime('%Y/%m/%d %H:%M')
+
+                disconnect_message = {
+                    "type": "user_update",
+                    "username": client_nickname,
+                    "ip": ip,
+                    "port": port,
+                    "status": f"最終ログイン: {current_time}"
+                }
+
+                await self.publish_presence_async(disconnect_message)
+
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"クライアントのクリーンアップ中にエラーが発生: {e}"))
+
+    async def broadcast_message_async(self, message, exclude_writer=None, seq=None, room=None, to=None, transfer=None, body=None):
+        if body is None:
+            await self.fan_out_async(message, exclude_writer, room, to, transfer)
+        await self.publish_bus_async(message, seq=seq, room=room, to=to, transfer=transfer, body=body)
+
+    async def publish_bus_async(self, message, presence=False, seq=None, room=None, to=None, transfer=None, body=None):
+        if self.bus_writer:
+            try:
+                self.bus_writer.write(pack_data({
+                    "origin": self.worker_id, "message": message, "presence": presence, "seq": seq, "room": room, "to": to,
+                    "transfer": transfer and transfer[1:], "body": body
+                }))
+                await self.bus_writer.drain()
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"ワーカー間バスへの送信中にエラーが発生: {e}"))
+
+    async def listen_bus_async(self, reader):
+        while True:
+            data = await async_receive_data(reader)
+            if data is None:
+                break
+            if data.get("chunk") is not None:
+                relayed = self.relay_chunk(("bus", data["origin"]), data["chunk"])
+                if relayed:
+                    self.queue_bus_chunk_async(data["origin"], relayed[0], relayed[1])
+                continue
+            if data["presence"]:
+                self.roster.update(json.loads(data["message"]))
+                await self.presence_changed_async()
+                continue
+            if data.get("body") is not None:
+                message = self.sequenced_message(data["body"], data["seq"])
+                await self.fan_out_async(message, room=data.get("room"), to=data.get("to"))
+                continue
+            if data.get("seq") is not None:
+                self.record_history(data["message"], data["seq"])
+            await self.fan_out_async(
+                data["message"], room=data.get("room"), to=data.get("to"), transfer=self.bus_transfer(data)
+            )
+
+    async def publish_presence_async(self, update):
+        self.roster.update(update)
+        await self.publish_bus_async(json.dumps(update), presence=True)
+        await self.presence_changed_async()
+
+    async def presence_changed_async(self):
+        if self.presence_interval:
+            self.presence_event.set()
+        else:
+            await self.flush_presence_async()
+
+    async def presence_loop_async(self):
+        while True:
+            await self.presence_event.wait()
+            await asyncio.sleep(self.presence_interval)
+            self.presence_event.clear()
+            await self.flush_presence_async()
+
+    async def flush_presence_async(self):
+        delta = self.roster.drain()
+        if delta:
+            await self.enqueue_all_async(self.presence_frames(delta, list(self.clients.items())))
+
+    async def fan_out_async(self, message, exclude_writer=None, room=None, to=None, transfer=None):
+        targets = self.route_targets(room, to)
+        if targets is None:
+            targets = list(self.clients.items())
+        shared = to is None and transfer is None and self.reaches_group(targets)
+        targets = [(writer, session) for writer, session in targets if writer is not exclude_writer]
+        if transfer is not None:
+            targets = self.transfer_targets(targets, *transfer)
+        started = time.perf_counter()
+        await self.enqueue_all_async(self.broadcast_frames(message, targets, shared))
+        self.fan_out_seconds.observe(time.perf_counter() - started)
+
+    async def register_client_async(self, writer, session):
+        if not self.group_keyring:
+            self.clients[writer] = session
+            self.room_index.add(writer, session)
+            return
+        async with self.group_key_lock_async:
+            if self.group_keyring.current:
+                await self.enqueue_all_async(self.group_key_frames(self.group_keyring.current, [(writer, session)]))
+            self.clients[writer] = session
+            self.room_index.add(writer, session)
+
+    async def rotate_group_key_async(self):
+        if not self.group_keyring:
+            return
+        # 配布を積む途中で待つと他のタスクの配信が先に進むので、切り替えは積み終えてから行う
+        async with self.group_key_lock_async:
+            group_key = self.group_keyring.next_key()
+            await self.enqueue_all_async(self.group_key_frames(group_key, list(self.clients.items())))
+            self.group_keyring.activate(group_key)
+
+    async def enqueue_all_async(self, frames):
+        disconnected_clients = []
+        waiting = {}
+
+        for writer, session, frame in frames:
+            if writer in disconnected_clients:
+                continue
+            try:
+                # 一度待ちに入った宛先は、以降のフレームも順序を保って待ちに積む
+                if writer in waiting:
+                    waiting[writer][1].append(frame)
+                elif not session.send_queue.put_nowait(frame):
+                    waiting[writer] = (session, [frame])
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"ブロードキャスト中にエラーが発生 ({session.nickname}): {e}"))
+                disconnected_clients.append(writer)
+
+        # blockポリシーで満杯だった宛先だけを並行して待つ
+        if waiting:
+            results = await asyncio.gather(
+                *(self.put_frames_async(session, pending) for session, pending in waiting.values()),
+                return_exceptions=True
+            )
+            for (writer, (session, _)), result in zip(waiting.items(), results):
+                if isinstance(result, Exception):
+                    self.stderr.write(self.style.ERROR(f"ブロードキャスト中にエラーが発生 ({session.nickname}): {result}"))
+                    disconnected_clients.append(writer)
+
+        for writer in disconnected_clients:
+            writer.close()
+
+    async def put_frames_async(self, session, frames):
+        for frame in frames:
+            await session.send_queue.put(frame)
+
+    async def serve_async(self, bus_sock=None):
+        self.presence_event = asyncio.Event()
+        self.group_key_lock_async = asyncio.Lock()
+        if self.message_log is not None:
+            self.log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='message-log')
+        if self.presence_interval:
+            self.presence_task = asyncio.create_task(self.presence_loop_async())
+        if bus_sock:
+            # 接続を受け付ける前にバスへの書き込み口を用意し、最初のメッセージから連番をハブに振ってもらう
+            reader, self.bus_writer = await asyncio.open_unix_connection(sock=bus_sock)
+            self.bus_task = asyncio.create_task(self.listen_bus_async(reader))
+        self.async_server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        async with self.async_server:
+            await self.async_server.serve_forever()
+
+    def create_server_socket(self, host, port, backlog):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(backlog)
+        return server_socket
 
     def handle(self, *args, **options):
         self.setup_logging()
         host = getattr(settings, 'CHAT_SERVER_HOST', get_local_ip()) #好きなIP
         port = getattr(settings, 'CHAT_SERVER_PORT', 12345) #好きなPort
+        for name in POSITIVE_OPTIONS:
+            if options.get(name) is not None and options[name] <= 0:
+                raise CommandError(f"--{name.replace('_', '-')} には正の値を指定してください")
+        if (options.get('handshake_queue_timeout') or 0) < 0:
+            raise CommandError("--handshake-queue-timeout には0以上の値を指定してください")
+        engine = options.get('engine') or 'threaded'
+        workers = option(options, 'workers', 1)
+        backlog = option(options, 'backlog', 1024 if engine == 'asyncio' or workers > 1 else 5)
+        self.send_queue_size = option(options, 'send_queue_size', self.send_queue_size)
+        self.slow_consumer_policy = options.get('slow_consumer_policy') or self.slow_consumer_policy
+        self.send_timeout = option(options, 'send_timeout', self.send_timeout)
+        self.max_frame_size = option(options, 'max_frame_size', self.max_frame_size)
+        if options.get('compression') == 'none':
+            self.compressor = None
+        elif options.get('compression_threshold') is not None:
+            self.compressor.threshold = options['compression_threshold']
+        self.max_transfer_bytes = option(options, 'max_transfer_bytes', self.max_transfer_bytes)
+        self.transfer_timeout = option(options, 'transfer_timeout', self.transfer_timeout)
+        if options.get('group_key'):
+            self.group_keyring = GroupKeyring()
+        self.heartbeat_interval = option(options, 'heartbeat_interval', 0)
+        self.idle_timeout = option(options, 'idle_timeout', self.idle_timeout)
+        if (options.get('history_size') or 0) > 0:
+            self.history = MessageStore(options['history_size'])
+        if options.get('message_log'):
+            self.log_options = {
+                "directory": options['message_log'],
+                "segment_bytes": option(options, 'log_segment_bytes', 16 * 1024 * 1024),
+                "fsync": options.get('log_fsync') or 'interval',
+                "fsync_interval": option(options, 'log_fsync_interval', 1.0),
+                "max_segments": option(options, 'log_max_segments', 0)
+            }
+        self.max_replay = option(options, 'max_replay', self.max_replay)
+        self.presence_interval = option(options, 'presence_interval', self.presence_interval)
+        self.message_echo_rate = option(options, 'message_echo_rate', self.message_echo_rate)
+        self.stats_interval = option(options, 'stats_interval', 0)
+        if options.get('metrics_port'):
+            self.metrics_address = (options.get('metrics_host') or '127.0.0.1', options['metrics_port'])
+        if (options.get('ticket_ttl') or 0) > 0:
+            self.tickets = TicketCache(options['ticket_ttl'], option(options, 'max_tickets', 10000))
+        self.batch_max_messages = max(1, option(options, 'batch_max_messages', 1))
+        self.batch_max_bytes = option(options, 'batch_max_bytes', self.batch_max_bytes)
+        self.batch_flush_delay = option(options, 'batch_flush_delay_us', 0) / 1000000
+        self.handshake_pool = HandshakePool(
+            self.SERVER_SK,
+            size=option(options, 'handshake_pool_size', 0),
+            max_pending=option(options, 'max_pending_handshakes', 256),
+            timeout=option(options, 'handshake_timeout', 10.0),
+            queue_timeout=option(options, 'handshake_queue_timeout', 5.0)
+        )
 
+        # SIGTERMでもCtrl+Cと同じ後片付け（プールやワーカーの停止）を行う
+        signal.signal(signal.SIGTERM, self.raise_interrupt)
+
+        try:
+            self.server_socket = self.create_server_socket(host, port, backlog)
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"サーバーエラー: {e}"))
+            return
+
+        if workers > 1:
+            self.stdout.write(self.style.SUCCESS(f"サーバーが {host}:{port} で待機中 ({engine}, {workers} workers)"))
+            self.run_workers(engine, workers)
+        else:
+            self.stdout.write(self.style.SUCCESS(f"サーバーが {host}:{port} で待機中 ({engine})"))
+            self.run_engine(engine)
+
+    def open_message_log(self):
+        # ログはワーカーごとに持つ（どのワーカーもバス経由で全メッセージを受け取る）
+        if not self.log_options:
+            return
+        options = dict(self.log_options)
+        if self.worker_id is not None:
+            options["directory"] = os.path.join(options["directory"], f"worker-{self.worker_id}")
+        self.message_log = MessageLog(**options)
+        self.stdout.write(f"メッセージログ {options['directory']} を開きました ({len(self.message_log)} 件)")
+
+    def run_engine(self, engine, bus_sock=None):
+        try:
+            self.open_message_log()
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"メッセージログを開けませんでした: {e}"))
+            return
+        self.start_metrics()
+        if engine == 'asyncio':
+            self.run_asyncio(bus_sock)
+        else:
+            self.run_threaded(bus_sock)
+
+    def start_metrics(self):
+        # ワーカーはそれぞれ自分のポート（指定ポート + ワーカー番号）で自分の分だけを返す
+        if self.metrics_address:
+            host, port = self.metrics_address
+            port += self.worker_id or 0
+            try:
+                self.metrics_server = serve_metrics(self.metrics, host, port)
+                self.stdout.write(f"メトリクスを http://{host}:{port}/metrics で公開しています")
+            except OSError as e:
+                self.stderr.write(self.style.ERROR(f"メトリクスのポートを開けませんでした: {e}"))
+        if self.stats_interval:
+            threading.Thread(target=self.stats_loop, daemon=True).start()
+
+    def stats_sample(self):
+        return (
+            time.monotonic(), self.messages_received.value, self.frames_sent.value,
+            self.bytes_received.value, self.bytes_sent.value, self.fan_out_seconds.snapshot()[0],
+            self.compress_input.value, self.compress_output.value
+        )
+
+    def stats_loop(self):
+        # 前回からの差分で毎秒の量と、その間の配信時間の分位点を出す
+        previous = self.stats_sample()
+        while self.running:
+            time.sleep(self.stats_interval)
+            current = self.stats_sample()
+            elapsed = current[0] - previous[0]
+            messages, frames, bytes_in, bytes_out = (
+                (now - before) / elapsed for now, before in zip(current[1:5], previous[1:5])
+            )
+            fan_out = [now - before for now, before in zip(current[5], previous[5])]
+            compressed_in, compressed_out = (now - before for now, before in zip(current[6:8], previous[6:8]))
+            ratio = f", 圧縮率 {compressed_out / compressed_in:.0%}" if compressed_in else ""
+            _, max_depth = self.queue_depths()
+            prefix = f"[ワーカー {self.worker_id}] " if self.worker_id is not None else ""
+            self.stdout.write(
+                f"{prefix}統計: 接続 {len(self.clients)}, 受信 {messages:.1f} 件/秒, 送信 {frames:.1f} フレーム/秒, "
+                f"受信 {bytes_in / 1024:.1f} KiB/秒, 送信 {bytes_out / 1024:.1f} KiB/秒, "
+                f"配信 p50 {self.fan_out_seconds.quantile(0.5, fan_out) * 1000:.2f}ms "
+                f"p99 {self.fan_out_seconds.quantile(0.99, fan_out) * 1000:.2f}ms, 送信キュー最大 {max_depth}{ratio}"
+            )
+            previous = current
+
+    def run_threaded(self, bus_sock=None):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((host, port))
-            self.server_socket.listen(5)
-            self.stdout.write(self.style.SUCCESS(f"サーバーが {host}:{port} で待機中"))
+            self.handshake_pool.start()
+            if bus_sock:
+                self.bus = WorkerBus(bus_sock, self.worker_id)
+                self.bus.listen(self.on_bus_message)
+            if self.presence_interval:
+                threading.Thread(target=self.presence_loop, daemon=True).start()
 
             while self.running:
                 try:
                     client_socket, _ = self.server_socket.accept()
+                    enable_keepalive(client_socket, self.idle_timeout)
+                    # 受け入れの順番待ちは接続ごとのスレッドで行い、acceptを止めない
                     client_thread = threading.Thread(
                         target=self.handle_client,
                         args=(client_socket,),
@@ -206,11 +1709,103 @@ class Command(BaseCommand):
             self.running = False
             self.cleanup_server()
 
+    def run_asyncio(self, bus_sock=None):
+        try:
+            self.handshake_pool.start()
+            asyncio.run(self.serve_async(bus_sock))
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("シャットダウン中..."))
+        except Exception as e:
+            self.stderr.write(self.style.ERROR(f"サーバーエラー: {e}"))
+        finally:
+            self.running = False
+            self.cleanup_server()
+
+    def raise_interrupt(self, signum, frame):
+        # 後片付け中に届いた2回目以降のSIGTERMでは中断しない
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+
+    def run_workers(self, engine, workers):
+        # listenソケットをfork前に作成して全ワーカーで共有し、親プロセスはバスのハブになる
+        pids = []
+        hub_socks = []
+        for worker_id in range(workers):
+            hub_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            pid = os.fork()
+            if pid == 0:
+                hub_sock.close()
+                for sock in hub_socks:
+                    sock.close()
+                self.worker_id = worker_id
+                self.stdout.write(f"ワーカー {worker_id} (pid {os.getpid()}) を起動しました")
+                try:
+                    self.run_engine(engine, worker_sock)
+                finally:
+                    os._exit(0)
+            worker_sock.close()
+            hub_socks.append(hub_sock)
+            pids.append(pid)
+
+        hub = BusHub(hub_socks)
+        try:
+            hub.serve()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("シャットダウン中..."))
+        finally:
+            hub.stop()
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.server_socket.close()
+
     def cleanup_server(self):
         try:
+            self.handshake_pool.shutdown()
+            stats = self.handshake_pool.stats()
+            self.stdout.write(
+                f"ハンドシェイク統計: 完了 {stats['completed']} (キャッシュ {stats['cache_hits']}), "
+                f"順番待ち {stats['queued']}, 拒否 {stats['rejected']}, タイムアウト {stats['timed_out']}, 失敗 {stats['failed']}, "
+                f"平均 {stats['avg_ms']:.1f}ms, 最大 {stats['max_ms']:.1f}ms"
+            )
+            if self.tickets:
+                ticket_stats = self.tickets.stats()
+                self.stdout.write(
+                    f"セッション再開: 再開 {ticket_stats['resumed']}, 失効・不一致 {ticket_stats['missed']}, "
+                    f"発行 {ticket_stats['issued']}"
+                )
+            if self.send_calls.value:
+                self.stdout.write(
+                    f"送信統計: フレーム {self.frames_sent.value}, 書き込み {self.send_calls.value} "
+                    f"({self.frames_sent.value / self.send_calls.value:.2f} メッセージ/システムコール), "
+                    f"{self.bytes_sent.value} バイト"
+                )
+            if self.compress_input.value:
+                self.stdout.write(
+                    f"圧縮統計: {self.compress_input.value} バイト → {self.compress_output.value} バイト "
+                    f"({self.compress_output.value / self.compress_input.value:.1%})"
+                )
+            if self.metrics_server:
+                self.metrics_server.shutdown()
+                self.metrics_server.server_close()
+
+            if self.log_writer is not None:
+                # 積まれている書き込みを終えてからログを閉じる
+                self.log_writer.shutdown(wait=True)
+            if self.message_log is not None:
+                self.message_log.close()
+
             with self.clients_lock:
-                for sock in list(self.clients.keys()):
+                for sock, session in list(self.clients.items()):
                     try:
+                        session.send_queue.close()
                         sock.close()
                     except:
                         pass
@@ -223,6 +1818,6 @@ class Command(BaseCommand):
                     pass
                 finally:
                     self.server_socket.close()
-                    
+
         except Exception as e:
-            self.stderr.write(self.style.ERROR(f"サーバーのクリーンアップ中にエラーが発生: {e}"))
\ No newline at end of file
+            self.stderr.write(self.style.ERROR(f"サーバーのクリーンアップ中にエラーが発生: {e}"))
@@ -1,15 +1,26 @@
-from datetime import datetime
 import json
+import os
 import threading
+from .message_store import MessageStore
+from .presence import ONLINE
+from .rooms import DEFAULT_ROOM, valid_room
 
 class ChatManager:
-    def __init__(self, connection_manager):
+    def __init__(self, connection_manager, max_messages=10000):
         self.connection_manager = connection_manager
         self.message_callback = None
         self.peer_info_callback = None
+        self.room_callback = None
+        self.transfer_callback = None
+        # 通知を受け取り、チャンクが届き終わるのを待っている転送
+        self.transfers = {}
         self.peer_info = {}
-        self.messages = []
+        # 最後に反映した在席一覧の版数。これ以前の差分は読み飛ばす
+        self.roster_version = None
+        self.roster_requested = False
+        self.messages = MessageStore(max_messages)
         self.connection_manager.set_message_callback(self._internal_message_handler)
+        self.connection_manager.set_transfer_callback(self._internal_transfer_handler)
         self.message_lock = threading.Lock()
 
     def set_message_callback(self, callback):
@@ -18,12 +29,92 @@ class ChatManager:
     def set_peer_info_callback(self, callback):
         self.peer_info_callback = callback
 
+    def set_room_callback(self, callback):
+        self.room_callback = callback
+
+    def set_transfer_callback(self, callback):
+        # 届いたファイルを (転送の通知, ファイル) で、中断されたものを (転送の通知, None) で受け取る。ファイルは呼び出し側で閉じる
+        self.transfer_callback = callback
+
     def update_peer_info(self, nickname, ip, port, status):
         self.peer_info[nickname] = {"ip": ip, "port": port, "status": status}
         if self.peer_info_callback:
             self.peer_info_callback(self.peer_info)
 
-    def send_message(self, message):
+    def is_self(self, update):
+        address = self.connection_manager.client_address
+        return bool(address) and update["username"] == self.connection_manager.nickname and str(update["port"]) == str(address[1])
+
+    def apply_roster(self, roster):
+        # 最終ログインを表示している相手は残し、在席中の相手を一覧で置き換える。版数はサーバーの再起動で戻り得るので上書きする
+        self.peer_info = {nickname: info for nickname, info in self.peer_info.items() if info["status"] != ONLINE}
+        for user in roster["users"]:
+            if not self.is_self(user):
+                self.peer_info[user["username"]] = {"ip": user["ip"], "port": user["port"], "status": user["status"]}
+        self.roster_version = roster["version"]
+        self.roster_requested = False
+        if self.peer_info_callback:
+            self.peer_info_callback(self.peer_info)
+
+    def apply_presence(self, delta):
+        if self.roster_version is not None and delta["version"] <= self.roster_version:
+            return
+        if self.roster_version is None or delta["base"] > self.roster_version:
+            # 途中の差分を取りこぼしたので一覧を取り直す（届くまでは要求し直さない）
+            if not self.roster_requested:
+                self.roster_requested = True
+                self.send_request(json.dumps({"type": "roster"}))
+            return
+        for update in delta["updates"]:
+            if not self.is_self(update):
+                self.peer_info[update["username"]] = {"ip": update["ip"], "port": update["port"], "status": update["status"]}
+        self.roster_version = delta["version"]
+        if self.peer_info_callback:
+            self.peer_info_callback(self.peer_info)
+
+    def send_message(self, message, room=None):
+        if self.connection_manager.rooms_enabled:
+            message = json.dumps({"type": "message", "room": room or DEFAULT_ROOM, "content": message})
+        elif room not in (None, DEFAULT_ROOM):
+            raise Exception("サーバーがルームに対応していません")
+        self.send_request(message)
+
+    def send_direct(self, nickname, message):
+        self.require_rooms()
+        self.send_request(json.dumps({"type": "direct", "to": nickname, "content": message}))
+
+    def join_room(self, room):
+        self.require_rooms()
+        if not valid_room(room):
+            raise Exception("ルーム名が不正です")
+        self.connection_manager.rooms.add(room)
+        self.send_request(json.dumps({"type": "join", "room": room}))
+
+    def leave_room(self, room):
+        self.require_rooms()
+        self.connection_manager.rooms.discard(room)
+        self.send_request(json.dumps({"type": "leave", "room": room}))
+
+    def send_file(self, path, room=None, to=None):
+        # ファイルを分割転送で送る。toを指定すればその相手だけに、それ以外はルームの参加者に届く
+        self.require_rooms()
+        request = {"name": os.path.basename(path)}
+        if to is not None:
+            request["to"] = to
+        else:
+            request["room"] = room or DEFAULT_ROOM
+        try:
+            with open(path, 'rb') as f:
+                return self.connection_manager.send_transfer(f, os.fstat(f.fileno()).st_size, request)
+        except Exception as e:
+            print(f"ファイル送信中にエラーが発生: {str(e)}")
+            raise
+
+    def require_rooms(self):
+        if not self.connection_manager.rooms_enabled:
+            raise Exception("サーバーがルームに対応していません")
+
+    def send_request(self, message):
         try:
             self.connection_manager.send_message(message)
         except Exception as e:
@@ -43,25 +134,49 @@ class ChatManager:
                     )
                     return
                 elif decoded_message.get("type") == "message":
-                    self.add_message(message)
+                    if isinstance(decoded_message.get("seq"), int):
+                        self.connection_manager.note_seq(decoded_message["seq"])
+                    self.add_message(message, decoded_message)
+                    return
+                elif decoded_message.get("type") == "roster":
+                    self.apply_roster(decoded_message)
+                    return
+                elif decoded_message.get("type") == "presence":
+                    self.apply_presence(decoded_message)
+                    return
+                elif decoded_message.get("type") == "room_update":
+                    if self.room_callback:
+                        self.room_callback(decoded_message)
+                    return
+                elif decoded_message.get("type") == "transfer":
+                    self.transfers[decoded_message["id"]] = decoded_message
+                    return
+                elif decoded_message.get("type") == "error":
+                    print(f"サーバーからのエラー: {decoded_message.get('content')}")
                     return
             except json.JSONDecodeError:
                 pass
         except Exception as e:
             print(f"メッセージ処理中にエラーが発生: {str(e)}")
 
+    def _internal_transfer_handler(self, transfer_id, fileobj):
+        transfer = self.transfers.pop(transfer_id, {"type": "transfer", "id": transfer_id})
+        if self.transfer_callback:
+            self.transfer_callback(transfer, fileobj)
+        elif fileobj:
+            fileobj.close()
+
     def _clean_message(self, message):
         parts = message.split(':\n')
         if len(parts) > 1:
             return parts[0] + ': ' + parts[-1].strip()
         return message
 
-    def add_message(self, message):
+    def add_message(self, message, decoded_message=None):
         with self.message_lock:
-            if message not in self.messages:
-                self.messages.append(message)
-                if self.message_callback:
-                    self.message_callback(message)
+            record = self.messages.add(message, decoded_message)
+            if record and self.message_callback:
+                self.message_callback(message)
 
     def disconnect(self):
         try:
@@ -69,23 +184,20 @@ class ChatManager:
         except Exception as e:
             print(f"切断中にエラーが発生: {str(e)}")
 
+    @property
+    def last_seq(self):
+        return self.messages.last_seq
+
+    def get_messages_after(self, seq, limit=None):
+        with self.message_lock:
+            records = self.messages.after_seq(seq, limit)
+            cursor = records[-1].seq if records else seq
+            return [record.raw for record in records], cursor
+
     def get_messages(self, limit=None, since_timestamp=None):
         with self.message_lock:
             if since_timestamp:
-                filtered_messages = [msg for msg in self.messages if self._get_timestamp(msg) > since_timestamp]
+                records = self.messages.since(since_timestamp, limit)
             else:
-                filtered_messages = self.messages.copy()
-
-            if limit:
-                return filtered_messages[-limit:]
-            return filtered_messages
-
-    def _get_timestamp(self, message):
-        try:
-            parts = message.split(' - ')
-            if len(parts) >= 2:
-                timestamp_str = parts[1].split(':')[0] + ':' + parts[1].split(':')[1]
-                return datetime.strptime(timestamp_str, "%H:%M:%S %d/%m/%Y")
-        except:
-            pass
-        return datetime.min
\ No newline at end of file
+                records = self.messages.tail(0, limit)
+            return [record.raw for record in records]
\ No newline at end of file
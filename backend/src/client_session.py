@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import threading
+import time
+
+from .rooms import DEFAULT_ROOM, initial_rooms
+from .session_cipher import LegacyCipher
+from .utils import FRAME_CHUNK, FRAMING_LEGACY, encode_batch, encode_frame, frame_size
+
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect', 'block')
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+# スレッドエンジン用の送信キュー。満杯時の挙動はpolicyで決まる
+class SendQueue:
+    def __init__(self, maxsize, policy='drop_oldest', timeout=1.0):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"不明なポリシーです: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.frames = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        with self.cond:
+            if self.closed:
+                raise SlowConsumerError("送信キューは既に閉じられています")
+            if len(self.frames) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    self.frames.popleft()
+                    self.dropped += 1
+                elif self.policy == 'disconnect':
+                    raise SlowConsumerError("送信キューが満杯です")
+                elif not self.cond.wait_for(
+                    lambda: self.closed or len(self.frames) < self.maxsize, self.timeout
+                ) or self.closed:
+                    raise SlowConsumerError("送信キューの空き待ちがタイムアウトしました")
+            self.frames.append(frame)
+            self.cond.notify_all()
+
+    def put_wait(self, frame, timeout=None, limit=None):
+        # 履歴の送り直しと分割転送用。ポリシーにかかわらず、空きが出るまで待ってから積む。
+        # limitを指定すると、キューがその長さを下回るまで待つ
+        limit = min(limit or self.maxsize, self.maxsize)
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.closed or len(self.frames) < limit, timeout):
+                raise SlowConsumerError("送信キューの空き待ちがタイムアウトしました")
+            if self.closed:
+                raise SlowConsumerError("送信キューは既に閉じられています")
+            self.frames.append(frame)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed)
+            if not self.frames:
+                return None
+            frame = self.frames.popleft()
+            self.cond.notify_all()
+            return frame
+
+    def get_batch(self, max_frames, max_bytes, delay=0.0):
+        # 溜まっているフレームをまとめて取り出す。delay秒までは上限に達するのを待つ
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.closed)
+            batch = []
+            size = 0
+            deadline = None
+            while True:
+                while self.frames and len(batch) < max_frames and size < max_bytes:
+                    frame = self.frames.popleft()
+                    batch.append(frame)
+                    size += frame_size(frame)
+                if self.closed or len(batch) >= max_frames or size >= max_bytes or delay <= 0:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + delay
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            self.cond.notify_all()
+            return batch or None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.cond.notify_all()
+
+
+# asyncioエンジン用の送信キュー。イベントループのスレッドからのみ操作する
+class AsyncSendQueue:
+    def __init__(self, maxsize, policy='drop_oldest', timeout=1.0):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"不明なポリシーです: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        self.frames = collections.deque()
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put_nowait(self, frame):
+        # blockポリシーで満杯のときだけFalseを返し、呼び出し側にput()での待機を任せる
+        if self.closed:
+            raise SlowConsumerError("送信キューは既に閉じられています")
+        if len(self.frames) >= self.maxsize:
+            if self.policy == 'drop_oldest':
+                self.frames.popleft()
+                self.dropped += 1
+            elif self.policy == 'disconnect':
+                raise SlowConsumerError("送信キューが満杯です")
+            else:
+                self.not_full.clear()
+                return False
+        self.frames.append(frame)
+        self.not_empty.set()
+        return True
+
+    async def put(self, frame):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while not self.put_nowait(frame):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise SlowConsumerError("送信キューの空き待ちがタイムアウトしました")
+            try:
+                await asyncio.wait_for(self.not_full.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise SlowConsumerError("送信キューの空き待ちがタイムアウトしました")
+
+    async def put_wait(self, frame, timeout=None, limit=None):
+        limit = min(limit or self.maxsize, self.maxsize)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self.closed and len(self.frames) >= limit:
+            self.not_full.clear()
+            if deadline is None:
+                await self.not_full.wait()
+                continue
+            try:
+                await asyncio.wait_for(self.not_full.wait(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                raise SlowConsumerError("送信キューの空き待ちがタイムアウトしました")
+        if self.closed:
+            raise SlowConsumerError("送信キューは既に閉じられています")
+        self.frames.append(frame)
+        self.not_empty.set()
+
+    async def get(self):
+        while not self.frames and not self.closed:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        if not self.frames:
+            return None
+        frame = self.frames.popleft()
+        self.not_full.set()
+        return frame
+
+    async def get_batch(self, max_frames, max_bytes, delay=0.0):
+        frame = await self.get()
+        if frame is None:
+            return None
+        batch = [frame]
+        size = frame_size(frame)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        while len(batch) < max_frames and size < max_bytes:
+            if not self.frames:
+                remaining = deadline - loop.time()
+                if self.closed or remaining <= 0:
+                    break
+                self.not_empty.clear()
+                try:
+                    await asyncio.wait_for(self.not_empty.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                continue
+            frame = self.frames.popleft()
+            batch.append(frame)
+            size += frame_size(frame)
+        self.not_full.set()
+        return batch
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.not_empty.set()
+        self.not_full.set()
+
+
+class ClientSession:
+    def __init__(self, address, nickname, shared_key, send_queue, framing=FRAMING_LEGACY, group_mode=False, batch_mode=False, heartbeat=False, replay_since=None, replay_last=None, rooms=None, roster_mode=False, transfer_mode=False, cipher=None, compressor=None):
+        self.address = address
+        self.nickname = nickname
+        self.shared_key = shared_key
+        # AES-GCMに対応していないクライアントは従来の暗号のまま
+        self.cipher = cipher or LegacyCipher(shared_key)
+        # 圧縮に応じたクライアントだけ、暗号化の前に圧縮する
+        self.compressor = compressor
+        self.send_queue = send_queue
+        self.framing = framing
+        self.group_mode = group_mode
+        self.group_key_drops = 0
+        self.batch_mode = batch_mode
+        self.heartbeat = heartbeat
+        self.replay_since = replay_since
+        self.replay_last = replay_last
+        # ルームに対応していないクライアントは既定ルームだけに参加する
+        self.rooms_mode = rooms is not None
+        self.rooms = initial_rooms(rooms) if self.rooms_mode else {DEFAULT_ROOM}
+        self.roster_mode = roster_mode
+        self.transfer_mode = transfer_mode
+        self.writer = None
+
+    def batch_buffers(self, batch):
+        # バッチ対応クライアントには1フレームに包み、それ以外は連結して1回で書き込む
+        if self.batch_mode and len(batch) > 1:
+            return encode_batch(batch)
+        return [buffer for frame in batch for buffer in frame]
+
+    def encrypt_frame(self, message):
+        # 送信キューに積むのはsendmsgにそのまま渡せるバッファのリスト
+        if self.compressor:
+            message = self.compressor.compress(message)
+        return self.encrypt_payload(message)
+
+    def encrypt_payload(self, payload):
+        # 圧縮済み（または圧縮しない接続向け）の平文を暗号化する
+        return encode_frame(self.cipher.encrypt(payload), self.framing)
+
+    def encrypt_chunk(self, chunk):
+        # 分割転送のチャンク。宛先ごとの暗号で暗号化し直す
+        return encode_frame(self.cipher.encrypt(chunk), self.framing, FRAME_CHUNK)
+
+    @property
+    def ip(self):
+        return self.address.rsplit(':', 1)[0]
+
+    @property
+    def port(self):
+        return self.address.rsplit(':', 1)[1]
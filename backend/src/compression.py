@@ -0,0 +1,105 @@
+import json
+import time
+import zlib
+
+from .presence import ONLINE
+from .rooms import DEFAULT_ROOM
+
+# 辞書を変えたら識別子も変える。ハンドシェイクで同じ識別子を選んだ相手とだけ圧縮する
+COMPRESSION_ID = 'zlib-envelope-1'
+# これより短い本文は圧縮しない（ヘッダの分だけ大きくなりやすく、CPUも無駄になる）
+COMPRESSION_THRESHOLD = 64
+# 短い封筒では6とほぼ同じ圧縮率で、大きな本文では2倍ほど速い
+COMPRESSION_LEVEL = 3
+# メッセージは1件ずつ独立に圧縮するので、窓は辞書が収まる4KiBで足りる。大きい窓は圧縮器の初期化が重い
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+# 暗号化する平文の先頭1バイト
+RAW = b'\x00'
+DEFLATE = b'\x01'
+
+
+def envelope_dictionary():
+    # サーバーが送る封筒のJSON。zlibは辞書の末尾に近いほど短い距離で参照できるので、頻度の高いものほど後ろに置く
+    samples = [
+        {"type": "transfer", "id": "", "name": "", "size": 0, "username": "", "ip": "", "port": "", "room": DEFAULT_ROOM},
+        {"type": "error", "content": ""},
+        {"type": "roster", "version": 0, "users": []},
+        {"type": "presence", "version": 0, "updates": []},
+        {"type": "room_update", "room": DEFAULT_ROOM, "username": "", "ip": "", "port": "", "status": "join"},
+        {"type": "user_update", "username": "", "ip": "", "port": "", "status": "最終ログイン: 2026/"},
+        {"type": "user_update", "username": "", "ip": "192.168.", "port": "", "status": ONLINE},
+        {"type": "direct", "to": "", "content": ""},
+        {"type": "message", "room": DEFAULT_ROOM, "content": ""},
+        {"type": "message", "username": "", "ip": "192.168.", "port": "", "content": "", "to": "", "seq": 1700000000000000},
+        {"type": "message", "username": "", "ip": "127.0.0.1", "port": "", "content": "", "room": DEFAULT_ROOM, "seq": 1700000000000000},
+    ]
+    return "".join(json.dumps(sample) for sample in samples).encode('utf-8')
+
+
+PRESET_DICTIONARY = envelope_dictionary()
+
+
+# 暗号化の前に平文を圧縮し、復号の後に展開する。メッセージごとに独立しているので、
+# 宛先ごとの暗号化やバッチ、送信キューからの取りこぼしに影響されない
+class PayloadCompressor:
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL, dictionary=PRESET_DICTIONARY):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        # メトリクスはサーバーだけが設定する
+        self.compress_seconds = None
+        self.decompress_seconds = None
+        self.input_bytes = None
+        self.output_bytes = None
+        self.skipped = None
+
+    def set_metrics(self, compress_seconds, decompress_seconds, input_bytes, output_bytes, skipped):
+        self.compress_seconds = compress_seconds
+        self.decompress_seconds = decompress_seconds
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.skipped = skipped
+
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        payload = None
+        if len(data) >= self.threshold:
+            started = time.perf_counter()
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zdict=self.dictionary)
+            compressed = compressor.compress(data) + compressor.flush()
+            if self.compress_seconds:
+                self.compress_seconds.observe(time.perf_counter() - started)
+            # 縮まなかったもの（暗号文や圧縮済みのデータなど）はそのまま送る
+            if len(compressed) < len(data):
+                payload = DEFLATE + compressed
+        if payload is None:
+            payload = RAW + data
+            if self.skipped:
+                self.skipped.inc()
+        if self.input_bytes:
+            self.input_bytes.inc(len(data))
+            self.output_bytes.inc(len(payload))
+        return payload
+
+    def decompress(self, payload, max_size):
+        # 展開後の大きさはmax_sizeまでに制限し、小さなフレームから巨大なデータを展開させない
+        marker = payload[:1]
+        if marker == RAW:
+            return bytes(payload[1:])
+        if marker != DEFLATE:
+            raise ValueError("不明な圧縮形式です")
+        started = time.perf_counter()
+        decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=self.dictionary)
+        try:
+            data = decompressor.decompress(payload[1:], max_size)
+        except zlib.error as e:
+            raise ValueError(f"圧縮データを展開できません: {e}")
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"展開後のデータが大きすぎます ({max_size} バイトまで)")
+        if not decompressor.eof:
+            raise ValueError("圧縮データが途中で切れています")
+        if self.decompress_seconds:
+            self.decompress_seconds.observe(time.perf_counter() - started)
+        return data
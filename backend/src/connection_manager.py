@@ -1,8 +1,25 @@
+import collections
+import json
+import random
 import socket
 import threading
-import os
-import json
-from .utils import generate_keys, generate_shared_key, send_data, receive_data, get_local_ip, aes_encrypt, aes_decrypt
+import time
+from .utils import generate_shared_key, send_data, receive_data, send_frame, get_local_ip, FrameReader, FRAMING_LEGACY, FRAMING_BINARY, SUPPORTED_FRAMINGS, FRAME_GROUP_KEY, FRAME_GROUP_DATA, FRAME_BATCH, FRAME_PING, FRAME_PONG, FRAME_CHUNK, DEFAULT_MAX_FRAME, encode_frame, send_buffers, iter_batch
+from .compression import COMPRESSION_ID, PayloadCompressor
+from .group_key import GroupKeyStore
+from .key_store import key_store
+from .resumption import new_nonce, resumed_key, resumption_secret
+from .rooms import DEFAULT_ROOM
+from .session_cipher import SALT_SIZE, LegacyCipher, SessionCipher, new_salt
+from .transfers import CHUNK_ABORT, CHUNK_LAST, CHUNK_OVERHEAD, CHUNK_SIZE, IncomingTransfer, chunk_size_for, decode_chunk, encode_chunk, new_transfer_id
+
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+OUTBOX_SIZE = 100
+# この回数分のハートビート間隔に何も受信しなければ、サーバーが落ちたとみなす
+HEARTBEAT_MISSES = 3
+# 初めて接続したときにサーバーへ送ってもらう直近のメッセージ数
+JOIN_HISTORY = 100
 
 class ConnectionManager:
     def __init__(self):
@@ -11,6 +28,9 @@ class ConnectionManager:
         self.client_pk = None
         self.server_socket = None
         self.shared_key = None
+        self.cipher = None
+        # サーバーと同じ辞書で圧縮できるときだけ、暗号化の前に圧縮する
+        self.compressor = None
         self.client_address = None
         self.server_ip = None
         self.server_port = None
@@ -22,6 +42,34 @@ class ConnectionManager:
             'server_port': None
         }
         self.last_error = None
+        self.framing = FRAMING_LEGACY
+        self.frame_reader = None
+        self.group_keys = None
+        self.heartbeat_interval = None
+        # サーバーは受信が途絶えた接続を切断するので、最後に送った時刻から数えてpingを送る
+        self.last_sent = 0.0
+        # (接続先, チケット, 再開用の秘密)。同じ接続先・同じIDへの再接続でだけ使う
+        self.resumption = None
+        self.resumed = False
+        # 切断を検知したら自動で再接続し、その間の送信はoutboxに溜めて再接続後に送る
+        self.auto_reconnect = True
+        self.reconnecting = False
+        self.closing = threading.Event()
+        self.outbox = collections.deque()
+        self.send_lock = threading.Lock()
+        # 最後に受け取ったメッセージの連番。再接続時に伝えて、切断中の分を送り直してもらう
+        self.last_seq = None
+        self.join_history = JOIN_HISTORY
+        # 参加中のルーム。再接続時にもハンドシェイクで伝えて参加し直す
+        self.rooms = {DEFAULT_ROOM}
+        self.rooms_enabled = False
+        # 分割転送。サーバーが受け付けるフレームの上限に収まる大きさのチャンクで送る
+        self.transfer_enabled = False
+        self.max_frame = None
+        self.chunk_size = CHUNK_SIZE
+        # 受信中の転送。受信スレッドだけが触る
+        self.incoming = {}
+        self.transfer_callback = None
 
     def set_peer_info(self, nickname, ip, port, status):
         self.peer_info = {
@@ -36,6 +84,10 @@ class ConnectionManager:
         if self.is_connected and self.server_socket:
             self.start_receive_messages()
 
+    def set_transfer_callback(self, callback):
+        # 転送が届き終わったら (転送ID, 先頭に戻したファイル) で、中断されたら (転送ID, None) で呼ぶ。ファイルは呼び出し側で閉じる
+        self.transfer_callback = callback
+
     def start_receive_messages(self):
         if self.receive_thread is None or not self.receive_thread.is_alive():
             self.receive_thread = threading.Thread(target=self.receive_messages)
@@ -50,36 +102,26 @@ class ConnectionManager:
     def get_or_generate_keys(self, nickname, secret_key):
         try:
             self.nickname = nickname
-            key_storage_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'key_storage')
-            pk_file = os.path.join(key_storage_dir, f"{nickname}.pk.json")
-            sk_file = os.path.join(key_storage_dir, f"{nickname}.sk.json")
-            
-            os.makedirs(key_storage_dir, exist_ok=True)
-            
-            if os.path.exists(pk_file) and os.path.exists(sk_file):
-                with open(pk_file, 'r') as f:
-                    self.client_pk = json.load(f)
-                with open(sk_file, 'r') as f:
-                    self.client_sk = json.load(f)
-            else:
-                self.client_sk, self.client_pk = generate_keys(secret_key)
-                
-                with open(pk_file, 'w') as f:
-                    json.dump(self.client_pk, f)
-                with open(sk_file, 'w') as f:
-                    json.dump(self.client_sk, f)
-                    
+            keypair = key_store.load_or_create(nickname, secret_key)
+            self.client_sk = keypair.private_key
+            self.client_pk = keypair.public_key
             return self.client_pk
         except Exception as e:
             self.last_error = f"鍵の生成/読み込み中にエラーが発生: {str(e)}"
             raise Exception(self.last_error)
     
     def connect_to_server(self, server_ip, server_port):
+        self.closing.clear()
+        return self.open_connection(server_ip, server_port)
+
+    def open_connection(self, server_ip, server_port):
         self.connection_state['server_ip'] = server_ip
         self.connection_state['server_port'] = server_port
         self.is_connected = False
 
         try:
+            if self.frame_reader:
+                self.frame_reader.close()
             if self.server_socket:
                 try:
                     self.server_socket.close()
@@ -87,6 +129,9 @@ class ConnectionManager:
                     pass
                 self.server_socket = None
                 
+            # 前の接続で受信途中だった転送の続きは届かない
+            self.discard_incoming()
+
             self.server_ip = server_ip
             self.server_port = int(server_port)
             client_ip = get_local_ip()
@@ -96,6 +141,8 @@ class ConnectionManager:
 
             self.client_address = (client_ip, self.server_socket.getsockname()[1])
             client_address = self.perform_key_exchange(f"{self.client_address[0]}:{self.client_address[1]}")
+            # 以降の待機はwait_readableで行う。フレームの途中で止まった場合だけタイムアウトで切断とみなす
+            self.server_socket.settimeout(self.idle_timeout())
             self.is_connected = True
             
             if hasattr(self, 'message_callback'):
@@ -123,60 +170,327 @@ class ConnectionManager:
                 raise Exception("サーバーから無効なデータを受信しました")
             
             server_pk = server_data['pk']
-            
-            send_data(self.server_socket, {
+
+            # サーバーが対応していればバイナリフレームを使う。旧サーバーはframingを送ってこない
+            offered = [f for f in server_data.get('framing', []) if f in SUPPORTED_FRAMINGS]
+            self.framing = max(offered) if offered else FRAMING_LEGACY
+
+            hello = {
                 "pk": self.client_pk,
                 "address": client_address,
                 "nickname": self.nickname
-            })
-        
-            self.shared_key = generate_shared_key(self.client_sk, server_pk)
+            }
+            if self.framing != FRAMING_LEGACY:
+                hello["framing"] = self.framing
+            # サーバーが塩を送ってくればAES-GCMに切り替える。旧サーバーとは従来の暗号で通信する
+            server_salt = server_data.get('aead')
+            client_salt = None
+            if isinstance(server_salt, bytes) and len(server_salt) == SALT_SIZE:
+                client_salt = new_salt()
+                hello["aead"] = client_salt
+            # グループ鍵モードはバイナリフレームの種別で鍵と本文を区別し、本文はAES-GCMで届くので、その場合だけ応じる
+            self.group_keys = None
+            if self.framing == FRAMING_BINARY and server_data.get('group_key') and client_salt:
+                hello["group_key"] = True
+                self.group_keys = GroupKeyStore()
+            if self.framing == FRAMING_BINARY and server_data.get('batch'):
+                hello["batch"] = True
+            # 分割転送もチャンク専用のフレーム種別を使い、AES-GCMで暗号化するので、その場合だけ応じる
+            self.max_frame = server_data.get('max_frame')
+            self.transfer_enabled = bool(self.framing == FRAMING_BINARY and server_data.get('transfer') and client_salt)
+            if self.transfer_enabled:
+                hello["transfer"] = True
+                self.chunk_size = chunk_size_for(self.max_frame)
+            if self.last_seq is not None:
+                hello["since"] = self.last_seq
+            elif self.join_history and server_data.get('history'):
+                hello["history"] = self.join_history
+            self.rooms_enabled = bool(server_data.get('rooms'))
+            if self.rooms_enabled:
+                hello["rooms"] = sorted(self.rooms)
+                # 在席一覧をまとめて受け取る。要求はルーム対応と同じJSON形式で送る
+                if server_data.get('roster'):
+                    hello["roster"] = True
+            self.compressor = None
+            if COMPRESSION_ID in (server_data.get('compression') or ()):
+                hello["compression"] = COMPRESSION_ID
+                self.compressor = PayloadCompressor()
+            self.heartbeat_interval = None
+            if self.framing == FRAMING_BINARY and server_data.get('heartbeat'):
+                hello["heartbeat"] = True
+                self.heartbeat_interval = server_data['heartbeat']
+
+            # 前回のチケットがあれば提示する。受け入れられなかった場合に備えて公開鍵も送っておく
+            endpoint = (self.server_ip, self.server_port, self.nickname, tuple(self.client_pk))
+            resumption = self.resumption if self.resumption and self.resumption[0] == endpoint else None
+            self.resumption = None
+            if server_data.get('resume'):
+                hello["resume"] = True
+                if resumption:
+                    hello["ticket"] = resumption[1]
+                    hello["nonce"] = new_nonce()
+            send_data(self.server_socket, hello)
+
+            self.resumed = False
+            if hello.get("resume"):
+                result = receive_data(self.server_socket)
+                if not result or 'ticket' not in result:
+                    raise Exception("サーバーから無効なハンドシェイク結果を受信しました")
+                if result.get('resumed') and resumption:
+                    self.shared_key = resumed_key(resumption[2], server_data['nonce'], hello['nonce'])
+                    self.resumed = True
+                else:
+                    self.shared_key = generate_shared_key(self.client_sk, server_pk)
+                self.resumption = (endpoint, result['ticket'], resumption_secret(self.shared_key, result['ticket']))
+            else:
+                self.shared_key = generate_shared_key(self.client_sk, server_pk)
+
+            if client_salt:
+                self.cipher = SessionCipher(self.shared_key, server_salt, client_salt, False)
+            else:
+                self.cipher = LegacyCipher(self.shared_key)
+            self.frame_reader = FrameReader(self.server_socket, self.framing)
+            self.last_sent = time.monotonic()
             return client_address
             
         except Exception as e:
             self.last_error = f"鍵交換に失敗: {str(e)}"
             raise Exception(self.last_error)
 
+    def idle_timeout(self):
+        return self.heartbeat_interval * HEARTBEAT_MISSES if self.heartbeat_interval else None
+
+    def send_ping(self):
+        with self.send_lock:
+            send_buffers(self.server_socket, encode_frame(b'', self.framing, FRAME_PING))
+            self.last_sent = time.monotonic()
+
+    def note_seq(self, seq):
+        if self.last_seq is None or seq > self.last_seq:
+            self.last_seq = seq
+
     def send_message(self, message):
-        if not self.is_connected or not self.server_socket or not self.shared_key:
+        with self.send_lock:
+            if self.reconnecting:
+                self.buffer_message(message)
+                return
+            if not self.is_connected or not self.server_socket or not self.shared_key:
+                raise Exception("サーバーに接続されていません")
+            self.check_message_size(message)
+
+            try:
+                self.send_now(message)
+            except Exception as e:
+                self.is_connected = False
+                self.last_error = f"メッセージ送信エラー: {str(e)}"
+                if self.auto_reconnect and hasattr(self, 'message_callback'):
+                    # 受信スレッドに切断を気付かせて再接続させ、このメッセージは再接続後に送る
+                    self.buffer_message(message)
+                    self.shutdown_socket()
+                    return
+                raise Exception(self.last_error)
+
+    def check_message_size(self, message):
+        # サーバーの上限を超えるフレームを送ると切断されるので、送る前に断る。大きなデータは分割転送で送る
+        if self.max_frame and len(message.encode('utf-8')) + CHUNK_OVERHEAD > self.max_frame:
+            raise Exception(f"メッセージが大きすぎます ({self.max_frame} バイトまで)")
+
+    def send_transfer(self, source, size, request):
+        # sourceからsizeバイトを読みながら、chunk_sizeごとに暗号化したチャンクで送る。全体をメモリに載せず、
+        # 1チャンクごとに送信ロックを取り直すので、送っている間も他のメッセージを送れる
+        if not self.transfer_enabled:
+            raise Exception("サーバーが分割転送に対応していません")
+        if self.reconnecting or not self.is_connected:
             raise Exception("サーバーに接続されていません")
-            
+        transfer_id = new_transfer_id()
+        cipher = self.cipher
+        self.send_message(json.dumps(dict(request, type="transfer", id=transfer_id.hex(), size=size)))
+        index = 0
+        remaining = size
+        while True:
+            length = min(self.chunk_size, remaining)
+            data = source.read(length)
+            if len(data) != length:
+                self.send_chunk(cipher, encode_chunk(transfer_id, index, CHUNK_ABORT))
+                raise Exception("転送中にファイルの大きさが変わりました")
+            remaining -= length
+            flags = 0 if remaining else CHUNK_LAST
+            self.send_chunk(cipher, encode_chunk(transfer_id, index, flags, data))
+            if flags:
+                return transfer_id.hex()
+            index += 1
+
+    def send_chunk(self, cipher, chunk):
+        with self.send_lock:
+            # 再接続した後の接続では、サーバーはこの転送を知らない
+            if self.reconnecting or not self.is_connected or self.cipher is not cipher:
+                raise Exception("転送中にサーバーとの接続が切れました")
+            try:
+                send_frame(self.server_socket, cipher.encrypt(chunk), self.framing, FRAME_CHUNK)
+                self.last_sent = time.monotonic()
+            except OSError as e:
+                self.last_error = f"チャンク送信エラー: {str(e)}"
+                raise Exception(self.last_error)
+
+    def receive_chunk(self, plaintext):
+        transfer_id, index, flags, data = decode_chunk(plaintext)
+        transfer = self.incoming.get(transfer_id)
+        if flags & CHUNK_ABORT:
+            if transfer:
+                del self.incoming[transfer_id]
+                transfer.discard()
+            self.finish_transfer(transfer_id, None)
+            return
+        if transfer is None:
+            if index != 0:
+                # 再接続前に始まった転送の続きなどは組み立てられないので捨てる
+                return
+            transfer = self.incoming[transfer_id] = IncomingTransfer()
         try:
-            encrypted_message = aes_encrypt(message, self.shared_key)
-            send_data(self.server_socket, encrypted_message)
-        except Exception as e:
-            self.is_connected = False
-            self.last_error = f"メッセージ送信エラー: {str(e)}"
-            raise Exception(self.last_error)
+            transfer.write(index, data)
+        except ValueError:
+            del self.incoming[transfer_id]
+            transfer.discard()
+            self.finish_transfer(transfer_id, None)
+            raise
+        if flags & CHUNK_LAST:
+            del self.incoming[transfer_id]
+            self.finish_transfer(transfer_id, transfer.complete())
+
+    def finish_transfer(self, transfer_id, fileobj):
+        if self.transfer_callback:
+            self.transfer_callback(transfer_id.hex(), fileobj)
+        elif fileobj:
+            fileobj.close()
+
+    def discard_incoming(self):
+        incoming, self.incoming = self.incoming, {}
+        for transfer_id, transfer in incoming.items():
+            transfer.discard()
+            self.finish_transfer(transfer_id, None)
+
+    def send_now(self, message):
+        if self.compressor:
+            message = self.compressor.compress(message)
+        encrypted_message = self.cipher.encrypt(message)
+        send_frame(self.server_socket, encrypted_message, self.framing)
+        self.last_sent = time.monotonic()
+
+    def buffer_message(self, message):
+        if len(self.outbox) >= OUTBOX_SIZE:
+            raise Exception("再接続待ちの送信メッセージが上限に達しました")
+        self.outbox.append(message)
+
+    def flush_outbox(self):
+        with self.send_lock:
+            while self.outbox:
+                self.send_now(self.outbox[0])
+                self.outbox.popleft()
+            self.reconnecting = False
+
+    def handle_frame(self, frame_type, payload):
+        if frame_type == FRAME_PONG:
+            return
+        if frame_type == FRAME_GROUP_KEY:
+            self.group_keys.store(payload, self.cipher)
+            return
+        if frame_type == FRAME_CHUNK:
+            self.receive_chunk(self.cipher.decrypt_bytes(payload))
+            return
+        if frame_type == FRAME_GROUP_DATA:
+            # グループ宛てのフレームは全員で同じ暗号文を使うので圧縮しない
+            decrypted_message = self.group_keys.decrypt(payload)
+        elif self.compressor:
+            decrypted_message = self.compressor.decompress(self.cipher.decrypt_bytes(payload), DEFAULT_MAX_FRAME).decode('utf-8')
+        else:
+            decrypted_message = self.cipher.decrypt(payload)
+        self.message_callback(decrypted_message)
 
     def receive_messages(self):
+        while True:
+            self.receive_loop()
+            if self.closing.is_set() or not self.auto_reconnect or not self.reconnect():
+                break
+
+        self.is_connected = False
+        print("メッセージ受信ループを終了しました")
+
+    def receive_loop(self):
+        idle_since = time.monotonic()
         while self.is_connected and self.server_socket and hasattr(self, 'message_callback'):
             try:
-                if not self.server_socket:
-                    break
-                    
-                encrypted_message = receive_data(self.server_socket)
-                if not encrypted_message:
+                if self.heartbeat_interval:
+                    # 受信中でも、最後の送信から間隔が過ぎたらpingを送る（受信だけのクライアントもサーバーに切断されないように）。
+                    # サーバーからの受信がpongも含めて上限を超えて途絶えたら切断とみなす
+                    now = time.monotonic()
+                    if now - idle_since >= self.idle_timeout():
+                        print("サーバーからの応答が無いため切断します")
+                        break
+                    if now - self.last_sent >= self.heartbeat_interval:
+                        self.send_ping()
+                    wait = min(self.last_sent + self.heartbeat_interval, idle_since + self.idle_timeout()) - time.monotonic()
+                    if not self.frame_reader.wait_readable(max(0, wait)):
+                        continue
+
+                frame = self.frame_reader.next_frame()
+                if not frame:
                     print("サーバーから切断されました")
                     break
-                    
-                decrypted_message = aes_decrypt(encrypted_message, self.shared_key)
-                self.message_callback(decrypted_message)
-                
-            except (ConnectionResetError, BrokenPipeError):
-                print("サーバーとの接続が切断されました")
-                self.is_connected = False
+                idle_since = time.monotonic()
+            except OSError as e:
+                # タイムアウトを含め、フレームの途中で失敗したら以降の境目が分からないので読み続けない
+                if self.is_connected:
+                    print(f"サーバーとの接続が切断されました: {str(e)}")
                 break
             except Exception as e:
-                if not self.is_connected or not self.server_socket:
-                    break
-                continue
-        
+                print(f"受信データが不正なため切断します: {str(e)}")
+                break
+
+            frame_type, payload = frame
+            try:
+                if frame_type == FRAME_BATCH:
+                    # バッチは中のフレームを順に展開してからコールバックに渡す
+                    for inner_type, inner_payload in iter_batch(payload):
+                        self.handle_frame(inner_type, inner_payload)
+                else:
+                    self.handle_frame(frame_type, payload)
+            except Exception as e:
+                # フレーム単位で読み終えているので、復号や処理に失敗したものだけ捨てて続ける
+                print(f"受信メッセージの処理中にエラーが発生: {str(e)}")
+
         self.is_connected = False
-        print("メッセージ受信ループを終了しました")
+
+    def reconnect(self):
+        # サーバー再起動時に全員が同時に押し寄せないよう、上限付きの指数バックオフに全幅のジッターをかける
+        self.reconnecting = True
+        attempt = 0
+        while not self.closing.is_set():
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(attempt, 16)))
+            if self.closing.wait(delay):
+                break
+            try:
+                self.open_connection(self.server_ip, self.server_port)
+                self.flush_outbox()
+                print("サーバーに再接続しました")
+                return True
+            except Exception as e:
+                attempt += 1
+                print(f"再接続に失敗しました ({attempt}回目): {str(e)}")
+        self.reconnecting = False
+        return False
+
+    def shutdown_socket(self):
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
 
     def close_connection(self):
+        self.closing.set()
+        self.outbox.clear()
         self.is_connected = False
+        if self.frame_reader:
+            self.frame_reader.close()
         if self.server_socket:
             try:
                 self.server_socket.shutdown(socket.SHUT_RDWR)
@@ -188,4 +502,6 @@ class ConnectionManager:
                 except:
                     pass
                 self.server_socket = None
-        self.shared_key = None
\ No newline at end of file
+        self.shared_key = None
+        self.cipher = None
+        self.discard_incoming()
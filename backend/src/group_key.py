@@ -0,0 +1,67 @@
+import os
+import struct
+import threading
+
+from .session_cipher import Opener, Sealer
+from .utils import FRAMING_BINARY, FRAME_GROUP_DATA, FRAME_GROUP_KEY, encode_frame
+
+KEY_ID = struct.Struct('!I')
+GROUP_KEY_SIZE = 32
+# ローテーション直後に旧鍵で暗号化されたフレームが届いても復号できるよう、直近の鍵をいくつか残す
+RETAINED_GROUP_KEYS = 4
+
+
+# 本文はグループ鍵ごとにカウンタを進めるAES-GCMで暗号化する
+class GroupKey:
+    __slots__ = ('key_id', 'key', 'sealer')
+
+    def __init__(self, key_id, key):
+        self.key_id = key_id
+        self.key = key
+        self.sealer = Sealer(key)
+
+    def wrap_frame(self, cipher):
+        # 各クライアントの接続ごとの暗号でグループ鍵を包んで配布する
+        return encode_frame(KEY_ID.pack(self.key_id) + cipher.encrypt(self.key), FRAMING_BINARY, FRAME_GROUP_KEY)
+
+    def encrypt_frame(self, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        return encode_frame(KEY_ID.pack(self.key_id) + self.sealer.seal(message), FRAMING_BINARY, FRAME_GROUP_DATA)
+
+
+# サーバー側。参加・離脱のたびに鍵を替えて、離脱したクライアントが以降の配信を読めないようにする。
+# next_keyで作った鍵は、全員への配布を送信キューに積み終えてからactivateで配信に使い始める
+class GroupKeyring:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.current = None
+
+    def next_key(self):
+        with self.lock:
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+            return GroupKey(self.next_id, os.urandom(GROUP_KEY_SIZE))
+
+    def activate(self, group_key):
+        self.current = group_key
+
+
+# クライアント側。受け取ったグループ鍵をIDごとに保持して復号する
+class GroupKeyStore:
+    def __init__(self):
+        self.keys = {}
+        self.order = []
+
+    def store(self, payload, cipher):
+        key_id = KEY_ID.unpack_from(payload)[0]
+        self.keys[key_id] = Opener(cipher.decrypt_bytes(payload[KEY_ID.size:]))
+        self.order.append(key_id)
+        while len(self.order) > RETAINED_GROUP_KEYS:
+            self.keys.pop(self.order.pop(0), None)
+
+    def decrypt(self, payload):
+        key_id = KEY_ID.unpack_from(payload)[0]
+        if key_id not in self.keys:
+            raise KeyError(f"未知のグループ鍵です: {key_id}")
+        return self.keys[key_id].open(payload[KEY_ID.size:]).decode('utf-8')
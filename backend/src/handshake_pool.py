@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+from .utils import cached_shared_key, derive_shared_key, prepare_private_key, shared_key_cache
+
+
+def _warm_up(private_key):
+    prepare_private_key(private_key)
+    return True
+
+
+class HandshakeTimeout(Exception):
+    pass
+
+
+# 共有鍵の導出をプロセスプールへ逃がし、確立済みセッションの中継をGILで止めないようにする。
+# size=0のときは呼び出し元のスレッドでそのまま導出する（受け入れ制限と計測は有効）。
+# 処理中がmax_pendingに達したら、後から来た接続は最大queue_timeout秒まで順番を待つ。
+# 待っている接続がmax_waitingを超えるか、待ちきれなかった接続は拒否する
+class HandshakePool:
+    def __init__(self, private_key, size=0, max_pending=256, timeout=10.0, queue_timeout=5.0, max_waiting=1024):
+        self.private_key = private_key
+        self.size = size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.max_waiting = max_waiting
+        self.executor = None
+        self.admission = threading.BoundedSemaphore(max_pending)
+        # asyncioエンジンで順番を待っている接続。空いた枠は待っている順にそのまま渡す
+        self.waiters = collections.deque()
+        self.stats_lock = threading.Lock()
+        self.pending = 0
+        self.waiting = 0
+        self.queued = 0
+        self.completed = 0
+        self.cache_hits = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def start(self):
+        if self.size > 0:
+            # fork済みのスレッドを引き継がないようspawnで起動し、長期鍵の準備まで済ませておく
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.size,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            for future in [self.executor.submit(_warm_up, self.private_key) for _ in range(self.size)]:
+                future.result()
+
+    def shutdown(self):
+        if self.executor:
+            try:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            except OSError:
+                # プール側のプロセスが先にシグナルで終了している場合
+                pass
+            self.executor = None
+
+    def enter_queue(self):
+        with self.stats_lock:
+            if self.waiting >= self.max_waiting or not self.queue_timeout:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            self.queued += 1
+            return True
+
+    def leave_queue(self, admitted):
+        with self.stats_lock:
+            self.waiting -= 1
+            if admitted:
+                self.pending += 1
+            else:
+                self.rejected += 1
+        return admitted
+
+    def admit(self):
+        # スレッドエンジン用。接続ごとのスレッドで呼び、空きが無ければ待つ
+        if self.admission.acquire(blocking=False):
+            with self.stats_lock:
+                self.pending += 1
+            return True
+        if not self.enter_queue():
+            return False
+        return self.leave_queue(self.admission.acquire(timeout=self.queue_timeout))
+
+    async def admit_async(self):
+        if not self.waiters and self.admission.acquire(blocking=False):
+            with self.stats_lock:
+                self.pending += 1
+            return True
+        if not self.enter_queue():
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        admitted = False
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            admitted = True
+        except asyncio.TimeoutError:
+            # 枠を渡された直後に時間切れになった場合は、受け取った枠をそのまま使う
+            admitted = waiter.done() and not waiter.cancelled()
+        finally:
+            self.leave_queue(admitted)
+        return admitted
+
+    def release(self, started, outcome):
+        elapsed = time.monotonic() - started
+        with self.stats_lock:
+            self.pending -= 1
+            if outcome == 'completed':
+                self.completed += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+            elif outcome == 'timeout':
+                self.timed_out += 1
+            else:
+                self.failed += 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.admission.release()
+
+    def lookup(self, public_key):
+        shared_key = cached_shared_key(self.private_key, public_key)
+        if shared_key is not None:
+            with self.stats_lock:
+                self.cache_hits += 1
+        return shared_key
+
+    def store(self, public_key, shared_key):
+        shared_key_cache.put((self.private_key, tuple(public_key)), shared_key)
+        return shared_key
+
+    def derive(self, public_key):
+        shared_key = self.lookup(public_key)
+        if shared_key is not None:
+            return shared_key
+        if not self.executor:
+            return self.store(public_key, derive_shared_key(self.private_key, public_key))
+        future = self.executor.submit(derive_shared_key, self.private_key, tuple(public_key))
+        try:
+            return self.store(public_key, future.result(timeout=self.timeout))
+        except FutureTimeoutError:
+            future.cancel()
+            raise HandshakeTimeout("共有鍵の導出がタイムアウトしました")
+
+    async def derive_async(self, public_key):
+        shared_key = self.lookup(public_key)
+        if shared_key is not None:
+            return shared_key
+        if not self.executor:
+            return self.store(public_key, derive_shared_key(self.private_key, public_key))
+        future = self.executor.submit(derive_shared_key, self.private_key, tuple(public_key))
+        try:
+            return self.store(public_key, await asyncio.wait_for(asyncio.wrap_future(future), self.timeout))
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise HandshakeTimeout("共有鍵の導出がタイムアウトしました")
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "pending": self.pending,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "completed": self.completed,
+                "cache_hits": self.cache_hits,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "failed": self.failed,
+                "avg_ms": self.total_seconds / self.completed * 1000 if self.completed else 0.0,
+                "max_ms": self.max_seconds * 1000
+            }
@@ -0,0 +1,168 @@
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import threading
+from urllib.parse import quote
+
+from Crypto.Cipher import AES
+
+from .utils import KEY_STORAGE_DIR, N, LRUCache, multiply
+
+KEY_CACHE_SIZE = int(os.getenv('KEY_CACHE_SIZE', '1024'))
+KEY_FILE_VERSION = 1
+SCRYPT_PARAMS = {"n": 1 << 14, "r": 8, "p": 1}
+
+
+class KeyPair:
+    __slots__ = ('name', 'private_key', 'public_key', 'encrypted', 'verifier')
+
+    def __init__(self, name, private_key, public_key, encrypted=False, verifier=None):
+        self.name = name
+        self.private_key = private_key
+        # ハンドシェイクでそのまま送れる形（タプル）で持っておく
+        self.public_key = tuple(public_key)
+        self.encrypted = encrypted
+        self.verifier = verifier
+
+    def matches(self, passphrase):
+        if not self.encrypted:
+            return True
+        if not passphrase:
+            return False
+        salt, digest = self.verifier
+        return hmac.compare_digest(hashlib.sha256(salt + passphrase.encode()).digest(), digest)
+
+
+def passphrase_key(passphrase, salt, params=SCRYPT_PARAMS):
+    return hashlib.scrypt(passphrase.encode(), salt=salt, dklen=32, **params)
+
+
+def make_verifier(passphrase):
+    # キャッシュヒット時にscryptをやり直さずにパスフレーズを照合するための値（メモリ上のみ）
+    salt = os.urandom(16)
+    return salt, hashlib.sha256(salt + passphrase.encode()).digest()
+
+
+# 1つのIDにつき1ファイル（<name>.key）。秘密鍵はパスフレーズから導いた鍵でAES-GCM暗号化して保存し、
+# 一度読み込んだ鍵ペアはメモリ上のLRUに残して再接続ではディスクを読まない
+class KeyStore:
+    def __init__(self, directory=KEY_STORAGE_DIR, cache_size=KEY_CACHE_SIZE):
+        self.directory = directory
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def path(self, name, suffix='.key'):
+        return os.path.join(self.directory, quote(name, safe='') + suffix)
+
+    def load_or_create(self, name, passphrase=None):
+        keypair = self.cache.get(name)
+        if keypair is None:
+            with self.lock:
+                keypair = self.cache.get(name) or self.load(name, passphrase) or self.create(name, passphrase)
+                self.cache.put(name, keypair)
+        if passphrase and not keypair.encrypted:
+            # 平文の鍵を最初に渡されたパスフレーズで暗号化すると、ニックネームを知っている他人が自分のパスフレーズで
+            # 鍵を奪えてしまう。暗号化は所有者がencrypt_keyコマンドで明示的に行う
+            raise ValueError(
+                f"{name} の鍵はパスフレーズなしで保存されています。"
+                f"所有者が python manage.py encrypt_key {name} で暗号化してから接続してください"
+            )
+        if not keypair.matches(passphrase):
+            raise ValueError("パスフレーズが一致しません")
+        return keypair
+
+    def encrypt(self, name, passphrase):
+        # パスフレーズなしで保存された鍵（以前の形式を含む）を、所有者が指定したパスフレーズで暗号化して保存し直す
+        if not passphrase:
+            raise ValueError("パスフレーズを指定してください")
+        with self.lock:
+            keypair = self.cache.get(name)
+            if keypair is None:
+                try:
+                    keypair = self.load(name, None)
+                except ValueError:
+                    raise ValueError(f"{name} の鍵は既に暗号化されています")
+            if keypair is None:
+                raise ValueError(f"{name} の鍵がありません")
+            if keypair.encrypted:
+                raise ValueError(f"{name} の鍵は既に暗号化されています")
+            keypair = self.save(keypair, passphrase)
+            self.cache.put(name, keypair)
+        return keypair
+
+    def load(self, name, passphrase):
+        try:
+            with open(self.path(name), 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return self.load_legacy(name)
+
+        if "nonce" not in data:
+            return KeyPair(name, data["sk"], data["pk"])
+        if not passphrase:
+            raise ValueError("この鍵の読み込みにはパスフレーズが必要です")
+        key = passphrase_key(passphrase, bytes.fromhex(data["salt"]), data["kdf"])
+        cipher = AES.new(key, AES.MODE_GCM, nonce=bytes.fromhex(data["nonce"]))
+        try:
+            secret = cipher.decrypt_and_verify(bytes.fromhex(data["sk"]), bytes.fromhex(data["tag"]))
+        except ValueError:
+            raise ValueError("パスフレーズが一致しません")
+        return KeyPair(name, int.from_bytes(secret, 'big'), data["pk"], True, make_verifier(passphrase))
+
+    def load_legacy(self, name):
+        # 以前の形式（<name>.pk.json / <name>.sk.json）。見つかれば次回からは新形式で読む
+        try:
+            with open(self.path(name, '.sk.json'), 'r') as f:
+                private_key = json.load(f)
+            with open(self.path(name, '.pk.json'), 'r') as f:
+                public_key = json.load(f)
+        except FileNotFoundError:
+            return None
+        return self.save(KeyPair(name, private_key, public_key), None)
+
+    def create(self, name, passphrase):
+        # 秘密鍵は暗号論的な乱数で作る（randomのメルセンヌ・ツイスタは出力から内部状態を推測できる）
+        private_key = secrets.randbelow(N - 1) + 1
+        return self.save(KeyPair(name, private_key, multiply(private_key)), passphrase)
+
+    def save(self, keypair, passphrase):
+        data = {"version": KEY_FILE_VERSION, "pk": list(keypair.public_key)}
+        if passphrase:
+            salt = os.urandom(16)
+            cipher = AES.new(passphrase_key(passphrase, salt), AES.MODE_GCM)
+            secret, tag = cipher.encrypt_and_digest(keypair.private_key.to_bytes(32, 'big'))
+            data.update({
+                "kdf": SCRYPT_PARAMS,
+                "salt": salt.hex(),
+                "nonce": cipher.nonce.hex(),
+                "sk": secret.hex(),
+                "tag": tag.hex()
+            })
+            keypair = KeyPair(keypair.name, keypair.private_key, keypair.public_key, True, make_verifier(passphrase))
+        else:
+            data["sk"] = keypair.private_key
+
+        # 一時ファイルに書いてからrenameし、書きかけのファイルが読まれないようにする
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path(keypair.name))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return keypair
+
+
+key_store = KeyStore()
+
+
+def generate_keys(name, passphrase=None):
+    keypair = key_store.load_or_create(name, passphrase)
+    return keypair.private_key, keypair.public_key
@@ -0,0 +1,310 @@
+import fcntl
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from itertools import islice
+
+RECORD_HEADER = struct.Struct('!QII')   # seq, 本文の長さ, crc32
+INDEX_ENTRY = struct.Struct('!QQQ')     # それより前の最大seq, ファイル内の位置, セグメント内の番号
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def take(records, count):
+    # イテレータから最大count件を取り出す。asyncioエンジンではこれを別スレッドで呼んで少しずつ読む
+    return list(islice(records, count))
+
+
+def iter_records(path, offset, end):
+    # ファイル内の位置offsetからendまでのレコードを順に返す。読み込みはバッファ1つ分とレコード1件分だけ
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset < end:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            seq, length, _ = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            offset += RECORD_HEADER.size + length
+            yield seq, data
+
+
+class LogSegment:
+    __slots__ = ('base', 'path', 'index', 'size', 'count')
+
+    def __init__(self, directory, base):
+        # baseはログ全体で数えたときの先頭レコードの番号で、ファイル名にもなる
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}")
+        self.index = []
+        self.size = 0
+        self.count = 0
+
+    @property
+    def log_path(self):
+        return self.path + SEGMENT_SUFFIX
+
+    @property
+    def index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    @property
+    def floor(self):
+        return self.index[0][0] if self.index else 0
+
+    def seek_seq(self, seq):
+        # 直前までの最大seqがseq以下である最後の索引位置。そこより前にseqより後ろのレコードは無い
+        position = bisect_right(self.index, (seq, float('inf'), float('inf'))) - 1
+        return self.index[max(position, 0)]
+
+    def seek_ordinal(self, ordinal):
+        position = bisect_right([entry[2] for entry in self.index], ordinal) - 1
+        return self.index[max(position, 0)]
+
+
+# 追記専用のメッセージログ。一定サイズでセグメントを切り替え、各セグメントには
+# 数件おきの索引（.idx）を付けて、連番や件数から読み始める位置をファイル全体を読まずに求める。
+# 連番はワーカーごとの時計から作られ、バス経由の分は前後し得るので、索引にはそれより前の最大seqを記録する
+class MessageLog:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, fsync='interval', fsync_interval=1.0,
+                 index_interval=128, max_segments=0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"不明なfsyncポリシーです: {fsync}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.segments = []
+        self.log_file = None
+        self.index_file = None
+        self.max_seq = 0
+        self.dirty = False
+        self.closed = False
+        self.sync_thread = None
+
+        os.makedirs(directory, exist_ok=True)
+        # 同じディレクトリに2つのプロセスが書き込むとレコードが混ざるので排他する
+        self.lock_file = open(os.path.join(directory, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            raise RuntimeError(f"メッセージログ {directory} は別のプロセスが使用中です")
+        self.open_segments()
+
+        if fsync == 'interval':
+            self.sync_thread = threading.Thread(target=self.sync_periodically, daemon=True)
+            self.sync_thread.start()
+
+    def __len__(self):
+        if not self.segments:
+            return 0
+        return self.segments[-1].base + self.segments[-1].count
+
+    def open_segments(self):
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        for base in bases:
+            segment = LogSegment(self.directory, base)
+            segment.size = os.path.getsize(segment.log_path)
+            segment.index = self.load_index(segment)
+            self.segments.append(segment)
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.count = following.base - segment.base
+
+        # 書き込み途中で落ちた可能性があるのは最後のセグメントだけなので、そこだけ検査して壊れた末尾を切り詰める
+        while self.segments:
+            active = self.segments[-1]
+            self.recover(active)
+            if active.count:
+                break
+            os.unlink(active.log_path)
+            if os.path.exists(active.index_path):
+                os.unlink(active.index_path)
+            self.segments.pop()
+
+        if self.segments:
+            active = self.segments[-1]
+            self.log_file = open(active.log_path, 'ab')
+            self.index_file = open(active.index_path, 'ab')
+
+    def load_index(self, segment):
+        try:
+            with open(segment.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in range(0, usable, INDEX_ENTRY.size)]
+        return [entry for entry in entries if entry[1] < segment.size]
+
+    def recover(self, segment):
+        # 最後の索引位置から読み直して件数と最大seqを数え、索引の欠けも補う
+        if segment.index:
+            floor, offset, ordinal = segment.index[-1]
+        else:
+            floor, offset, ordinal = (self.scan_max(self.segments[-2]) if len(self.segments) > 1 else 0), 0, 0
+        max_seq = floor
+        with open(segment.log_path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                seq, length, crc = RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+                if ordinal % self.index_interval == 0 and (not segment.index or segment.index[-1][2] < ordinal):
+                    segment.index.append((max_seq, offset, ordinal))
+                max_seq = max(max_seq, seq)
+                offset += RECORD_HEADER.size + length
+                ordinal += 1
+
+        if offset < segment.size:
+            print(f"メッセージログ {segment.log_path} の末尾 {segment.size - offset} バイトが壊れていたため切り詰めました")
+            with open(segment.log_path, 'r+b') as f:
+                f.truncate(offset)
+        segment.size = offset
+        segment.count = ordinal
+        segment.index = [entry for entry in segment.index if entry[1] < offset]
+        with open(segment.index_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in segment.index))
+        self.max_seq = max_seq
+
+    def scan_max(self, segment):
+        floor, offset, _ = segment.index[-1] if segment.index else (0, 0, 0)
+        return max([floor] + [seq for seq, _ in iter_records(segment.log_path, offset, segment.size)])
+
+    def append(self, seq, message):
+        data = message.encode('utf-8')
+        with self.lock:
+            if self.closed:
+                return
+            if not self.segments or self.segments[-1].size >= self.segment_bytes:
+                self.roll()
+            segment = self.segments[-1]
+            if segment.count % self.index_interval == 0:
+                entry = (self.max_seq, segment.size, segment.count)
+                segment.index.append(entry)
+                self.index_file.write(INDEX_ENTRY.pack(*entry))
+                self.index_file.flush()
+            self.log_file.write(RECORD_HEADER.pack(seq, len(data), zlib.crc32(data)) + data)
+            # 読み手は別のファイルオブジェクトで読むので、書いた分はOSまで渡しておく
+            self.log_file.flush()
+            segment.size += RECORD_HEADER.size + len(data)
+            segment.count += 1
+            self.max_seq = max(self.max_seq, seq)
+            if self.fsync == 'always':
+                os.fsync(self.log_file.fileno())
+            else:
+                self.dirty = True
+
+    def roll(self):
+        # lockを持って呼ぶ。新しいセグメントは最初のレコードを書くときに作る
+        if self.log_file:
+            self.close_files()
+        segment = LogSegment(self.directory, len(self))
+        self.log_file = open(segment.log_path, 'ab')
+        self.index_file = open(segment.index_path, 'ab')
+        self.segments.append(segment)
+        if self.fsync != 'never':
+            self.sync_directory()
+        if self.max_segments and len(self.segments) > self.max_segments:
+            for old in self.segments[:-self.max_segments]:
+                # 読み出し中のものはファイルを開いたままなので、そのまま最後まで読める
+                for path in (old.log_path, old.index_path):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+            del self.segments[:-self.max_segments]
+
+    def close_files(self):
+        for f in (self.log_file, self.index_file):
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+            f.close()
+        self.log_file = None
+        self.index_file = None
+        self.dirty = False
+
+    def sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self):
+        with self.lock:
+            if self.dirty and self.log_file:
+                os.fsync(self.log_file.fileno())
+                os.fsync(self.index_file.fileno())
+                self.dirty = False
+
+    def sync_periodically(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except (OSError, ValueError):
+                pass
+
+    def snapshot(self):
+        # 読み出し開始時点のセグメントと、その時点で書き終わっている範囲
+        with self.lock:
+            return [(segment, segment.size, segment.count) for segment in self.segments]
+
+    def read_segments(self, segments, start, offset):
+        for segment, size, _ in segments[start:]:
+            try:
+                yield from iter_records(segment.log_path, offset, size)
+            except FileNotFoundError:
+                # 読み始める前に保持数の上限で削除された
+                pass
+            offset = 0
+
+    def read_after(self, seq):
+        # seqより後ろのレコードを書き込まれた順に返す。読み始める位置は索引で求め、その先は1件ずつ読む
+        segments = self.snapshot()
+        if not segments:
+            return
+        start = max(0, bisect_right([segment.floor for segment, _, _ in segments], seq) - 1)
+        _, offset, _ = segments[start][0].seek_seq(seq)
+        for record_seq, data in self.read_segments(segments, start, offset):
+            if record_seq > seq:
+                yield data.decode('utf-8')
+
+    def read_last(self, count):
+        # 直近count件。セグメントの件数から読み始めるレコードの番号を求め、最寄りの索引位置から読み飛ばす
+        segments = self.snapshot()
+        if not segments or count <= 0:
+            return
+        last, _, last_count = segments[-1]
+        first = max(segments[0][0].base, last.base + last_count - count)
+        start = bisect_right([segment.base for segment, _, _ in segments], first) - 1
+        segment = segments[start][0]
+        _, offset, ordinal = segment.seek_ordinal(first - segment.base)
+        skip = first - segment.base - ordinal
+        for _, data in islice(self.read_segments(segments, start, offset), skip, None):
+            yield data.decode('utf-8')
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.log_file:
+                self.close_files()
+        self.lock_file.close()
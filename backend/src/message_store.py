@@ -0,0 +1,96 @@
+import time
+from datetime import datetime
+
+
+class MessageRecord:
+    __slots__ = ('seq', 'timestamp', 'raw', 'key')
+
+    def __init__(self, seq, timestamp, raw, key):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.raw = raw
+        self.key = key
+
+
+# 保持件数に上限のあるリングバッファ。seqは連番なので位置を直接計算でき、
+# タイムスタンプは単調増加にそろえてあるので二分探索できる
+class MessageStore:
+    def __init__(self, max_messages=10000):
+        if max_messages < 1:
+            raise ValueError("保持件数には1以上を指定してください")
+        self.max_messages = max_messages
+        self.slots = [None] * max_messages
+        self.head = 0
+        self.size = 0
+        self.next_seq = 1
+        self.index = {}
+        self.last_timestamp = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self.record_at(i).raw
+
+    def record_at(self, position):
+        return self.slots[(self.head + position) % self.max_messages]
+
+    @property
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def dedup_key(self, raw, decoded):
+        # IDかサーバーの連番を持つメッセージはそれで、それ以外は本文そのもので重複を判定する（キーは本文と同じ文字列オブジェクト）
+        if decoded and decoded.get("id") is not None:
+            return ("id", decoded["id"])
+        if decoded and decoded.get("seq") is not None:
+            return ("seq", decoded["seq"])
+        return raw
+
+    def add(self, raw, decoded=None, timestamp=None):
+        key = self.dedup_key(raw, decoded)
+        if key in self.index:
+            return None
+
+        timestamp = max(timestamp if timestamp is not None else time.time(), self.last_timestamp)
+        self.last_timestamp = timestamp
+
+        if self.size == self.max_messages:
+            oldest = self.slots[self.head]
+            self.index.pop(oldest.key, None)
+            self.slots[self.head] = None
+            self.head = (self.head + 1) % self.max_messages
+            self.size -= 1
+
+        record = MessageRecord(self.next_seq, timestamp, raw, key)
+        self.slots[(self.head + self.size) % self.max_messages] = record
+        self.size += 1
+        self.next_seq += 1
+        self.index[key] = record.seq
+        return record
+
+    def tail(self, start, limit=None):
+        if limit:
+            start = max(start, self.size - limit)
+        return [self.record_at(i) for i in range(start, self.size)]
+
+    def after_seq(self, seq, limit=None):
+        # カーソルで先へ読み進めるため、seqより後ろを古い順にlimit件返す
+        if not self.size:
+            return []
+        start = max(0, seq + 1 - self.record_at(0).seq)
+        end = min(self.size, start + limit) if limit else self.size
+        return [self.record_at(i) for i in range(start, end)]
+
+    def since(self, timestamp, limit=None):
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_at(middle).timestamp > timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        return self.tail(low, limit)
@@ -0,0 +1,60 @@
+import threading
+
+ONLINE = "オンライン"
+
+
+def presence_key(update):
+    return (update["ip"], update["port"], update["username"])
+
+
+# サーバー全体（他ワーカーの接続も含む）の在席一覧。変更のたびに版数を進め、
+# 配っていない変更はユーザーごとに最新の1件だけを残しておいて、まとめて差分として配る
+class Roster:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.usernames = {}
+        self.version = 0
+        self.sent_version = 0
+        self.pending = {}
+
+    def update(self, update):
+        key = presence_key(update)
+        with self.lock:
+            if update["status"] == ONLINE:
+                if key not in self.users:
+                    self.usernames[key[2]] = self.usernames.get(key[2], 0) + 1
+                self.users[key] = update
+            elif self.users.pop(key, None) is not None:
+                self.usernames[key[2]] -= 1
+                if not self.usernames[key[2]]:
+                    del self.usernames[key[2]]
+            self.version += 1
+            self.pending[key] = update
+
+    def snapshot(self):
+        with self.lock:
+            return {"type": "roster", "version": self.version, "users": list(self.users.values())}
+
+    def online_users(self):
+        with self.lock:
+            return list(self.users.values())
+
+    def has_username(self, username):
+        with self.lock:
+            return username in self.usernames
+
+    def drain(self):
+        # 前回配ってからの変更をまとめた差分。baseより前の版を持つクライアントは一覧を取り直す
+        with self.lock:
+            if not self.pending:
+                return None
+            delta = {
+                "type": "presence",
+                "base": self.sent_version,
+                "version": self.version,
+                "updates": list(self.pending.values())
+            }
+            self.pending = {}
+            self.sent_version = self.version
+            return delta
@@ -0,0 +1,56 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from .utils import LRUCache
+
+TICKET_SIZE = 16
+NONCE_SIZE = 16
+
+
+def resumption_secret(shared_key, ticket):
+    # チケットごとの再開用の秘密。共有鍵そのものは保存しない
+    return hmac.new(shared_key, b"resumption" + ticket, hashlib.sha256).digest()
+
+
+def resumed_key(secret, server_nonce, client_nonce):
+    # 再開のたびに双方のノンスを混ぜて新しいセッション鍵を作る
+    return hmac.new(secret, b"resume" + server_nonce + client_nonce, hashlib.sha256).digest()
+
+
+def new_nonce():
+    return os.urandom(NONCE_SIZE)
+
+
+# サーバー側のチケット保管庫。チケットは使い捨てで、再開に使われたら新しいものと交換する
+class TicketCache:
+    def __init__(self, ttl=3600.0, maxsize=10000):
+        self.ttl = ttl
+        self.tickets = LRUCache(maxsize)
+        self.stats_lock = threading.Lock()
+        self.issued = 0
+        self.resumed = 0
+        self.missed = 0
+
+    def issue(self, shared_key, public_key):
+        ticket = os.urandom(TICKET_SIZE)
+        self.tickets.put(ticket, (resumption_secret(shared_key, ticket), tuple(public_key), time.monotonic() + self.ttl))
+        with self.stats_lock:
+            self.issued += 1
+        return ticket
+
+    def redeem(self, ticket, public_key):
+        entry = self.tickets.pop(ticket) if isinstance(ticket, bytes) else None
+        if entry and entry[1] == tuple(public_key) and entry[2] > time.monotonic():
+            with self.stats_lock:
+                self.resumed += 1
+            return entry[0]
+        with self.stats_lock:
+            self.missed += 1
+        return None
+
+    def stats(self):
+        with self.stats_lock:
+            return {"issued": self.issued, "resumed": self.resumed, "missed": self.missed, "cached": len(self.tickets)}
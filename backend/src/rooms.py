@@ -0,0 +1,124 @@
+import json
+import threading
+
+from .transfers import valid_transfer
+
+# 旧クライアントや、ルームを指定しないメッセージの宛先
+DEFAULT_ROOM = 'lobby'
+MAX_ROOM_NAME = 64
+MAX_ROOMS_PER_CLIENT = 32
+
+
+def valid_room(name):
+    return isinstance(name, str) and 0 < len(name) <= MAX_ROOM_NAME and name.isprintable()
+
+
+def initial_rooms(requested):
+    # ハンドシェイクで指定されたルーム（再接続なら切断前に参加していたもの）。不正な名前は無視する
+    rooms = []
+    for room in requested:
+        if valid_room(room) and room not in rooms:
+            rooms.append(room)
+    return set(rooms[:MAX_ROOMS_PER_CLIENT])
+
+
+def parse_request(text, rooms_mode):
+    # ルーム対応クライアントはJSONで要求を送る。それ以外（旧クライアントの本文など）は既定ルームへの発言として扱う
+    request = None
+    if rooms_mode:
+        try:
+            request = json.loads(text)
+        except ValueError:
+            pass
+    if not isinstance(request, dict) or request.get("type") not in ("message", "direct", "join", "leave", "roster", "transfer"):
+        return {"type": "message", "room": DEFAULT_ROOM, "content": text}
+    if request["type"] == "roster":
+        return request
+    if request["type"] == "transfer":
+        if not valid_transfer(request):
+            raise ValueError("転送の指定が不正です")
+        if request.get("to") is not None:
+            if not isinstance(request["to"], str):
+                raise ValueError("宛先が不正です")
+            return request
+    if request["type"] == "direct":
+        if not isinstance(request.get("to"), str) or not isinstance(request.get("content"), str):
+            raise ValueError("宛先か本文が不正です")
+        return request
+    room = request.get("room", DEFAULT_ROOM)
+    if not valid_room(room):
+        raise ValueError("ルーム名が不正です")
+    if request["type"] == "message" and not isinstance(request.get("content"), str):
+        raise ValueError("本文が不正です")
+    request["room"] = room
+    return request
+
+
+def visible_to(session, message):
+    # 履歴の送り直しで、そのクライアントに配信されるはずだったメッセージだけを選ぶ
+    decoded = json.loads(message)
+    if decoded.get("to") is not None:
+        return session.nickname in (decoded["to"], decoded.get("username"))
+    return decoded.get("room", DEFAULT_ROOM) in session.rooms
+
+
+# ルーム → 参加者、ニックネーム → 接続の索引。配信先をサーバー全体の接続ではなく宛先の参加者だけから引く。
+# キーはエンジンごとの接続の識別子（ソケットかStreamWriter）
+class RoomIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.nicknames = {}
+
+    def add(self, key, session):
+        with self.lock:
+            self.nicknames.setdefault(session.nickname, {})[key] = session
+            for room in session.rooms:
+                self.rooms.setdefault(room, {})[key] = session
+
+    def remove(self, key, session):
+        with self.lock:
+            for room in session.rooms:
+                self.discard(self.rooms, room, key)
+            self.discard(self.nicknames, session.nickname, key)
+
+    def discard(self, index, name, key):
+        members = index.get(name)
+        if members is not None:
+            members.pop(key, None)
+            if not members:
+                del index[name]
+
+    def join(self, key, session, room):
+        with self.lock:
+            if room in session.rooms:
+                return False
+            if len(session.rooms) >= MAX_ROOMS_PER_CLIENT:
+                raise ValueError("参加できるルーム数の上限に達しました")
+            session.rooms.add(room)
+            self.rooms.setdefault(room, {})[key] = session
+            return True
+
+    def leave(self, key, session, room):
+        with self.lock:
+            if room not in session.rooms:
+                return False
+            session.rooms.discard(room)
+            self.discard(self.rooms, room, key)
+            return True
+
+    def members(self, room):
+        with self.lock:
+            return list(self.rooms.get(room, {}).items())
+
+    def connections(self, nicknames):
+        # 同じニックネームで複数接続していれば全てに届ける
+        with self.lock:
+            targets = {}
+            for nickname in nicknames:
+                targets.update(self.nicknames.get(nickname, {}))
+            return list(targets.items())
+
+    def has_nickname(self, nickname):
+        with self.lock:
+            return nickname in self.nicknames
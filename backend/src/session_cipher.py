@@ -0,0 +1,147 @@
+import hashlib
+import hmac
+import os
+import struct
+import threading
+
+from Crypto.Cipher import AES
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+from .utils import aes_decrypt_bytes, aes_encrypt
+
+SALT_SIZE = 16
+TAG_SIZE = 16
+COUNTER = struct.Struct('!Q')
+# GCMのノンスは12バイト。先頭4バイトは0で、残りにフレームごとのカウンタを入れる
+NONCE_PREFIX = bytes(4)
+# 暗号化してから送信キューに積むまでの間にスレッド間で順序が入れ替わり得るので、この幅までは遅れて届いても受け付ける
+REPLAY_WINDOW = 1024
+
+
+def new_salt():
+    return os.urandom(SALT_SIZE)
+
+
+def directional_keys(shared_key, server_salt, client_salt):
+    # 接続ごとに双方が選んだ塩を混ぜ、送信方向ごとに別の鍵を作る。
+    # 同じ鍵ペアで再接続して共有鍵が同じでも、カウンタを0から使い直して同じノンスにならない
+    material = server_salt + client_salt
+    return (
+        hmac.new(shared_key, b"client to server" + material, hashlib.sha256).digest(),
+        hmac.new(shared_key, b"server to client" + material, hashlib.sha256).digest()
+    )
+
+
+class GCMKey:
+    # 鍵の展開は作成時の1回だけ。cryptographyがあれば鍵オブジェクトを使い回し、無ければpycryptodomeで都度作る
+    __slots__ = ('key', 'aead')
+
+    def __init__(self, key):
+        self.key = key
+        self.aead = AESGCM(key) if AESGCM else None
+
+    def seal(self, nonce, data):
+        if self.aead:
+            return self.aead.encrypt(nonce, data, None)
+        ciphertext, tag = AES.new(self.key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def open(self, nonce, data):
+        if len(data) < TAG_SIZE:
+            raise ValueError("暗号文が短すぎます")
+        if self.aead:
+            try:
+                return self.aead.decrypt(nonce, data, None)
+            except InvalidTag:
+                raise ValueError("認証タグが一致しません")
+        try:
+            return AES.new(self.key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+        except ValueError:
+            raise ValueError("認証タグが一致しません")
+
+
+# 送信側。フレームごとにカウンタを進め、先頭8バイトにカウンタをそのまま載せる
+class Sealer:
+    def __init__(self, key):
+        self.key = GCMKey(key)
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def seal(self, data):
+        with self.lock:
+            counter = self.counter
+            self.counter += 1
+        prefix = COUNTER.pack(counter)
+        return prefix + self.key.seal(NONCE_PREFIX + prefix, data)
+
+
+# 受信側。同じカウンタのフレームは2度受け付けず、窓より古いものも捨てる
+class Opener:
+    def __init__(self, key, window=REPLAY_WINDOW):
+        self.key = GCMKey(key)
+        self.window = window
+        self.highest = -1
+        self.seen = 0
+
+    def open(self, payload):
+        if len(payload) < COUNTER.size:
+            raise ValueError("暗号文が短すぎます")
+        counter = COUNTER.unpack_from(payload)[0]
+        if counter <= self.highest:
+            offset = self.highest - counter
+            if offset >= self.window:
+                raise ValueError("古すぎるフレームです")
+            if self.seen >> offset & 1:
+                raise ValueError("同じフレームを2度受信しました")
+        # 認証に通ったものだけを受信済みとして記録する
+        data = self.key.open(NONCE_PREFIX + payload[:COUNTER.size], payload[COUNTER.size:])
+        if counter > self.highest:
+            self.seen = (self.seen << (counter - self.highest) | 1) & ((1 << self.window) - 1)
+            self.highest = counter
+        else:
+            self.seen |= 1 << (self.highest - counter)
+        return data
+
+
+# 接続ごとの暗号。鍵の展開は接続時に1回だけ行い、以降はカウンタを進めながらAES-GCMで暗号化と改ざん検知を行う
+class SessionCipher:
+    aead = True
+
+    def __init__(self, shared_key, server_salt, client_salt, server_side):
+        client_key, server_key = directional_keys(shared_key, server_salt, client_salt)
+        self.sealer = Sealer(server_key if server_side else client_key)
+        self.opener = Opener(client_key if server_side else server_key)
+
+    def encrypt(self, message):
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        return self.sealer.seal(message)
+
+    def decrypt_bytes(self, payload):
+        return self.opener.open(payload)
+
+    def decrypt(self, payload):
+        return self.decrypt_bytes(payload).decode('utf-8')
+
+
+# AES-GCMに対応していない相手用。カウンタが毎回0から始まるAES-CTRのままで鍵ストリームが再利用されるため、
+# 互換のためだけに残している
+class LegacyCipher:
+    aead = False
+
+    def __init__(self, shared_key):
+        self.shared_key = shared_key
+
+    def encrypt(self, message):
+        return aes_encrypt(message, self.shared_key)
+
+    def decrypt_bytes(self, payload):
+        return aes_decrypt_bytes(payload, self.shared_key)
+
+    def decrypt(self, payload):
+        return self.decrypt_bytes(payload).decode('utf-8')
@@ -0,0 +1,143 @@
+import os
+import struct
+import tempfile
+import threading
+
+# チャンクの平文の先頭に付けるヘッダ（転送ID、通し番号、フラグ）
+CHUNK_HEADER = struct.Struct('!16sIB')
+TRANSFER_ID_SIZE = 16
+CHUNK_LAST = 1
+CHUNK_ABORT = 2
+CHUNK_SIZE = 64 * 1024
+# 暗号化で増える分（カウンタと認証タグ）とフレームヘッダの余裕
+CHUNK_OVERHEAD = CHUNK_HEADER.size + 64
+MAX_TRANSFER_NAME = 255
+MAX_TRANSFERS_PER_CLIENT = 4
+# 宛先の送信キューにチャンクを積むのは、キューがこの長さを下回ってから。
+# チャットのフレームを先に流し、1宛先あたりに溜まるチャンクのメモリも抑える
+TRANSFER_QUEUE_FRAMES = 16
+# 他のワーカーから届いたチャンクを、宛先に積み終えるまで送信元ワーカーごとに溜めておける数。超えた転送は中断する
+BUS_CHUNK_BACKLOG = 256
+# 受信側で、これを超えた分は一時ファイルに書き出す
+SPOOL_BYTES = 1024 * 1024
+
+
+def new_transfer_id():
+    return os.urandom(TRANSFER_ID_SIZE)
+
+
+def parse_transfer_id(value):
+    try:
+        transfer_id = bytes.fromhex(value)
+    except (TypeError, ValueError):
+        return None
+    return transfer_id if len(transfer_id) == TRANSFER_ID_SIZE else None
+
+
+def valid_transfer(request):
+    return (
+        parse_transfer_id(request.get("id")) is not None
+        and isinstance(request.get("name"), str) and 0 < len(request["name"]) <= MAX_TRANSFER_NAME
+        and type(request.get("size")) is int and request["size"] >= 0
+    )
+
+
+def encode_chunk(transfer_id, index, flags=0, data=b''):
+    return CHUNK_HEADER.pack(transfer_id, index, flags) + data
+
+
+def decode_chunk(plaintext):
+    if len(plaintext) < CHUNK_HEADER.size:
+        raise ValueError("チャンクが短すぎます")
+    transfer_id, index, flags = CHUNK_HEADER.unpack_from(plaintext)
+    return transfer_id, index, flags, memoryview(plaintext)[CHUNK_HEADER.size:]
+
+
+def chunk_size_for(max_frame):
+    # サーバーが受け付けるフレームの大きさに収まるチャンクの本文の長さ
+    if not max_frame:
+        return CHUNK_SIZE
+    return max(1, min(CHUNK_SIZE, max_frame - CHUNK_OVERHEAD))
+
+
+# サーバーが中継中の転送。宛先は開始時に決めたものから増やさず、途中で参加した人には届けない
+class RelayedTransfer:
+    __slots__ = ('targets', 'size', 'received', 'next_index')
+
+    def __init__(self, targets, size):
+        self.targets = targets
+        self.size = size
+        self.received = 0
+        self.next_index = 0
+
+    def accept(self, index, length):
+        if index != self.next_index:
+            raise ValueError("チャンクの順序が不正です")
+        if self.received + length > self.size:
+            raise ValueError("宣言したサイズを超えて送られました")
+        self.next_index += 1
+        self.received += length
+
+    def complete(self):
+        return self.received == self.size
+
+
+# 送信元ごとの中継中の転送。送信元はエンジンごとの接続の識別子か、他ワーカーから届いたものは ('bus', ワーカー番号)
+class TransferTable:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = {}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(transfers) for transfers in self.owners.values())
+
+    def start(self, owner, transfer_id, targets, size):
+        with self.lock:
+            self.owners.setdefault(owner, {})[transfer_id] = transfer = RelayedTransfer(targets, size)
+        return transfer
+
+    def get(self, owner, transfer_id):
+        with self.lock:
+            return self.owners.get(owner, {}).get(transfer_id)
+
+    def count(self, owner):
+        with self.lock:
+            return len(self.owners.get(owner, ()))
+
+    def finish(self, owner, transfer_id):
+        with self.lock:
+            transfers = self.owners.get(owner)
+            if not transfers:
+                return None
+            transfer = transfers.pop(transfer_id, None)
+            if not transfers:
+                del self.owners[owner]
+            return transfer
+
+    def drop(self, owner):
+        # 送信元が切断したときに、中継途中の転送をまとめて取り除く
+        with self.lock:
+            return list(self.owners.pop(owner, {}).items())
+
+
+# 受信側で組み立て中の転送。SPOOL_BYTESまではメモリに置き、超えた分は一時ファイルに書き出す
+class IncomingTransfer:
+    def __init__(self, spool_bytes=SPOOL_BYTES):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+        self.next_index = 0
+        self.size = 0
+
+    def write(self, index, data):
+        if index != self.next_index:
+            raise ValueError("チャンクが欠けています")
+        self.file.write(data)
+        self.next_index += 1
+        self.size += len(data)
+
+    def complete(self):
+        self.file.seek(0)
+        return self.file
+
+    def discard(self):
+        self.file.close()
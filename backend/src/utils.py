@@ -1,40 +1,140 @@
-import json
+import asyncio
+import collections
+import functools
+import io
+import os
 from pathlib import Path
 import pickle
+import selectors
 import socket
 import struct
-import random
 import hashlib
+import threading
 
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
 from py_ecc.secp256k1 import secp256k1
 
+try:
+    from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+    ec = None
+
 ROOT_DIR = Path(__file__).resolve().parent.parent
 KEY_STORAGE_DIR = ROOT_DIR / 'key_storage'
 KEY_STORAGE_DIR.mkdir(exist_ok=True)
 G = secp256k1.G
 N = secp256k1.N
+ECDH_WINDOW = 4
+SHARED_KEY_CACHE_SIZE = int(os.getenv('SHARED_KEY_CACHE_SIZE', '4096'))
+
+# 固定基点（主にG）用のウィンドウテーブル。rows[i][d] = d * 2^(ECDH_WINDOW*i) * base
+class FixedBaseTable:
+    def __init__(self, base, width=ECDH_WINDOW):
+        self.width = width
+        self.rows = []
+        point = secp256k1.to_jacobian(base)
+        for _ in range((N.bit_length() + width - 1) // width):
+            row = [(0, 0, 1), point]
+            for _ in range(2, 1 << width):
+                row.append(secp256k1.jacobian_add(row[-1], point))
+            self.rows.append(row)
+            point = secp256k1.jacobian_add(row[-1], point)
+
+    def multiply(self, scalar):
+        # 倍算なしで、ウィンドウごとの加算だけで済む
+        acc = (0, 0, 1)
+        scalar %= N
+        mask = (1 << self.width) - 1
+        for row in self.rows:
+            digit = scalar & mask
+            if digit:
+                acc = secp256k1.jacobian_add(acc, row[digit])
+            scalar >>= self.width
+        return secp256k1.from_jacobian(acc)
+
+@functools.lru_cache(maxsize=64)
+def scalar_window_digits(scalar, width=ECDH_WINDOW):
+    # 長期間使う秘密鍵（SERVER_SKなど）のウィンドウ分解は一度だけ行う
+    digits = []
+    scalar %= N
+    while scalar:
+        digits.append(scalar & ((1 << width) - 1))
+        scalar >>= width
+    return tuple(reversed(digits))
+
+class PyEccBackend:
+    name = 'py_ecc'
+
+    def __init__(self):
+        self.base_table = None
+
+    def prepare_private_key(self, private_key):
+        scalar_window_digits(private_key)
+
+    def public_key(self, private_key):
+        if self.base_table is None:
+            self.base_table = FixedBaseTable(G)
+        return self.base_table.multiply(private_key)
+
+    def shared_x(self, private_key, public_key):
+        point = secp256k1.to_jacobian(tuple(public_key))
+        table = [(0, 0, 1), point]
+        for _ in range(2, 1 << ECDH_WINDOW):
+            table.append(secp256k1.jacobian_add(table[-1], point))
+
+        acc = (0, 0, 1)
+        for digit in scalar_window_digits(private_key):
+            for _ in range(ECDH_WINDOW):
+                acc = secp256k1.jacobian_double(acc)
+            if digit:
+                acc = secp256k1.jacobian_add(acc, table[digit])
+        return secp256k1.from_jacobian(acc)[0]
+
+class CryptographyBackend:
+    name = 'cryptography'
+
+    def __init__(self):
+        self.curve = ec.SECP256K1()
+        self.load_private_key = functools.lru_cache(maxsize=64)(self._load_private_key)
+
+    def _load_private_key(self, private_key):
+        return ec.derive_private_key(private_key, self.curve)
+
+    def prepare_private_key(self, private_key):
+        self.load_private_key(private_key)
+
+    def public_key(self, private_key):
+        numbers = self.load_private_key(private_key).public_key().public_numbers()
+        return (numbers.x, numbers.y)
+
+    def shared_x(self, private_key, public_key):
+        x, y = public_key
+        peer_key = ec.EllipticCurvePublicNumbers(x, y, self.curve).public_key()
+        shared = self.load_private_key(private_key).exchange(ec.ECDH(), peer_key)
+        return int.from_bytes(shared, 'big')
+
+ECDH_BACKENDS = {'py_ecc': PyEccBackend}
+if ec is not None:
+    ECDH_BACKENDS['cryptography'] = CryptographyBackend
 
-def generate_keys(filename):
-    pk_name = KEY_STORAGE_DIR / f"{filename}.pk.json"
-    sk_name = KEY_STORAGE_DIR / f"{filename}.sk.json"
+def get_ecdh_backend(name='auto'):
+    if name == 'auto':
+        name = 'cryptography' if 'cryptography' in ECDH_BACKENDS else 'py_ecc'
+    if name not in ECDH_BACKENDS:
+        raise ValueError(f"利用できないECDHバックエンドです: {name}")
+    return ECDH_BACKENDS[name]()
 
-    if sk_name.exists():
-        with open(sk_name, "r") as f:
-            private_key = json.load(f)
-        with open(pk_name, "r") as f:
-            public_key = json.load(f)
-    else:
-        private_key = random.randint(1, N - 1)
-        public_key = multiply(private_key)
+ecdh_backend = get_ecdh_backend(os.getenv('ECDH_BACKEND', 'auto'))
 
-        with open(pk_name, 'w') as f:
-            json.dump(public_key, f)
-        with open(sk_name, 'w') as f:
-            json.dump(private_key, f)
+def set_ecdh_backend(name):
+    global ecdh_backend
+    ecdh_backend = get_ecdh_backend(name)
+    shared_key_cache.clear()
+    return ecdh_backend
 
-    return private_key, public_key
+def prepare_private_key(private_key):
+    ecdh_backend.prepare_private_key(private_key)
 
 def aes_encrypt(message, key):
     if isinstance(message, str):
@@ -46,55 +146,268 @@ def aes_encrypt(message, key):
     ciphertext = aes.encrypt(message)
     return ciphertext
 
-def aes_decrypt(ciphertext, key):
+def aes_decrypt_bytes(ciphertext, key):
     ctr = Counter.new(128)
     aes = AES.new(key, AES.MODE_CTR, counter=ctr)
 
-    decrypted_message = aes.decrypt(ciphertext)
-    return decrypted_message.decode('utf-8')
+    return aes.decrypt(ciphertext)
 
-def recvall(sock, length):
-    data = b''
-    while len(data) < length:
-        packet = sock.recv(length - len(data))
-        if not packet:
-            return None
-        data += packet
-    return data
+def aes_decrypt(ciphertext, key):
+    return aes_decrypt_bytes(ciphertext, key).decode('utf-8')
 
-def send_data(conn, data):
-    serialized_data = pickle.dumps(data)
-    data_length = struct.pack('!I', len(serialized_data))
-    conn.sendall(data_length)
-    conn.sendall(serialized_data)
+# 相手から受け取るpickleは組み込みのコンテナ・数値・文字列・バイト列だけを許可する
+class SafeUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"許可されていない型です: {module}.{name}")
+
+def safe_loads(data):
+    return SafeUnpickler(io.BytesIO(data)).load()
+
+# 受信する1フレームの上限。長さフィールドをそのまま信じて巨大なバッファを確保しないようにする
+DEFAULT_MAX_FRAME = 16 * 1024 * 1024
+
+class FrameTooLarge(ValueError):
+    pass
+
+def check_frame_size(length, max_size):
+    if max_size is not None and length > max_size:
+        raise FrameTooLarge(f"フレームが大きすぎます ({length} > {max_size} バイト)")
 
 def recvall(sock, length):
-    data = b''
-    while len(data) < length:
-        packet = sock.recv(length - len(data))
-        if not packet:
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        packet_length = sock.recv_into(view[received:])
+        if not packet_length:
             return None
-        data += packet
+        received += packet_length
     return data
 
-def receive_data(sock):
+def send_data(conn, data):
+    conn.sendall(pack_data(data))
+
+def receive_data(sock, max_size=DEFAULT_MAX_FRAME):
     raw_data_length = recvall(sock, 4)
     if not raw_data_length:
         return None
 
     data_length = struct.unpack('!I', raw_data_length)[0]
+    check_frame_size(data_length, max_size)
     serialized_data = recvall(sock, data_length)
-    data = pickle.loads(serialized_data)
+    if serialized_data is None:
+        return None
+    data = safe_loads(serialized_data)
 
     return data
 
+# 鍵交換で合意した後に使うバイナリフレーム。ヘッダは種別1バイト + 長さ4バイトで、
+# 本文は暗号文をそのまま載せる。旧クライアントとはpickle形式(FRAMING_LEGACY)のまま通信する
+FRAMING_LEGACY = 0
+FRAMING_BINARY = 1
+SUPPORTED_FRAMINGS = (FRAMING_BINARY,)
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_DATA = 1
+FRAME_GROUP_KEY = 2
+FRAME_GROUP_DATA = 3
+FRAME_BATCH = 4
+FRAME_PING = 5
+FRAME_PONG = 6
+FRAME_CHUNK = 7
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+def negotiate_framing(offered):
+    if isinstance(offered, int) and offered in SUPPORTED_FRAMINGS:
+        return offered
+    return FRAMING_LEGACY
+
+def encode_frame(payload, framing=FRAMING_LEGACY, frame_type=FRAME_DATA):
+    if framing == FRAMING_LEGACY:
+        return [pack_data(payload)]
+    return [FRAME_HEADER.pack(frame_type, len(payload)), payload]
+
+def send_buffers(sock, buffers):
+    # ヘッダと本文を連結せずsendmsg(writev)1回で送り、部分送信の残りだけ再送する。戻り値は送信システムコールの回数
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return 1
+    # ping/pongのような本文の無いフレームの空バッファは残すと送信が進まなくなるので除く
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    calls = 0
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        calls += 1
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+    return calls
+
+def frame_size(frame):
+    return sum(len(buffer) for buffer in frame)
+
+def encode_batch(frames):
+    # 同じ宛先の複数フレームを1つのバッチフレームに入れる。中身は通常のフレームの連続
+    buffers = [buffer for frame in frames for buffer in frame]
+    return [FRAME_HEADER.pack(FRAME_BATCH, sum(len(buffer) for buffer in buffers))] + buffers
+
+def iter_batch(payload):
+    offset = 0
+    while offset < len(payload):
+        frame_type, length = FRAME_HEADER.unpack_from(payload, offset)
+        offset += FRAME_HEADER.size
+        yield frame_type, payload[offset:offset + length]
+        offset += length
+
+def send_frame(sock, payload, framing=FRAMING_LEGACY, frame_type=FRAME_DATA):
+    send_buffers(sock, encode_frame(payload, framing, frame_type))
+
+# 接続ごとに1つ持ち、受信バッファを使い回す。返すmemoryviewは次の読み込みまで有効
+class FrameReader:
+    def __init__(self, sock, framing=FRAMING_LEGACY, buffer_size=65536, max_size=DEFAULT_MAX_FRAME):
+        self.sock = sock
+        self.framing = framing
+        self.max_size = max_size
+        self.header = bytearray(FRAME_HEADER.size)
+        self.buffer = bytearray(buffer_size)
+        self.selector = None
+
+    def wait_readable(self, timeout):
+        # 待つのはフレームの境目だけにして、途中まで読んだところでタイムアウトしないようにする
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.sock, selectors.EVENT_READ)
+        return bool(self.selector.select(timeout))
+
+    def close(self):
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+
+    def fill(self, view):
+        received = 0
+        while received < len(view):
+            packet_length = self.sock.recv_into(view[received:])
+            if not packet_length:
+                return False
+            received += packet_length
+        return True
+
+    def read_frame(self):
+        if not self.fill(memoryview(self.header)):
+            return None
+        frame_type, length = FRAME_HEADER.unpack(self.header)
+        check_frame_size(length, self.max_size)
+        # 使い回すバッファより大きいフレームはその場限りのバッファで受け、接続ごとのメモリを設定した大きさに保つ
+        buffer = self.buffer if length <= len(self.buffer) else bytearray(length)
+        view = memoryview(buffer)[:length]
+        if not self.fill(view):
+            return None
+        return frame_type, view
+
+    def next_frame(self):
+        # pickle形式では種別が無いので、常に通常のデータフレームとして扱う
+        if self.framing == FRAMING_LEGACY:
+            data = receive_data(self.sock, self.max_size)
+            return None if data is None else (FRAME_DATA, data)
+        return self.read_frame()
+
+def pack_data(data):
+    serialized_data = pickle.dumps(data)
+    return struct.pack('!I', len(serialized_data)) + serialized_data
+
+async def async_send_data(writer, data):
+    writer.write(pack_data(data))
+    await writer.drain()
+
+async def async_receive_data(reader, max_size=DEFAULT_MAX_FRAME):
+    try:
+        raw_data_length = await reader.readexactly(4)
+        data_length = struct.unpack('!I', raw_data_length)[0]
+        check_frame_size(data_length, max_size)
+        serialized_data = await reader.readexactly(data_length)
+    except asyncio.IncompleteReadError:
+        return None
+
+    return safe_loads(serialized_data)
+
+async def async_read_frame(reader, max_size=DEFAULT_MAX_FRAME):
+    try:
+        frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        check_frame_size(length, max_size)
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return frame_type, payload
+
+async def async_next_frame(reader, framing=FRAMING_LEGACY, max_size=DEFAULT_MAX_FRAME):
+    if framing == FRAMING_LEGACY:
+        data = await async_receive_data(reader, max_size)
+        return None if data is None else (FRAME_DATA, data)
+    return await async_read_frame(reader, max_size)
+
+def enable_keepalive(sock, idle):
+    # ハートビートに応じない旧クライアントでも、相手が消えた接続はカーネルに検出させる
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(idle) // 3))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
 def get_local_ip():
     print(socket.gethostbyname(socket.gethostname()))
     return socket.gethostbyname(socket.gethostname())
 
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+shared_key_cache = LRUCache(SHARED_KEY_CACHE_SIZE)
+
+def derive_shared_key(private_key, public_key):
+    shared_x = ecdh_backend.shared_x(private_key, tuple(public_key))
+    return hashlib.sha256(str(shared_x).encode()).digest()
+
+def cached_shared_key(private_key, public_key):
+    return shared_key_cache.get((private_key, tuple(public_key)))
+
 def generate_shared_key(private_key, public_key):
-    shared_secret = secp256k1.multiply(public_key, private_key)
-    return hashlib.sha256(str(shared_secret[0]).encode()).digest()
+    # 同じ公開鍵からの再接続では導出済みの鍵を再利用する
+    cache_key = (private_key, tuple(public_key))
+    shared_key = shared_key_cache.get(cache_key)
+    if shared_key is None:
+        shared_key = derive_shared_key(private_key, public_key)
+        shared_key_cache.put(cache_key, shared_key)
+    return shared_key
 
 def is_valid_public_key(public_key):
     if not isinstance(public_key, tuple) or len(public_key) != 2:
@@ -108,6 +421,5 @@ def add_public_keys(pk1, pk2):
     return secp256k1.add(pk1, pk2)
 
 def multiply(scalar):
-    point = G
-    return secp256k1.multiply(point, scalar)
+    return ecdh_backend.public_key(scalar)
 
@@ -0,0 +1,177 @@
+import collections
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from .utils import pack_data, recvall, receive_data, safe_loads
+
+# ハブがワーカー1つ分に溜めておける未送信のバイト数。超えたワーカーは読み出しが止まっているとみなしてバスから外す
+HUB_QUEUE_BYTES = 64 * 1024 * 1024
+
+
+# ハブからワーカー1つへの送信。遅いワーカーが他のワーカーへの中継を止めないよう、ワーカーごとにキューと送信スレッドを持つ
+class WorkerOutbox:
+    def __init__(self, sock, max_bytes=HUB_QUEUE_BYTES):
+        self.sock = sock
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()
+        self.size = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, frame):
+        # 上限を超えたらFalseを返す（呼び出し側がこのワーカーを外す）
+        with self.condition:
+            if self.closed or self.size + len(frame) > self.max_bytes:
+                return False
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.condition.notify()
+            return True
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.frames and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    frames = list(self.frames)
+                    self.frames.clear()
+                    self.size = 0
+                # 溜まっていた分はまとめて1回で書き込む
+                self.sock.sendall(b''.join(frames))
+        except OSError:
+            # 切断するとハブの受信側がそれを検出して登録を外すので、それまで待つ
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            with self.condition:
+                while not self.closed:
+                    self.condition.wait()
+        # 送信中に別のスレッドから閉じないよう、ソケットはこのスレッドで閉じる
+        self.sock.close()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify()
+
+
+# 親プロセス側のハブ。あるワーカーから届いたフレームを他の全ワーカーへそのまま中継する。
+# チャットのメッセージにはここで全ワーカー共通の連番を振り、送信元を含む全ワーカーへ同じ順序で送る
+class BusHub:
+    def __init__(self, worker_socks):
+        self.worker_socks = list(worker_socks)
+        self.selector = selectors.DefaultSelector()
+        self.running = True
+        self.last_seq = 0
+        self.outboxes = {}
+        for sock in self.worker_socks:
+            self.selector.register(sock, selectors.EVENT_READ)
+            self.outboxes[sock] = WorkerOutbox(sock)
+
+    def serve(self):
+        while self.running and self.worker_socks:
+            for key, _ in self.selector.select(timeout=1.0):
+                sock = key.fileobj
+                frame = self.read_frame(sock)
+                if frame is None:
+                    self.unregister(sock)
+                    continue
+                self.route(sock, frame)
+
+    def next_seq(self):
+        # マイクロ秒の時刻を単調増加にそろえた値。ハブは1スレッドなので、振った順がそのまま配る順になる
+        self.last_seq = max(self.last_seq + 1, time.time_ns() // 1000)
+        return self.last_seq
+
+    def route(self, sock, frame):
+        data = safe_loads(frame[4:])
+        if data.get("body") is not None:
+            data["seq"] = self.next_seq()
+            frame = pack_data(data)
+            sock = None
+        for other in list(self.worker_socks):
+            if other is not sock and not self.outboxes[other].put(frame):
+                self.unregister(other)
+
+    def read_frame(self, sock):
+        try:
+            header = recvall(sock, 4)
+            if not header:
+                return None
+            body = recvall(sock, struct.unpack('!I', header)[0])
+            if body is None:
+                return None
+            return header + body
+        except OSError:
+            return None
+
+    def unregister(self, sock):
+        if sock in self.worker_socks:
+            self.worker_socks.remove(sock)
+            self.selector.unregister(sock)
+            self.outboxes.pop(sock).close()
+            # 送信スレッドが書き込み中でも抜けられるよう切断だけして、閉じるのは送信スレッドに任せる
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.running = False
+        for sock in list(self.worker_socks):
+            self.unregister(sock)
+
+
+# ワーカー側（スレッドエンジン）の接続。publishは複数のクライアントスレッドから呼ばれる
+class WorkerBus:
+    def __init__(self, sock, worker_id):
+        self.sock = sock
+        self.worker_id = worker_id
+        self.send_lock = threading.Lock()
+        self.listen_thread = None
+
+    def publish(self, message, presence=False, seq=None, room=None, to=None, transfer=None, body=None):
+        # bodyを渡したものは、ハブが連番を振ってから送信元にも送り返す
+        frame = pack_data({
+            "origin": self.worker_id, "message": message, "presence": presence, "seq": seq, "room": room, "to": to,
+            "transfer": transfer, "body": body
+        })
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def publish_chunk(self, chunk):
+        # 分割転送のチャンクは復号した平文のまま流し、受け取ったワーカーが宛先ごとに暗号化する
+        frame = pack_data({"origin": self.worker_id, "chunk": chunk})
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    def listen(self, callback):
+        def run():
+            while True:
+                try:
+                    data = receive_data(self.sock)
+                except OSError:
+                    break
+                if data is None:
+                    break
+                callback(data)
+
+        self.listen_thread = threading.Thread(target=run, daemon=True)
+        self.listen_thread.start()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
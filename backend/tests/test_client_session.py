@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import unittest
+
+from backend.src.client_session import AsyncSendQueue, SendQueue, SlowConsumerError
+
+
+def frame(n):
+    return [b"frame%d" % n]
+
+
+class SendQueueTests(unittest.TestCase):
+    def test_drop_oldest_keeps_newest_frames(self):
+        queue = SendQueue(3, 'drop_oldest')
+        for n in range(5):
+            queue.put(frame(n))
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual([queue.get() for _ in range(3)], [frame(2), frame(3), frame(4)])
+
+    def test_disconnect_raises_when_full(self):
+        queue = SendQueue(2, 'disconnect')
+        queue.put(frame(0))
+        queue.put(frame(1))
+        with self.assertRaises(SlowConsumerError):
+            queue.put(frame(2))
+        # 満杯になるまでに積んだものは失われない
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_block_times_out(self):
+        queue = SendQueue(1, 'block', timeout=0.05)
+        queue.put(frame(0))
+        with self.assertRaises(SlowConsumerError):
+            queue.put(frame(1))
+
+    def test_block_waits_for_consumer(self):
+        queue = SendQueue(1, 'block', timeout=5)
+        queue.put(frame(0))
+        consumer = threading.Timer(0.05, queue.get)
+        consumer.start()
+        queue.put(frame(1))
+        consumer.join()
+        self.assertEqual(queue.get(), frame(1))
+
+    def test_closed_queue_rejects_frames(self):
+        queue = SendQueue(2, 'drop_oldest')
+        queue.put(frame(0))
+        queue.close()
+        self.assertIsNone(queue.get())
+        with self.assertRaises(SlowConsumerError):
+            queue.put(frame(1))
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SendQueue(1, 'ignore')
+
+
+class AsyncSendQueueTests(unittest.TestCase):
+    def test_drop_oldest_keeps_newest_frames(self):
+        async def run():
+            queue = AsyncSendQueue(3, 'drop_oldest')
+            for n in range(5):
+                self.assertTrue(queue.put_nowait(frame(n)))
+            self.assertEqual(queue.dropped, 2)
+            return await queue.get_batch(10, 1 << 20)
+        self.assertEqual(asyncio.run(run()), [frame(2), frame(3), frame(4)])
+
+    def test_disconnect_raises_when_full(self):
+        async def run():
+            queue = AsyncSendQueue(2, 'disconnect')
+            queue.put_nowait(frame(0))
+            queue.put_nowait(frame(1))
+            with self.assertRaises(SlowConsumerError):
+                queue.put_nowait(frame(2))
+            self.assertEqual(len(queue), 2)
+        asyncio.run(run())
+
+    def test_block_times_out(self):
+        async def run():
+            queue = AsyncSendQueue(1, 'block', timeout=0.05)
+            await queue.put(frame(0))
+            self.assertFalse(queue.put_nowait(frame(1)))
+            with self.assertRaises(SlowConsumerError):
+                await queue.put(frame(1))
+        asyncio.run(run())
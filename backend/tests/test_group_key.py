@@ -0,0 +1,80 @@
+import os
+import unittest
+
+from backend.src.group_key import RETAINED_GROUP_KEYS, GroupKeyring, GroupKeyStore
+from backend.src.session_cipher import SessionCipher, new_salt
+
+
+def payload(frame):
+    # encode_frameの戻り値はヘッダと本文のバッファ
+    return frame[1]
+
+
+class Member:
+    # 1クライアント分の接続ごとの暗号（サーバー側とクライアント側）と受け取ったグループ鍵
+    def __init__(self):
+        shared_key, server_salt, client_salt = os.urandom(32), new_salt(), new_salt()
+        self.server_cipher = SessionCipher(shared_key, server_salt, client_salt, True)
+        self.client_cipher = SessionCipher(shared_key, server_salt, client_salt, False)
+        self.keys = GroupKeyStore()
+
+    def receive_key(self, group_key):
+        self.keys.store(payload(group_key.wrap_frame(self.server_cipher)), self.client_cipher)
+
+    def read(self, frame):
+        return self.keys.decrypt(payload(frame))
+
+
+class GroupKeyRotationTests(unittest.TestCase):
+    def setUp(self):
+        self.keyring = GroupKeyring()
+        self.alice = Member()
+        self.bob = Member()
+
+    def rotate(self, members):
+        # サーバーと同じく、全員に配布してから切り替える
+        group_key = self.keyring.next_key()
+        for member in members:
+            member.receive_key(group_key)
+        self.keyring.activate(group_key)
+        return group_key
+
+    def test_next_key_is_not_used_until_activated(self):
+        first = self.rotate([self.alice])
+        pending = self.keyring.next_key()
+        self.assertIs(self.keyring.current, first)
+        self.assertGreater(pending.key_id, first.key_id)
+        self.keyring.activate(pending)
+        self.assertIs(self.keyring.current, pending)
+
+    def test_frames_before_activation_use_previous_key(self):
+        self.rotate([self.alice, self.bob])
+        pending = self.keyring.next_key()
+        # 配布を積んでいる間の配信は旧鍵のまま。新しい鍵をまだ受け取っていない相手も読める
+        before = self.keyring.current.encrypt_frame("before")
+        self.alice.receive_key(pending)
+        self.assertEqual(self.bob.read(before), "before")
+        self.bob.receive_key(pending)
+        self.keyring.activate(pending)
+        after = self.keyring.current.encrypt_frame("after")
+        self.assertEqual(self.alice.read(after), "after")
+        self.assertEqual(self.bob.read(after), "after")
+
+    def test_departed_member_cannot_read_after_rotation(self):
+        self.rotate([self.alice, self.bob])
+        self.rotate([self.alice])
+        frame = self.keyring.current.encrypt_frame("secret")
+        self.assertEqual(self.alice.read(frame), "secret")
+        with self.assertRaises(KeyError):
+            self.bob.read(frame)
+
+    def test_recent_keys_are_retained(self):
+        old = self.rotate([self.alice])
+        late = old.encrypt_frame("late")
+        for _ in range(RETAINED_GROUP_KEYS - 1):
+            self.rotate([self.alice])
+        # ローテーション直後に旧鍵で届いたフレームも復号できる
+        self.assertEqual(self.alice.read(late), "late")
+        self.rotate([self.alice])
+        with self.assertRaises(KeyError):
+            self.alice.read(old.encrypt_frame("too late"))
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from backend.src.message_log import INDEX_SUFFIX, RECORD_HEADER, SEGMENT_SUFFIX, MessageLog
+
+
+class MessageLogRecoveryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.directory = self.tmp.name
+
+    def open_log(self, **kwargs):
+        log = MessageLog(self.directory, fsync='never', **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def write(self, count, **kwargs):
+        log = self.open_log(**kwargs)
+        for seq in range(1, count + 1):
+            log.append(seq, f"m{seq}")
+        log.close()
+
+    def segment_files(self, suffix=SEGMENT_SUFFIX):
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def test_reopen_keeps_records(self):
+        self.write(10, index_interval=4)
+        log = self.open_log(index_interval=4)
+        self.assertEqual(len(log), 10)
+        self.assertEqual(log.max_seq, 10)
+        self.assertEqual(list(log.read_after(6)), ["m7", "m8", "m9", "m10"])
+
+    def test_truncates_partial_record(self):
+        self.write(5)
+        path = self.segment_files()[-1]
+        with open(path, 'ab') as f:
+            f.write(RECORD_HEADER.pack(6, 100, 0) + b"half")
+        log = self.open_log()
+        self.assertEqual(len(log), 5)
+        self.assertEqual(os.path.getsize(path), sum(RECORD_HEADER.size + len(f"m{seq}") for seq in range(1, 6)))
+        # 切り詰めた位置から追記を続けられる
+        log.append(6, "m6")
+        self.assertEqual(list(log.read_after(4)), ["m5", "m6"])
+
+    def test_truncates_record_with_bad_checksum(self):
+        self.write(5)
+        path = self.segment_files()[-1]
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"X")
+        log = self.open_log()
+        self.assertEqual(len(log), 4)
+        self.assertEqual(log.max_seq, 4)
+        self.assertEqual(list(log.read_last(10)), ["m1", "m2", "m3", "m4"])
+
+    def test_rebuilds_missing_index(self):
+        self.write(20, index_interval=4)
+        for path in self.segment_files(INDEX_SUFFIX):
+            os.unlink(path)
+        log = self.open_log(index_interval=4)
+        self.assertEqual(len(log), 20)
+        self.assertEqual(len(log.segments[-1].index), 5)
+        self.assertEqual(list(log.read_after(17)), ["m18", "m19", "m20"])
+
+    def test_recovers_across_segments(self):
+        self.write(30, segment_bytes=64, index_interval=2)
+        segments = self.segment_files()
+        self.assertGreater(len(segments), 2)
+        # 最後のセグメントが丸ごと壊れていたら削除し、1つ前のセグメントから続ける
+        with open(segments[-1], 'r+b') as f:
+            f.write(b"\xff" * RECORD_HEADER.size)
+        log = self.open_log(segment_bytes=64, index_interval=2)
+        self.assertEqual(self.segment_files(), segments[:-1])
+        last = len(log)
+        self.assertLess(last, 30)
+        self.assertEqual(log.max_seq, last)
+        self.assertEqual(list(log.read_last(3)), [f"m{seq}" for seq in range(last - 2, last + 1)])
+        log.append(last + 1, "next")
+        self.assertEqual(list(log.read_after(last)), ["next"])
+
+    def test_rejects_second_writer(self):
+        self.open_log()
+        with self.assertRaises(RuntimeError):
+            MessageLog(self.directory, fsync='never')
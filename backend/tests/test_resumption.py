@@ -0,0 +1,55 @@
+import os
+import unittest
+from unittest import mock
+
+from backend.src.resumption import TicketCache, resumption_secret
+
+PUBLIC_KEY = (1, 2)
+
+
+class TicketCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('backend.src.resumption.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shared_key = os.urandom(32)
+
+    def test_redeems_before_expiry(self):
+        tickets = TicketCache(ttl=60)
+        ticket = tickets.issue(self.shared_key, PUBLIC_KEY)
+        self.now += 59
+        self.assertEqual(tickets.redeem(ticket, PUBLIC_KEY), resumption_secret(self.shared_key, ticket))
+        self.assertEqual(tickets.stats()["resumed"], 1)
+
+    def test_rejects_expired_ticket(self):
+        tickets = TicketCache(ttl=60)
+        ticket = tickets.issue(self.shared_key, PUBLIC_KEY)
+        self.now += 60
+        self.assertIsNone(tickets.redeem(ticket, PUBLIC_KEY))
+        # 期限切れのチケットも取り出した時点で捨てる
+        self.assertEqual(tickets.stats(), {"issued": 1, "resumed": 0, "missed": 1, "cached": 0})
+
+    def test_ticket_is_single_use(self):
+        tickets = TicketCache(ttl=60)
+        ticket = tickets.issue(self.shared_key, PUBLIC_KEY)
+        self.assertIsNotNone(tickets.redeem(ticket, PUBLIC_KEY))
+        self.assertIsNone(tickets.redeem(ticket, PUBLIC_KEY))
+
+    def test_rejects_other_public_key(self):
+        tickets = TicketCache(ttl=60)
+        ticket = tickets.issue(self.shared_key, PUBLIC_KEY)
+        self.assertIsNone(tickets.redeem(ticket, (3, 4)))
+        # 別の鍵での提示でチケットは消費される
+        self.assertIsNone(tickets.redeem(ticket, PUBLIC_KEY))
+
+    def test_evicts_least_recent_beyond_maxsize(self):
+        tickets = TicketCache(ttl=60, maxsize=2)
+        first, second, third = [tickets.issue(self.shared_key, PUBLIC_KEY) for _ in range(3)]
+        self.assertIsNone(tickets.redeem(first, PUBLIC_KEY))
+        self.assertIsNotNone(tickets.redeem(second, PUBLIC_KEY))
+        self.assertIsNotNone(tickets.redeem(third, PUBLIC_KEY))
+
+    def test_ignores_malformed_ticket(self):
+        tickets = TicketCache(ttl=60)
+        self.assertIsNone(tickets.redeem("not bytes", PUBLIC_KEY))
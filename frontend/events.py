@@ -0,0 +1,62 @@
+import asyncio
+import threading
+
+KEEPALIVE_SECONDS = 15
+LONG_POLL_SECONDS = 25
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(True)
+
+
+# ChatManagerのコールバック（受信スレッド）から呼ばれ、待機中のストリームを起こす。
+# 中身は持たず版数だけを進めるので、読み出しは常にChatManager側から行う
+class ChatEvents:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.peer_version = 0
+        self.closed = False
+        self.waiters = set()
+
+    def notify(self, peers=False):
+        with self.condition:
+            self.version += 1
+            if peers:
+                self.peer_version += 1
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def notify_messages(self, message=None):
+        self.notify()
+
+    def notify_peers(self, peer_info=None):
+        self.notify(peers=True)
+
+    def close(self):
+        self.closed = True
+        self.notify()
+
+    def wait(self, version, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version or self.closed, timeout)
+            return self.version
+
+    async def wait_async(self, version, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.condition:
+            if self.version != version or self.closed:
+                return self.version
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                self.waiters.discard(waiter)
+        return self.version
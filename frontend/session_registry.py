@@ -0,0 +1,133 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from backend.src.connection_manager import ConnectionManager
+from backend.src.chat_manager import ChatManager
+from .events import ChatEvents
+
+SESSION_COOKIE = 'chat_session'
+
+
+class SessionLimitExceeded(Exception):
+    pass
+
+
+# ブラウザ1つ分のチャット接続。接続・送信・切断はlockで直列化する
+class ChatSession:
+    def __init__(self, key, max_messages):
+        self.key = key
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+        self.connection_manager = None
+        self.chat_manager = None
+        self.events = None
+        self.endpoint = None
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def is_connected(self):
+        return bool(self.chat_manager and self.connection_manager.is_connected)
+
+    def connect(self, nickname, secret_key, ip_address, port):
+        endpoint = (nickname, ip_address, str(port))
+        if endpoint == self.endpoint and self.is_connected():
+            # 同じ接続先への再送信（リロードなど）は確立済みの接続をそのまま使う
+            return
+        self.close()
+
+        connection_manager = ConnectionManager()
+        try:
+            connection_manager.get_or_generate_keys(nickname, secret_key)
+            connection_manager.connect_to_server(ip_address, port)
+        except Exception:
+            # 鍵交換の途中で失敗した場合もソケットと受信スレッドを残さない
+            connection_manager.close_connection()
+            raise
+
+        chat_manager = ChatManager(connection_manager, self.max_messages)
+        events = ChatEvents()
+
+        def on_message(message):
+            print(f"受信したメッセージ: {message}")
+            events.notify_messages(message)
+
+        chat_manager.set_message_callback(on_message)
+        chat_manager.set_peer_info_callback(events.notify_peers)
+
+        self.connection_manager = connection_manager
+        self.chat_manager = chat_manager
+        self.events = events
+        self.endpoint = endpoint
+
+    def close(self):
+        if self.chat_manager:
+            self.chat_manager.disconnect()
+        if self.events:
+            self.events.close()
+        self.chat_manager = None
+        self.events = None
+        self.endpoint = None
+
+
+# セッションキー（Cookie）ごとのChatSessionを保持する。最後に使われた順に並べておき、
+# 放置されたものから切断して上限を守る
+class SessionRegistry:
+    def __init__(self, max_sessions=500, idle_timeout=1800, max_messages=10000):
+        if max_messages < 1:
+            # 最初の接続で失敗するより、起動時に設定の誤りを知らせる
+            raise ValueError("CHAT_MESSAGE_RETENTION には1以上を指定してください")
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, key):
+        if not key:
+            return None
+        self.evict_idle()
+        with self.lock:
+            session = self.sessions.get(key)
+            if session:
+                session.touch()
+                self.sessions.move_to_end(key)
+            return session
+
+    def open(self, key=None):
+        session = self.get(key)
+        if session:
+            return session
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise SessionLimitExceeded("同時に利用できるセッション数の上限に達しました")
+            session = ChatSession(secrets.token_urlsafe(32), self.max_messages)
+            self.sessions[session.key] = session
+            return session
+
+    def remove(self, key):
+        with self.lock:
+            session = self.sessions.pop(key, None)
+        if session:
+            with session.lock:
+                session.close()
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        with self.lock:
+            while self.sessions:
+                key, session = next(iter(self.sessions.items()))
+                if session.last_active > deadline:
+                    break
+                expired.append(self.sessions.pop(key))
+        for session in expired:
+            print(f"放置されたセッションを切断しました: {session.endpoint}")
+            with session.lock:
+                session.close()
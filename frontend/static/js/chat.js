@@ -5,18 +5,16 @@ document.addEventListener("DOMContentLoaded", function () {
   const disconnectButton = document.getElementById("disconnect-button");
   const peerInfoContainer = document.getElementById("peer-info");
 
-  let receivedMessages = new Set();
+  let messageCursor = null;
+  let messagesEtag = null;
   let expandedCards = new Set();
-  let pollingInterval;
+  let eventSource = null;
+  let longPolling = false;
+  let peerVersion = -1;
 
   updateUserInfo();
   updatePeerInfo();
-  fetchMessages();
-
-  pollingInterval = setInterval(() => {
-    fetchMessages();
-    updatePeerInfo();
-  }, 3000);
+  fetchMessages().then(startEventStream);
 
   window.toggleCard = function (nickname) {
     const content = document.getElementById(`content-${nickname}`);
@@ -57,81 +55,155 @@ document.addEventListener("DOMContentLoaded", function () {
   function updatePeerInfo() {
     fetch("/get_peer_info/")
       .then((response) => response.json())
-      .then((data) => {
-        peerInfoContainer.innerHTML = "";
-
-        for (const [nickname, info] of Object.entries(data)) {
-          const card = document.createElement("div");
-          card.className = `peer-card ${
-            info.status === "オンライン" ? "online" : "offline"
-          }`;
-          card.id = `peer-${nickname}`;
-
-          const safeNickname = escapeHtml(nickname);
-
-          card.innerHTML = `
-            <button class="peer-card-header" onclick="toggleCard('${safeNickname}')">
-              <span class="peer-nickname">${safeNickname}</span>
-              <svg class="chevron ${
-                expandedCards.has(nickname) ? "expanded" : ""
-              }" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
-                <path d="M6 9l6 6 6-6" stroke-linecap="round" stroke-linejoin="round"/>
-              </svg>
-            </button>
-            <div class="peer-card-content ${
-              expandedCards.has(nickname) ? "expanded" : ""
-            }" id="content-${safeNickname}">
-              <p class="peer-info-item">IP: ${escapeHtml(info.ip)}</p>
-              <p class="peer-info-item">Port: ${escapeHtml(info.port)}</p>
-              <p class="peer-info-item">
-                <span class="status-badge ${
-                  info.status === "オンライン" ? "online" : "offline"
-                }">
-                  ${escapeHtml(info.status)}
-                </span>
-              </p>
-            </div>
-          `;
-
-          peerInfoContainer.appendChild(card);
-        }
-      })
+      .then(renderPeerInfo)
       .catch((error) => {
         console.error("ピア情報の更新に失敗:", error);
       });
   }
 
+  function renderPeerInfo(data) {
+    peerInfoContainer.innerHTML = "";
+
+    for (const [nickname, info] of Object.entries(data)) {
+      const card = document.createElement("div");
+      card.className = `peer-card ${
+        info.status === "オンライン" ? "online" : "offline"
+      }`;
+      card.id = `peer-${nickname}`;
+
+      const safeNickname = escapeHtml(nickname);
+
+      card.innerHTML = `
+        <button class="peer-card-header" onclick="toggleCard('${safeNickname}')">
+          <span class="peer-nickname">${safeNickname}</span>
+          <svg class="chevron ${
+            expandedCards.has(nickname) ? "expanded" : ""
+          }" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+            <path d="M6 9l6 6 6-6" stroke-linecap="round" stroke-linejoin="round"/>
+          </svg>
+        </button>
+        <div class="peer-card-content ${
+          expandedCards.has(nickname) ? "expanded" : ""
+        }" id="content-${safeNickname}">
+          <p class="peer-info-item">IP: ${escapeHtml(info.ip)}</p>
+          <p class="peer-info-item">Port: ${escapeHtml(info.port)}</p>
+          <p class="peer-info-item">
+            <span class="status-badge ${
+              info.status === "オンライン" ? "online" : "offline"
+            }">
+              ${escapeHtml(info.status)}
+            </span>
+          </p>
+        </div>
+      `;
+
+      peerInfoContainer.appendChild(card);
+    }
+  }
+
   function fetchMessages() {
-    fetch("/get_messages/")
+    const url =
+      messageCursor === null
+        ? "/get_messages/"
+        : `/get_messages/?after=${messageCursor}`;
+    const headers = {};
+    if (messageCursor !== null && messagesEtag) {
+      headers["If-None-Match"] = messagesEtag;
+    }
+
+    return fetch(url, { headers: headers, cache: "no-store" })
       .then((response) => {
+        if (response.status === 304) {
+          return null;
+        }
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
+        messagesEtag = response.headers.get("ETag");
         return response.json();
       })
       .then((data) => {
-        if (data && Array.isArray(data.messages)) {
-          const newMessages = data.messages
-            .map((msg) => {
-              return typeof msg === "string" ? JSON.parse(msg) : msg;
-            })
-            .filter(
-              (message) => !receivedMessages.has(JSON.stringify(message))
-            );
-
-          if (newMessages.length > 0) {
-            displayMessages(newMessages);
-            newMessages.forEach((message) =>
-              receivedMessages.add(JSON.stringify(message))
-            );
-          }
-        } else {
-          console.error("予期しないデータ形式:", data);
+        if (data !== null) {
+          applyMessages(data);
         }
       })
       .catch((error) => console.error("メッセージ取得エラー:", error));
   }
 
+  function applyMessages(data) {
+    if (data && Array.isArray(data.messages)) {
+      // サーバーは前回のカーソルより後ろだけを返すので、受信済みかどうかの照合は不要
+      if (data.reset) {
+        chatMessages.innerHTML = "";
+      }
+      const newMessages = data.messages.map((msg) => {
+        return typeof msg === "string" ? JSON.parse(msg) : msg;
+      });
+      if (newMessages.length > 0) {
+        displayMessages(newMessages);
+      }
+      if (typeof data.cursor === "number") {
+        messageCursor = data.cursor;
+      }
+    } else {
+      console.error("予期しないデータ形式:", data);
+    }
+  }
+
+  function startEventStream() {
+    if (!window.EventSource) {
+      startLongPolling();
+      return;
+    }
+    eventSource = new EventSource(`/events/?after=${messageCursor || 0}`);
+    eventSource.addEventListener("messages", (event) => {
+      applyMessages(JSON.parse(event.data));
+    });
+    eventSource.addEventListener("peers", (event) => {
+      renderPeerInfo(JSON.parse(event.data));
+    });
+    eventSource.onerror = () => {
+      // 一時的な切断はEventSourceが自動で再接続する。閉じられた場合だけロングポーリングに切り替える
+      if (eventSource.readyState === EventSource.CLOSED) {
+        eventSource = null;
+        startLongPolling();
+      }
+    };
+  }
+
+  function startLongPolling() {
+    longPolling = true;
+    pollEvents();
+  }
+
+  function pollEvents() {
+    if (!longPolling) {
+      return;
+    }
+    fetch(
+      `/events/?transport=poll&after=${messageCursor || 0}&peer_version=${peerVersion}`,
+      { cache: "no-store" }
+    )
+      .then((response) => {
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+      })
+      .then((data) => {
+        applyMessages(data);
+        if (data.peers) {
+          renderPeerInfo(data.peers);
+        }
+        peerVersion = data.peer_version;
+        pollEvents();
+      })
+      .catch((error) => {
+        console.error("イベント取得エラー:", error);
+        setTimeout(pollEvents, 3000);
+      });
+  }
+
   function sendMessage() {
     const message = messageInput.value.trim();
     if (message) {
@@ -147,7 +219,9 @@ document.addEventListener("DOMContentLoaded", function () {
         .then((data) => {
           if (data.status === "success") {
             messageInput.value = "";
-            fetchMessages();
+            if (!eventSource && !longPolling) {
+              fetchMessages();
+            }
           }
         });
     }
@@ -224,8 +298,9 @@ document.addEventListener("DOMContentLoaded", function () {
       .then((response) => response.json())
       .then((data) => {
         if (data.status === "success") {
-          if (pollingInterval) {
-            clearInterval(pollingInterval);
+          longPolling = false;
+          if (eventSource) {
+            eventSource.close();
           }
           window.location.href = "/";
         }
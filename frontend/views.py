@@ -1,13 +1,25 @@
+import json
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
-from backend.src.connection_manager import ConnectionManager
-from backend.src.chat_manager import ChatManager
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from .events import KEEPALIVE_SECONDS, LONG_POLL_SECONDS
+from .session_registry import SESSION_COOKIE, SessionLimitExceeded, SessionRegistry
 
-connection_manager = None
-chat_manager = None
+sessions = SessionRegistry(
+    settings.CHAT_MAX_SESSIONS,
+    settings.CHAT_SESSION_IDLE_SECONDS,
+    settings.CHAT_MESSAGE_RETENTION
+)
+
+def current_session(request):
+    # 接続済みのセッションだけを返す
+    session = sessions.get(request.COOKIES.get(SESSION_COOKIE))
+    if session and session.chat_manager:
+        return session
+    return None
 
 def connect_view(request):
-    global connection_manager, chat_manager
     if request.method == 'POST':
         nickname = request.POST.get('nickname')
         secret_key = request.POST.get('secret_key')
@@ -15,31 +27,44 @@ def connect_view(request):
         port = request.POST.get('port')
 
         try:
-            connection_manager = ConnectionManager()
-            connection_manager.get_or_generate_keys(nickname, secret_key)
-            client_address = connection_manager.connect_to_server(ip_address, port)
-
-            chat_manager = ChatManager(connection_manager)
-            chat_manager.set_message_callback(lambda message: print(f"受信したメッセージ: {message}"))
-
-            return redirect('chat')
+            session = sessions.open(request.COOKIES.get(SESSION_COOKIE))
+        except SessionLimitExceeded as e:
+            return render(request, 'connect.html', {'error_message': str(e)}, status=503)
+        try:
+            with session.lock:
+                session.connect(nickname, secret_key, ip_address, port)
         except Exception as e:
-            return render(request, 'connect.html', {'error_message': str(e)})
+            # 接続できなかったセッションは枠を空けるため破棄し、Cookieも消しておく
+            sessions.remove(session.key)
+            response = render(request, 'connect.html', {'error_message': str(e)})
+            response.delete_cookie(SESSION_COOKIE)
+            return response
+
+        response = redirect('chat')
+        response.set_cookie(SESSION_COOKIE, session.key, httponly=True, samesite='Lax')
+        return response
 
     return render(request, 'connect.html')
 
 def chat_view(request):
-    if not chat_manager:
+    if not current_session(request):
         return redirect('connect')
     return render(request, 'chat.html')
 
 def send_message(request):
-    if request.method == 'POST' and chat_manager:
+    session = current_session(request)
+    if request.method == 'POST' and session:
         message = request.POST.get('message')
+        room = request.POST.get('room') or None
+        to = request.POST.get('to') or None
         print(f"送信するメッセージ: {message}")
         try:
             formatted_message = f"{message}"
-            chat_manager.send_message(formatted_message)
+            with session.lock:
+                if to:
+                    session.chat_manager.send_direct(to, formatted_message)
+                else:
+                    session.chat_manager.send_message(formatted_message, room)
             print("メッセージが正常に送信されました")
             return JsonResponse({'status': 'success'})
         except Exception as e:
@@ -47,18 +72,136 @@ def send_message(request):
             return JsonResponse({'status': 'error', 'message': str(e)})
     return JsonResponse({'status': 'error', 'message': '無効なリクエストです'})
 
+def change_room(request):
+    session = current_session(request)
+    if request.method == 'POST' and session:
+        room = request.POST.get('room')
+        try:
+            with session.lock:
+                if request.POST.get('action') == 'leave':
+                    session.chat_manager.leave_room(room)
+                else:
+                    session.chat_manager.join_room(room)
+                rooms = sorted(session.connection_manager.rooms)
+            return JsonResponse({'status': 'success', 'rooms': rooms})
+        except Exception as e:
+            return JsonResponse({'status': 'error', 'message': str(e)})
+    return JsonResponse({'status': 'error', 'message': '無効なリクエストです'})
+
+def read_messages_after(manager, after, limit=None):
+    # 再接続などでカーソルが現在の連番より先にある場合は先頭から返し直す
+    reset = after > manager.last_seq
+    messages, cursor = manager.get_messages_after(0 if reset else after, limit)
+    return messages, cursor, reset
+
 def get_messages(request):
-    global chat_manager
-    if chat_manager:
+    session = current_session(request)
+    if session:
+        chat_manager = session.chat_manager
         limit = request.GET.get('limit')
         limit = int(limit) if limit and limit.isdigit() else None
-        messages = chat_manager.get_messages(limit)
-        return JsonResponse({"messages": messages})
-    return JsonResponse({"messages": []})
+        after = request.GET.get('after')
+        # ETagは「どのストアの何番まで」を表す。追いついているクライアントには本文を返さない
+        etag = f'"{id(chat_manager.messages)}-{chat_manager.last_seq}"'
+        if after is not None and request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        reset = False
+        if after is not None and after.isdigit():
+            messages, cursor, reset = read_messages_after(chat_manager, int(after), limit)
+        else:
+            messages = chat_manager.get_messages(limit)
+            cursor = chat_manager.last_seq
+        response = JsonResponse({"messages": messages, "cursor": cursor, "reset": reset})
+        if cursor == chat_manager.last_seq:
+            response['ETag'] = f'"{id(chat_manager.messages)}-{cursor}"'
+        response['Cache-Control'] = 'no-cache'
+        return response
+    return JsonResponse({"messages": [], "cursor": 0})
+
+def collect_events(manager, after, peer_version, events):
+    messages, cursor, reset = read_messages_after(manager, after)
+    payload = {"messages": messages, "cursor": cursor, "reset": reset}
+    if events.peer_version != peer_version:
+        payload["peers"] = dict(manager.peer_info)
+        payload["peer_version"] = events.peer_version
+    return payload
+
+def format_event(payload):
+    # SSEのidはカーソルにしておき、再接続時のLast-Event-IDから続きを送る
+    chunks = []
+    if payload["messages"] or payload["reset"]:
+        data = {key: payload[key] for key in ("messages", "cursor", "reset")}
+        chunks.append(f"id: {payload['cursor']}\nevent: messages\ndata: {json.dumps(data)}\n\n")
+    if "peers" in payload:
+        chunks.append(f"event: peers\ndata: {json.dumps(payload['peers'])}\n\n")
+    return "".join(chunks)
+
+def event_stream(session, after):
+    manager, events = session.chat_manager, session.events
+    peer_version = -1
+    while manager is session.chat_manager and not events.closed:
+        sessions.get(session.key)
+        version = events.version
+        payload = collect_events(manager, after, peer_version, events)
+        after, peer_version = payload["cursor"], payload.get("peer_version", peer_version)
+        yield format_event(payload) or ": keepalive\n\n"
+        events.wait(version, KEEPALIVE_SECONDS)
+
+async def event_stream_async(session, after):
+    manager, events = session.chat_manager, session.events
+    peer_version = -1
+    while manager is session.chat_manager and not events.closed:
+        # 開いているストリームはセッションの利用中として扱う
+        sessions.get(session.key)
+        version = events.version
+        payload = collect_events(manager, after, peer_version, events)
+        after, peer_version = payload["cursor"], payload.get("peer_version", peer_version)
+        yield format_event(payload) or ": keepalive\n\n"
+        await events.wait_async(version, KEEPALIVE_SECONDS)
+
+def query_int(request, name, default):
+    value = request.GET.get(name, '')
+    return int(value) if value.lstrip('-').isdigit() else default
+
+async def stream_events(request):
+    session = current_session(request)
+    if not session:
+        return JsonResponse({'status': 'error', 'message': '接続されていません'}, status=409)
+    manager, events = session.chat_manager, session.events
+
+    after = query_int(request, 'after', 0)
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        after = int(last_event_id)
+
+    if request.GET.get('transport') == 'poll':
+        # EventSourceが使えない環境向けのロングポーリング。変化があるかタイムアウトまで待って返す
+        peer_version = query_int(request, 'peer_version', -1)
+        version = events.version
+        payload = collect_events(manager, after, peer_version, events)
+        if not payload["messages"] and not payload["reset"] and "peers" not in payload:
+            await events.wait_async(version, LONG_POLL_SECONDS)
+            payload = collect_events(manager, after, peer_version, events)
+        payload.setdefault("peer_version", events.peer_version)
+        return JsonResponse(payload)
+
+    # WSGIでは非同期イテレータが全体をバッファしてしまうので、同期版で1スレッドを占有して流す
+    if isinstance(request, ASGIRequest):
+        stream = event_stream_async(session, after)
+    else:
+        stream = event_stream(session, after)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 def get_client_info(request):
-    global connection_manager
-    if connection_manager:
+    session = current_session(request)
+    if session:
+        connection_manager = session.connection_manager
         # クライアントの情報を辞書形式で整形
         client_info = {
             "nickname": connection_manager.nickname,
@@ -75,14 +218,15 @@ def get_client_info(request):
     return JsonResponse({})
 
 def get_peer_info(request):
-    if chat_manager:
-        return JsonResponse(chat_manager.peer_info)
+    session = current_session(request)
+    if session:
+        return JsonResponse(session.chat_manager.peer_info)
     return JsonResponse({})
 
 def disconnect(request):
-    global chat_manager, connection_manager
-    if chat_manager:
-        chat_manager.disconnect()
-    chat_manager = None
-    connection_manager = None
-    return JsonResponse({'status': 'success'})
+    key = request.COOKIES.get(SESSION_COOKIE)
+    if key:
+        sessions.remove(key)
+    response = JsonResponse({'status': 'success'})
+    response.delete_cookie(SESSION_COOKIE)
+    return response
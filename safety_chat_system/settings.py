@@ -8,6 +8,9 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 CHAT_SERVER_HOST = os.getenv('CHAT_SERVER_HOST', '0.0.0.0')
 CHAT_SERVER_PORT = int(os.getenv('CHAT_SERVER_PORT', '12345'))
+CHAT_MESSAGE_RETENTION = int(os.getenv('CHAT_MESSAGE_RETENTION', '10000'))
+CHAT_MAX_SESSIONS = int(os.getenv('CHAT_MAX_SESSIONS', '500'))
+CHAT_SESSION_IDLE_SECONDS = int(os.getenv('CHAT_SESSION_IDLE_SECONDS', '1800'))
 
 
 DEBUG = True